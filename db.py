@@ -1,10 +1,35 @@
+import itertools
 import streamlit as st
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 import psycopg2.pool
 import pandas as pd
 
 
+# NUMERIC → float (thay vì Decimal), DATE → giữ text ISO để query() đổi cả cột sang datetime64 1 lần
+_NUMERIC_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, "NUMERIC_FLOAT", lambda v, cur: None if v is None else float(v))
+_DATE_TEXT = psycopg2.extensions.new_type(psycopg2.extensions.DATE.values, "DATE_TEXT", lambda v, cur: v)
+_DATE_OIDS = frozenset(psycopg2.extensions.DATE.values)
+
+QUERY_CHUNK_ROWS = 20_000     # Số dòng mỗi lần FETCH của server-side cursor (query_chunks)
+QUERY_ROW_BUDGET = 500_000    # Trần số dòng 1 query stream được đọc (0 = không giới hạn)
+_cursor_ids = itertools.count()
+
+
+class RowBudgetExceeded(RuntimeError):
+    """Query trả nhiều dòng hơn max_rows — thu hẹp bộ lọc hoặc tăng max_rows."""
+
+
+class _TypedConnection(psycopg2.extensions.connection):
+    """Kết nối của pool dashboard: đăng ký caster NUMERIC/DATE ở trên (chỉ cho kết nối này)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        psycopg2.extensions.register_type(_NUMERIC_FLOAT, self)
+        psycopg2.extensions.register_type(_DATE_TEXT, self)
+
+
 @st.cache_resource
 def _get_pool():
     """Tạo connection pool (cache theo resource → chỉ tạo 1 lần)."""
@@ -14,19 +39,183 @@ def _get_pool():
         host=cfg["host"], port=cfg["port"], database=cfg["database"],
         user=cfg["user"], password=cfg["password"],
         sslmode="require", connect_timeout=10,
+        connection_factory=_TypedConnection,
     )
 
 
 def query(sql: str, params=None) -> pd.DataFrame:
+    """Chạy SELECT → DataFrame đúng kiểu: fetch tuple (không dựng dict từng dòng), NUMERIC là float64,
+    DATE là datetime64 — page không cần pd.to_numeric / pd.to_datetime lại. Kết quả rỗng vẫn có cột."""
     pool = _get_pool()
     conn = pool.getconn()
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        with conn.cursor() as cur:
             cur.execute(sql, params or [])
             rows = cur.fetchall()
-            return pd.DataFrame([dict(r) for r in rows])
+            desc = cur.description
     finally:
         pool.putconn(conn)
+    return _frame(rows, desc)
+
+
+def _frame(rows, desc) -> pd.DataFrame:
+    df = pd.DataFrame.from_records(rows, columns=[d.name for d in desc], coerce_float=True)
+    for d in desc:
+        if d.type_code in _DATE_OIDS:
+            df[d.name] = pd.to_datetime(df[d.name], format="%Y-%m-%d", errors="coerce")
+    return df
+
+
+def query_chunks(sql: str, params=None, chunk_rows=QUERY_CHUNK_ROWS, max_rows=QUERY_ROW_BUDGET):
+    """Như query() nhưng đọc qua server-side cursor, yield từng DataFrame ≤ chunk_rows dòng — client
+    chỉ giữ 1 chunk mỗi lúc. Vượt max_rows → RowBudgetExceeded. Không có dòng nào → 1 frame rỗng có cột.
+    Giữ 1 kết nối của pool tới khi generator chạy hết / bị đóng."""
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor(name=f"query_chunks_{next(_cursor_ids)}") as cur:
+            cur.itersize = chunk_rows
+            cur.execute(sql, params or [])
+            total = 0
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows and total:
+                    break
+                total += len(rows)
+                if max_rows and total > max_rows:
+                    raise RowBudgetExceeded(f"Query vượt {max_rows:,} dòng — hãy thu hẹp bộ lọc")
+                yield _frame(rows, cur.description)
+                if not rows:
+                    break
+    finally:
+        conn.rollback()  # đóng transaction của named cursor trước khi trả kết nối về pool
+        pool.putconn(conn)
+
+
+def query_frame(sql: str, params=None, chunk_rows=QUERY_CHUNK_ROWS, max_rows=QUERY_ROW_BUDGET) -> pd.DataFrame:
+    """query_chunks gộp lại 1 DataFrame (không giữ cùng lúc toàn bộ tuple lẫn DataFrame như query())."""
+    return pd.concat(list(query_chunks(sql, params, chunk_rows, max_rows)), ignore_index=True)
+
+
+def query_sum(sql: str, params, by: list, cols: list,
+              chunk_rows=QUERY_CHUNK_ROWS, max_rows=QUERY_ROW_BUDGET) -> pd.DataFrame:
+    """SUM(cols) GROUP BY by trên kết quả query, cộng dồn từng chunk → bộ nhớ theo số nhóm,
+    không theo số dòng. Key NULL giữ thành nhóm riêng (như GROUP BY của SQL)."""
+    parts = [c.groupby(by, dropna=False, sort=False)[cols].sum()
+             for c in query_chunks(sql, params, chunk_rows, max_rows)]
+    return pd.concat(parts).groupby(level=list(range(len(by))), dropna=False).sum().reset_index()
+
+
+def rollup_covers(table: str, farm_ids: tuple, s, e) -> bool:
+    """Rollup tháng (agg_cong_thang / agg_vat_tu_thang, ETL tự cập nhật) thay được dữ liệu
+    từng ngày trong [s, e] không: bảng đã có và không nhóm nào vắt qua 2 đầu khoảng ngày."""
+    if not farm_ids or not query("SELECT to_regclass(%s) IS NOT NULL AS ok", [table])["ok"][0]:
+        return False
+    ph = ",".join(["%s"] * len(farm_ids))
+    r = query(f"""
+        SELECT COUNT(*) AS n FROM {table}
+        WHERE farm_id IN ({ph})
+          AND thang BETWEEN DATE_TRUNC('month', %s::date) AND %s
+          AND (ngay_min < %s OR ngay_max > %s)
+    """, list(farm_ids) + [str(s), str(e), str(s), str(e)])
+    return int(r["n"][0]) == 0
+
+
+# ── Aggregate query cho trang Chi Phí ─────────────────────────
+# Mỗi nguồn: bảng fact + rollup tháng cùng alias, các cột lọc / chiều (biểu thức SQL) và measure.
+# {thang} = tháng của dòng: fact → DATE_TRUNC ngày, rollup → cột thang.
+# Vật tư "Không xác định" được đoán loại theo tên (LOAI_VAT_TU_THEO_TEN) ngay trong SQL.
+LOAI_VAT_TU_THEO_TEN = [
+    ("Phân Bón", ["phân", "bio", "calci", "chế phẩm"]),
+    ("Cây Giống", ["cây", "chuối già"]),
+    ("Vật Tư Tiêu Hao", ["xốp", "túi", "băng keo", "bao", "thùng", "carton", "dây", "pallet",
+                         "xe gắn máy", "bơm", "máy tính"]),
+]
+_LOAI_VT = "COALESCE(NULLIF(TRIM(v.loai_vat_tu), ''), 'Không xác định')"
+_TEN_VT = "COALESCE(NULLIF(TRIM(v.ten_vat_tu), ''), 'Không xác định')"
+
+
+def _loai_vat_tu_sql() -> str:
+    whens = []
+    for loai, kws in LOAI_VAT_TU_THEO_TEN:
+        hit = " OR ".join(f"strpos(lower({_TEN_VT}), '{k}') > 0" for k in kws)
+        whens.append(f"WHEN {hit} THEN '{loai}'")
+    return f"CASE WHEN {_LOAI_VT} <> 'Không xác định' THEN {_LOAI_VT} {' '.join(whens)} ELSE 'Không xác định' END"
+
+
+AGG_SOURCES = {
+    "cong": dict(
+        fact="fact_nhat_ky_san_xuat", rollup="agg_cong_thang", alias="nk",
+        joins="""JOIN dim_farm f ON f.farm_id=nk.farm_id
+            JOIN dim_lo   l ON l.lo_id=nk.lo_id
+            JOIN dim_doi  d ON d.doi_id=nk.doi_id
+            JOIN dim_cong_viec cv ON cv.cong_viec_id=nk.cong_viec_id""",
+        cols={"farm_code": "f.farm_code", "lo_code": "l.lo_code", "lo_type": "l.lo_type",
+              "doi_code": "d.doi_code", "is_ho_tro": "nk.is_ho_tro", "thang": "{thang}",
+              "cong_doan": "COALESCE(NULLIF(TRIM(cv.cong_doan),''),'Không ghi')",
+              "ten_cong_viec": "COALESCE(NULLIF(TRIM(cv.ten_cong_viec),''),'Không ghi')"},
+        measures={"so_cong": "SUM(nk.so_cong)", "thanh_tien": "SUM(nk.thanh_tien)"}),
+    "vt": dict(
+        fact="fact_vat_tu", rollup="agg_vat_tu_thang", alias="vt",
+        joins="""JOIN dim_farm f ON f.farm_id=vt.farm_id
+            JOIN dim_lo   l ON l.lo_id=vt.lo_id
+            LEFT JOIN dim_vat_tu v ON v.vat_tu_id=vt.vat_tu_id""",
+        cols={"farm_code": "f.farm_code", "lo_code": "l.lo_code", "lo_type": "l.lo_type",
+              "thang": "{thang}", "loai_vat_tu": _loai_vat_tu_sql(), "ten_vat_tu": _TEN_VT},
+        measures={"thanh_tien": "SUM(vt.thanh_tien)"}),
+}
+
+
+@st.cache_data(ttl=300, max_entries=32)
+def load_agg(kind: str, sets: tuple, farm_ids: tuple, s, e, filters=(), sel_vus=None) -> dict:
+    """SUM measure của AGG_SOURCES[kind] theo từng bộ chiều trong sets, 1 query GROUP BY GROUPING SETS
+    → {bộ chiều: DataFrame(chiều + measure + n)}, sort theo chiều và bỏ nhóm có chiều NULL như groupby
+    của pandas. () = tổng cộng (luôn 1 dòng; n = số dòng fact, 0 khi không có dữ liệu).
+    filters: ((cột, (giá trị, ...)), ...) — mỗi cặp là 1 điều kiện IN, rỗng → không dòng nào.
+    Không lọc vụ và khoảng ngày khớp rollup → đọc rollup tháng thay cho fact."""
+    src = AGG_SOURCES[kind]
+    a = src["alias"]
+    use_agg = not sel_vus and rollup_covers(src["rollup"], farm_ids, s, e)
+    thang = f"{a}.thang" if use_agg else f"DATE_TRUNC('month',{a}.ngay)::date"
+    cols = {k: v.replace("{thang}", thang) for k, v in src["cols"].items()}
+
+    conds = [f"{a}.farm_id IN ({','.join(['%s']*len(farm_ids))})"]
+    params = list(farm_ids)
+    if sel_vus:
+        conds.append("(" + " OR ".join([f"({a}.lo_id = %s AND {a}.ngay BETWEEN %s AND %s)"] * len(sel_vus)) + ")")
+        for v in sel_vus:
+            params += [v["lo_id"], v["vu_start"], v["vu_end"]]
+    elif use_agg:
+        conds.append(f"{a}.thang BETWEEN DATE_TRUNC('month', %s::date) AND %s"); params += [str(s), str(e)]
+    else:
+        conds.append(f"{a}.ngay BETWEEN %s AND %s"); params += [str(s), str(e)]
+    for col, values in filters:
+        if not values:
+            conds.append("FALSE"); continue
+        conds.append(f"{cols[col]} IN ({','.join(['%s']*len(values))})"); params += list(values)
+
+    dims = list(dict.fromkeys(d for st_ in sets for d in st_))
+    meas = list(src["measures"])
+    n_expr = f"SUM({a}.so_dong)" if use_agg else "COUNT(*)"
+    select = [f"{cols[d]} AS {d}" for d in dims]
+    select += [f"{src['measures'][m]} AS {m}" for m in meas] + [f"COALESCE({n_expr}, 0) AS n"]
+    select.append(f"GROUPING({', '.join(cols[d] for d in dims)}) AS g" if dims else "0 AS g")
+    gsets = ", ".join("(" + ", ".join(cols[d] for d in st_) + ")" for st_ in dict.fromkeys(sets))
+    df = query(f"""
+        SELECT {', '.join(select)}
+        FROM {src['rollup'] if use_agg else src['fact']} {a}
+        {src['joins']}
+        WHERE {' AND '.join(conds)}
+        GROUP BY GROUPING SETS ({gsets})
+    """, params)
+
+    out = {}
+    for st_ in sets:
+        g = sum(1 << (len(dims) - 1 - i) for i, d in enumerate(dims) if d not in st_)
+        part = df.loc[df["g"] == g, list(st_) + meas + ["n"]].dropna(subset=list(st_)).infer_objects()
+        part[meas] = part[meas].astype(float).fillna(0)
+        out[st_] = (part.sort_values(list(st_)) if st_ else part).reset_index(drop=True)
+    return out
 
 
 @st.cache_data(ttl=300)
@@ -130,9 +319,8 @@ def load_lo_vu_summary(farm_ids: tuple, s, e, lo_types=(), sel_los=()):
     elif vt_df.empty:
         merged = cong_df.copy(); merged["tien_vt"] = 0.0
     else:
-        merged = pd.merge(cong_df, vt_df, on=["lo_code", "farm_code", "vu"], how="outer").fillna(0)
-    for col in ["tien_cong", "tien_vt", "so_cong"]:
-        merged[col] = pd.to_numeric(merged[col], errors="coerce").fillna(0)
+        merged = pd.merge(cong_df, vt_df, on=["lo_code", "farm_code", "vu"], how="outer")
+    merged[["tien_cong", "tien_vt", "so_cong"]] = merged[["tien_cong", "tien_vt", "so_cong"]].fillna(0)
     merged["total"] = merged["tien_cong"] + merged["tien_vt"]
     return merged.sort_values(["farm_code", "lo_code", "vu"]).reset_index(drop=True)
 
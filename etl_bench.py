@@ -0,0 +1,466 @@
+"""
+etl_bench.py — Benchmark throughput ETL trên sheet giả lớn (fake Sheets client + Postgres local)
+Sinh sheet theo đúng các kiểu header map_columns phải xử lý (Master "Công (fact)", team Farm 157
+"Nhập công hàng ngày", team Farm 126 có "Lô 2", header nhiều dòng), chạy fetch → transform → load
+như etl_sync, đo rows/s từng stage + peak RSS, so với baseline đã lưu.
+
+Mỗi size chạy trong 1 process riêng (peak RSS không cộng dồn giữa các size). Bench chỉ đụng
+schema riêng `etl_bench` (xoá + tạo lại mỗi lần chạy) — KHÔNG trỏ --dsn vào Supabase production.
+
+Usage:
+  python etl_bench.py --dsn postgresql://postgres@localhost/postgres          # 10k + 100k, so với baseline
+  python etl_bench.py --dsn ... --sizes 10000 100000 1000000
+  python etl_bench.py --dsn ... --update-baseline                              # Ghi kết quả làm baseline mới
+  python etl_bench.py --dsn ... --tolerance 0.3                                # Cho phép chậm hơn 30%
+"""
+
+import argparse, json, os, platform, random, subprocess, sys, tempfile, time
+from datetime import date, datetime, timedelta
+
+import psycopg2
+
+from etl_fake import FakeSheetsClient
+from etl_sync import (FETCH_MAX_WORKERS, LOAD_BATCH_ROWS, TRANSFORM_WORKERS, ETLProcessor, RunReport,
+                      _process_master, _process_teams, iter_fetch, load_dim_maps, peak_rss_mb, plan_fetch_jobs)
+
+BENCH_SCHEMA = "etl_bench"
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "etl_bench_baseline.json")
+DEFAULT_SIZES = (10_000, 100_000)
+DEFAULT_TOLERANCE = 0.25  # Chậm hơn baseline quá 25% (hoặc RSS cao hơn 25%) → fail
+
+# Metric dùng để so baseline (stage nhỏ như resolve quá nhiễu ở 10k dòng, chỉ in ra để xem)
+CHECKED_RATES = ("transform", "load", "total")
+
+
+# ──────────────────────────────────────────────────────────────
+# SCHEMA: bản rút gọn các bảng ETL dùng (cột + natural key như Supabase)
+# ──────────────────────────────────────────────────────────────
+BENCH_DDL = f"""
+    DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;
+    CREATE SCHEMA {BENCH_SCHEMA};
+    SET search_path = {BENCH_SCHEMA};
+    CREATE TABLE dim_farm (farm_id SERIAL PRIMARY KEY, farm_code TEXT);
+    CREATE TABLE dim_doi (doi_id SERIAL PRIMARY KEY, doi_code TEXT, farm_id INT);
+    CREATE TABLE dim_lo (lo_id SERIAL PRIMARY KEY, lo_code TEXT, farm_id INT, lo_type TEXT DEFAULT 'Lô thực');
+    CREATE TABLE dim_cong_viec (cong_viec_id SERIAL PRIMARY KEY, ten_cong_viec TEXT, cong_doan TEXT);
+    CREATE TABLE dim_vat_tu (vat_tu_id SERIAL PRIMARY KEY, ma_vat_tu TEXT, ten_vat_tu TEXT, loai_vat_tu TEXT);
+    CREATE TABLE fact_nhat_ky_san_xuat (
+        nhat_ky_id SERIAL PRIMARY KEY, farm_id INT, ngay DATE, doi_id INT, lo_id INT, cong_viec_id INT,
+        so_cong NUMERIC, klcv NUMERIC, dinh_muc NUMERIC, ti_le_display NUMERIC, don_gia NUMERIC,
+        thanh_tien NUMERIC, is_ho_tro BOOLEAN DEFAULT FALSE, is_estimated BOOLEAN DEFAULT FALSE,
+        CONSTRAINT uq_nk_natural_key UNIQUE (farm_id, ngay, doi_id, lo_id, cong_viec_id, so_cong, klcv, thanh_tien)
+    );
+    CREATE INDEX idx_nk_farm_ngay ON fact_nhat_ky_san_xuat (farm_id, ngay);
+    CREATE TABLE fact_vat_tu (
+        vat_tu_fact_id SERIAL PRIMARY KEY, farm_id INT, lo_id INT, cong_viec_id INT, vat_tu_id INT, ngay DATE,
+        so_luong NUMERIC, don_gia NUMERIC, thanh_tien NUMERIC,
+        CONSTRAINT uq_vt_natural_key UNIQUE (farm_id, ngay, lo_id, cong_viec_id, vat_tu_id, so_luong, don_gia, thanh_tien)
+    );
+    CREATE INDEX idx_vt_farm_ngay ON fact_vat_tu (farm_id, ngay);
+"""
+
+FARM_CODE = "Farm 157"
+LO_CODES = ["1A", "1B", "2A", "2B", "3A", "3B", "4A", "4B", "5A", "5B", "6A", "7A", "7B", "7C", "8A", "8B",
+            "9A", "10A", "11A", "12A", "12B", "14A", "14B", "15A", "15B", "16A", "17A"]
+LO_GROUPS = ["NT1", "NT2", "NT3", "NT4"]  # Cột "Lô 2" thường ghi nhóm đội (cũng có trong dim_lo)
+DOI_CODES = ["Đội 1", "Đội 2", "Đội BVTV", "Đội Điện Nước", "Đội Cơ Giới", "Đội Thu Hoạch", "Đội NT1"]
+DOI_IN_SHEET = ["Đội 1", "Đội 2", "NT1", "BVTV", "Điện nước", "Cơ giới", "Thu hoạch"]  # Có cả alias
+CONG_VIEC = ["Làm Cỏ Thủ Công", "Bón Phân", "Tưới Nước", "Phun Thuốc BVTV", "Cắt Tỉa Lá", "Chích Bắp",
+             "Bao Buồng", "Thu Hoạch", "Vận Chuyển", "Sửa Chữa Điện", "Cày Đất", "Đào Hố", "Trồng Mới",
+             "Dặm Cây", "Chống Đổ", "Vệ Sinh Vườn", "Cắt Chồi", "Đóng Gói", "Bốc Xếp", "Bảo Vệ"]
+VAT_TU = [(f"VT{i:03d}", name) for i, name in enumerate(
+    ["Urê", "Kali", "DAP", "NPK 16-16-8", "Lân", "Vôi", "Phân Hữu Cơ", "Bao Buồng", "Dây Nilon",
+     "Cọc Chống", "Thuốc Trừ Cỏ", "Thuốc Nấm", "Dầu Diesel", "Nhớt", "Ống Tưới"], start=1)]
+
+
+def setup_schema(dsn):
+    """Tạo lại schema bench + seed dim tables khớp với dữ liệu sinh ra."""
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(BENCH_DDL)
+            cur.execute("INSERT INTO dim_farm (farm_code) VALUES (%s) RETURNING farm_id", (FARM_CODE,))
+            farm_id = cur.fetchone()[0]
+            cur.executemany("INSERT INTO dim_doi (doi_code, farm_id) VALUES (%s, %s)",
+                            [(d, farm_id) for d in DOI_CODES])
+            cur.executemany("INSERT INTO dim_lo (lo_code, farm_id) VALUES (%s, %s)",
+                            [(lo, farm_id) for lo in LO_CODES + LO_GROUPS])
+            cur.executemany("INSERT INTO dim_cong_viec (ten_cong_viec, cong_doan) VALUES (%s, 'Chăm sóc')",
+                            [(cv,) for cv in CONG_VIEC])
+            cur.executemany("INSERT INTO dim_vat_tu (ma_vat_tu, ten_vat_tu) VALUES (%s, %s)", VAT_TU)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ──────────────────────────────────────────────────────────────
+# DỮ LIỆU: layout header thật + dòng giả (kèm tỉ lệ nhỏ dòng lỗi như sheet thật)
+# ──────────────────────────────────────────────────────────────
+# fields song song với header: tên field trong dict giá trị của 1 dòng ("" = ô trống)
+LAYOUTS = {
+    # Master "Công (fact)" — debug_195_header.txt. "Công Đoạn" / "Hạng mục dự toán công" cũng map vào
+    # hang_muc (cột sau ghi đè cột trước) nên phải cùng giá trị, như sheet thật
+    "master_nk": {
+        "type": "nk", "preamble": [],
+        "header": ["Mã CV", "Lô", "Lô 2", "Đội Thực Hiện", "Ngày", "Hạng mục công việc", "Loại công",
+                   "Số Công", "KLCV", "ĐVT", "Đơn Giá", "Định Mức", "Thành Tiền", "Công Đoạn", "Ghi Chú",
+                   "Hỗ Trợ Đội Khác", "Hạng mục dự toán công"],
+        "fields": ["ma_cv", "lo", "lo2", "doi", "ngay", "hang_muc", "loai_cong", "so_cong", "klcv", "dvt",
+                   "don_gia", "dinh_muc", "thanh_tien", "hang_muc", "ghi_chu", "", "hang_muc"],
+    },
+    "master_vt": {
+        "type": "vt", "preamble": [],
+        "header": ["STT", "Mã CV", "Lô", "Lô 2", "Ngày", "Hạng mục công việc", "Vật Tư", "SL", "ĐVT",
+                   "Đơn Giá", "Thành Tiền", "Ghi Chú"],
+        "fields": ["stt", "ma_cv", "lo", "lo2", "ngay", "hang_muc", "vat_tu", "so_luong", "dvt",
+                   "don_gia", "thanh_tien", "ghi_chu"],
+    },
+    # Team Farm 157 "Nhập công hàng ngày": vài dòng tiêu đề phía trên, "Vườn" = lô, header nhiều dòng
+    "team157_nk": {
+        "type": "nk", "preamble": [["Ngày Bắt Đầu", "01/03/2026", "BẢNG NHẬP CÔNG HÀNG NGÀY"], []],
+        "header": ["STT", "Ngày", "Vườn", "Tên công việc", "ĐVT", "KLCV", "Số\ncông", "Đơn giá",
+                   "Thành\ntiền", "Loại công"],
+        "fields": ["stt", "ngay", "lo", "hang_muc", "dvt", "klcv", "so_cong", "don_gia_vnd",
+                   "thanh_tien", "loai_cong"],
+    },
+    "team157_vt": {
+        "type": "vt", "preamble": [["BẢNG NHẬP VẬT TƯ HÀNG NGÀY"]],
+        "header": ["STT", "Ngày", "Vườn", "Tên công việc", "Tên vật tư", "ĐVT", "Số lượng", "Đơn giá",
+                   "Thành\ntiền"],
+        "fields": ["stt", "ngay", "lo", "hang_muc", "ten_vt", "dvt", "so_luong", "don_gia_vnd", "thanh_tien"],
+    },
+    # Team Farm 126 "Công (fact)" — explore_output.txt: STT + "Lô 2" (nhóm đội)
+    "team126_nk": {
+        "type": "nk", "preamble": [["Ngày Bắt Đầu", "13/08/2025", "BẢNG TỔNG HỢP CÔNG"]],
+        "header": ["STT", "Mã CV", "Lô", "Lô 2", "Đội Thực Hiện", "Ngày", "Hạng mục công việc", "Loại công",
+                   "Số Công", "KLCV", "ĐVT", "Đơn Giá", "Thành Tiền"],
+        "fields": ["stt", "ma_cv", "lo", "lo2", "doi", "ngay", "hang_muc", "loai_cong", "so_cong", "klcv",
+                   "dvt", "don_gia", "thanh_tien"],
+    },
+    "team126_vt": {
+        "type": "vt", "preamble": [],
+        "header": ["STT", "Mã CV", "Lô", "Lô 2", "Ngày", "Hạng mục công việc", "Vật Tư", "SL", "ĐVT",
+                   "Đơn Giá", "Thành Tiền"],
+        "fields": ["stt", "ma_cv", "lo", "lo2", "ngay", "hang_muc", "vat_tu", "so_luong", "dvt",
+                   "don_gia", "thanh_tien"],
+    },
+}
+
+# 1 farm "both": Master + team kiểu 157 + team kiểu 126 (đúng cách run_etl route sheet)
+BENCH_SOURCES = {
+    "Farm Bench": {
+        "farm_code": FARM_CODE,
+        "type": "both",
+        "master": "bench-master",
+        "fact_cong_sheet": "Công (fact)",
+        "fact_vt_sheet": "Vật Tư (fact)",
+        "teams": [
+            {"id": "bench-team-157", "name": "Đội 1",
+             "sheets": [{"name": "Nhập công hàng ngày", "type": "nk"},
+                        {"name": "Nhập vật tư hàng ngày", "type": "vt"}]},
+            {"id": "bench-team-126", "name": "Đội 2",
+             "sheets": [{"name": "Công (fact)", "type": "nk"}, {"name": "Vật Tư (fact)", "type": "vt"}]},
+        ],
+    },
+}
+
+# (doc_id, sheet) → (layout, tỉ lệ số dòng)
+BENCH_SHEETS = {
+    ("bench-master", "Công (fact)"): ("master_nk", 0.40),
+    ("bench-master", "Vật Tư (fact)"): ("master_vt", 0.15),
+    ("bench-team-157", "Nhập công hàng ngày"): ("team157_nk", 0.15),
+    ("bench-team-157", "Nhập vật tư hàng ngày"): ("team157_vt", 0.05),
+    ("bench-team-126", "Công (fact)"): ("team126_nk", 0.20),
+    ("bench-team-126", "Vật Tư (fact)"): ("team126_vt", 0.05),
+}
+
+
+class _Pools:
+    """Chuỗi dùng chung giữa các dòng — 1M dòng không tạo 1M bản sao của cùng 1 ngày / lô / tên."""
+
+    def __init__(self):
+        start = date(2025, 1, 1)
+        self.dates = [(start + timedelta(days=i)).strftime("%d/%m/%Y") for i in range(420)]
+        self.cv_variants = [[cv, cv.lower(), f" {cv} "] for cv in CONG_VIEC]  # khác hoa/thường, khoảng trắng
+        self.ma_cv = [f"CS{i + 1:02d}" for i in range(len(CONG_VIEC))]
+        self.so_cong = ["0.5", "1", "1", "1", "1.5", "2", "3"]
+        self.klcv = [str(v) for v in range(10, 500, 10)]
+        self.don_gia = [250_000, 280_000, 300_000, 320_000, 350_000]
+
+
+def fake_values(rng, kind, pools):
+    """Giá trị 1 dòng (dict field → chuỗi như GSheet trả về), kèm ~4% dòng lỗi đủ các rule."""
+    i_cv = rng.randrange(len(CONG_VIEC))
+    lo = rng.choice(LO_CODES)
+    v = {
+        "ngay": rng.choice(pools.dates), "lo": lo, "lo2": rng.choice(LO_GROUPS),
+        "ma_cv": pools.ma_cv[i_cv], "hang_muc": rng.choice(pools.cv_variants[i_cv]),
+        "doi": rng.choice(DOI_IN_SHEET), "dvt": "Công" if kind == "nk" else "Kg",
+    }
+    if kind == "nk":
+        so_cong = rng.choice(pools.so_cong)
+        don_gia = rng.choice(pools.don_gia)
+        v.update(so_cong=so_cong, klcv=rng.choice(pools.klcv), don_gia=f"{don_gia:,}",
+                 don_gia_vnd=f"{don_gia:,} ₫", dinh_muc="100", loai_cong="Khoán" if rng.random() < 0.3 else "Nhật",
+                 thanh_tien=f"{float(so_cong) * don_gia:,.0f}")
+    else:
+        code, name = rng.choice(VAT_TU)
+        so_luong = rng.randint(1, 200)
+        don_gia = rng.choice((8_000, 12_500, 15_000, 45_000))
+        v.update(vat_tu=name, ten_vt=name, so_luong=str(so_luong), don_gia=f"{don_gia:,}",
+                 don_gia_vnd=f"{don_gia:,} ₫", thanh_tien=f"{so_luong * don_gia:,}")
+
+    r = rng.random()
+    if r < 0.01:
+        v["ngay"] = ""                                          # no_date
+    elif r < 0.02:
+        for f in ("so_cong", "klcv", "so_luong", "thanh_tien", "don_gia", "don_gia_vnd"):
+            v.pop(f, None)                                      # empty
+    elif r < 0.025:
+        v["lo"] = "12"                                          # lo_12
+    elif r < 0.03:
+        v["hang_muc"] = "Việc chưa có trong danh mục"           # no_cv (NK) / missing cv (VT)
+    elif r < 0.035:
+        v["thanh_tien"] = "150,000,000"                         # outlier
+    elif r < 0.04:
+        v["ghi_chu"] = "nhập bổ sung"
+    return v
+
+
+def fake_sheet(layout_name, n, rng, pools):
+    """Rows của 1 sheet theo layout: preamble + header + n dòng (~1% dòng nhập trùng dòng trước)."""
+    layout = LAYOUTS[layout_name]
+    fields, kind = layout["fields"], layout["type"]
+    rows = [list(r) for r in layout["preamble"]] + [list(layout["header"])]
+    prev = None
+    for i in range(n):
+        if prev is not None and rng.random() < 0.01:
+            row = list(prev)
+        else:
+            v = fake_values(rng, kind, pools)
+            row = [str(i + 1) if f == "stt" else v.get(f, "") for f in fields]
+            prev = row
+        rows.append(row)
+    return rows
+
+
+def bench_workbooks(n_rows, seed=0):
+    """Workbooks cho FakeSheetsClient: tổng ~n_rows dòng dữ liệu chia theo BENCH_SHEETS."""
+    rng, pools = random.Random(seed), _Pools()
+    workbooks = {}
+    for (doc_id, sheet), (layout, share) in BENCH_SHEETS.items():
+        wb = workbooks.setdefault(doc_id, {"title": f"Bench — {doc_id}", "sheets": {}})
+        wb["sheets"][sheet] = fake_sheet(layout, max(1, round(n_rows * share)), rng, pools)
+    return workbooks
+
+
+# ──────────────────────────────────────────────────────────────
+# CHẠY 1 SIZE (process con)
+# ──────────────────────────────────────────────────────────────
+def run_once(dsn, n_rows, seed=0, batch_rows=LOAD_BATCH_ROWS, workers=FETCH_MAX_WORKERS,
+             transform_workers=TRANSFORM_WORKERS):
+    """Sinh data → fetch (fake) → transform → load vào schema bench. Trả dict kết quả."""
+    t0 = time.perf_counter()
+    workbooks = bench_workbooks(n_rows, seed)
+    gen_s, gen_rss = time.perf_counter() - t0, peak_rss_mb()
+
+    conn = psycopg2.connect(dsn, options=f"-c search_path={BENCH_SCHEMA}")
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE fact_nhat_ky_san_xuat, fact_vat_tu RESTART IDENTITY")
+    conn.commit()
+
+    report = RunReport({"bench_rows": n_rows, "seed": seed, "batch_rows": batch_rows, "workers": workers,
+                        "transform_workers": transform_workers})
+    with report.stage("dim_load"):
+        dim_maps = load_dim_maps(conn, snapshot_path=None)
+    processor = ETLProcessor(conn, dim_maps, batch_rows=batch_rows, report=report,
+                             transform_workers=transform_workers)
+    report.attach(processor=processor)
+
+    gc = FakeSheetsClient(workbooks, latency=(0, 0))
+    jobs = plan_fetch_jobs(BENCH_SOURCES)
+    with report.stage("fetch"):
+        fetched = list(iter_fetch(gc, jobs, max_workers=workers))
+    for wb in fetched:
+        report.add_workbook(wb)
+    del workbooks, gc
+
+    for farm_label, source in BENCH_SOURCES.items():
+        farm_id = dim_maps["farm"][source["farm_code"]]
+        farm_wbs = [wb for wb in fetched if wb["farm_label"] == farm_label]
+        processor.start_farm(farm_id)
+        _process_master(processor, next(wb for wb in farm_wbs if wb["kind"] == "master"), farm_id, farm_label)
+        _process_teams(processor, [wb for wb in farm_wbs if wb["kind"] == "team"], farm_id, farm_label)
+        processor.finish_farm()
+    processor.close()
+    report.finish("ok")
+    conn.close()
+    return bench_result(report.to_dict(), n_rows, gen_s, gen_rss)
+
+
+def bench_result(d, n_rows, gen_s, gen_rss):
+    """Rút gọn run report thành số liệu benchmark: rows/s theo stage + RSS."""
+    stages = d["stages_s"]
+    rows_read = d["rows"]["nk_total"] + d["rows"]["vt_total"]
+    sent = sum(v["sent"] for v in d["load"].values())
+
+    def rate(count, *names):
+        seconds = sum(stages.get(k, 0.0) for k in names)
+        return round(count / seconds, 1) if seconds else None
+
+    return {
+        "rows": n_rows,
+        "rows_read": rows_read,
+        "rows_sent": sent,
+        "rows_inserted": sum(v["inserted"] for v in d["load"].values()),
+        "generate_s": round(gen_s, 2),
+        "duration_s": d["duration_s"],
+        "stages_s": stages,
+        "rows_per_s": {
+            "fetch": rate(rows_read, "fetch"),
+            "parse": rate(rows_read, "parse"),
+            "resolve": rate(rows_read, "resolve"),
+            "filter": rate(rows_read, "filter"),
+            "transform": rate(rows_read, "parse", "resolve", "filter"),
+            "load": rate(sent, "load"),
+            "total": round(rows_read / d["duration_s"], 1) if d["duration_s"] else None,
+        },
+        "generate_rss_mb": gen_rss,
+        "peak_rss_mb": d["peak_rss_mb"],
+    }
+
+
+# ──────────────────────────────────────────────────────────────
+# BASELINE
+# ──────────────────────────────────────────────────────────────
+def load_baseline(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, results, previous=None):
+    """Ghi kết quả làm baseline (giữ các size cũ không chạy lần này)."""
+    baseline = {"created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(), "machine": platform.platform(),
+                "results": dict((previous or {}).get("results", {}))}
+    baseline["results"].update({str(r["rows"]): r for r in results})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=1)
+    print(f"📝 Baseline: {path}")
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """So với baseline → list mô tả regression (rỗng = OK)."""
+    regressions = []
+    for r in results:
+        base = baseline["results"].get(str(r["rows"]))
+        if not base:
+            print(f"  ⚠️ {r['rows']:,} dòng: chưa có trong baseline, bỏ qua so sánh")
+            continue
+        for metric in CHECKED_RATES:
+            now, ref = r["rows_per_s"].get(metric), base["rows_per_s"].get(metric)
+            if now and ref and now < ref * (1 - tolerance):
+                regressions.append(f"{r['rows']:,} dòng — {metric}: {now:,.0f} dòng/s < baseline {ref:,.0f} "
+                                   f"({now / ref - 1:+.0%})")
+        now, ref = r.get("peak_rss_mb"), base.get("peak_rss_mb")
+        if now and ref and now > ref * (1 + tolerance):
+            regressions.append(f"{r['rows']:,} dòng — peak RSS: {now:.0f} MB > baseline {ref:.0f} MB "
+                               f"({now / ref - 1:+.0%})")
+    return regressions
+
+
+def print_results(results):
+    print(f"\n  {'Dòng':>10} {'Tổng/s':>9} {'Parse/s':>9} {'Resolve/s':>10} {'Filter/s':>9} "
+          f"{'Load/s':>9} {'Giây':>7} {'RSS MB':>7}")
+    print(f"  {'-' * 76}")
+    for r in results:
+        rate = r["rows_per_s"]
+        cells = [f"{rate[k]:>{w},.0f}" if rate[k] else f"{'-':>{w}}"
+                 for k, w in (("total", 9), ("parse", 9), ("resolve", 10), ("filter", 9), ("load", 9))]
+        rss = f"{r['peak_rss_mb']:>7.0f}" if r["peak_rss_mb"] is not None else f"{'-':>7}"
+        print(f"  {r['rows']:>10,} {' '.join(cells)} {r['duration_s']:>7.1f} {rss}")
+
+
+# ──────────────────────────────────────────────────────────────
+# MAIN
+# ──────────────────────────────────────────────────────────────
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark throughput ETL (fake Sheets + Postgres local)")
+    parser.add_argument("--dsn", default=os.getenv("ETL_BENCH_DSN"),
+                        help="Postgres local (mặc định env ETL_BENCH_DSN); bench dùng schema riêng etl_bench")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Tổng số dòng dữ liệu mỗi lần chạy (VD: 10000 100000 1000000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-rows", type=int, default=LOAD_BATCH_ROWS)
+    parser.add_argument("--workers", type=int, default=FETCH_MAX_WORKERS)
+    parser.add_argument("--transform-workers", type=int, default=TRANSFORM_WORKERS)
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="File baseline JSON")
+    parser.add_argument("--update-baseline", action="store_true", help="Ghi kết quả lần này làm baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Mức chậm hơn baseline cho phép (mặc định {DEFAULT_TOLERANCE:.0%})")
+    parser.add_argument("--output", help="Ghi kết quả (JSON) ra file")
+    parser.add_argument("--verbose", action="store_true", help="Hiện log ETL của từng lần chạy")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)  # process con: chạy 1 size
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("cần --dsn (hoặc env ETL_BENCH_DSN) trỏ tới Postgres local")
+
+    if args.run_one:
+        result = run_once(args.dsn, args.run_one, args.seed, args.batch_rows, args.workers,
+                          args.transform_workers)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    print("=" * 55)
+    print(f"🏁 ETL BENCH — {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"   Sizes: {', '.join(f'{n:,}' for n in args.sizes)} dòng — batch {args.batch_rows:,}")
+    print("=" * 55)
+    setup_schema(args.dsn)
+
+    results = []
+    for n in args.sizes:
+        print(f"\n⏱️ {n:,} dòng...")
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "result.json")
+            cmd = [sys.executable, os.path.abspath(__file__), "--dsn", args.dsn, "--run-one", str(n),
+                   "--seed", str(args.seed), "--batch-rows", str(args.batch_rows),
+                   "--workers", str(args.workers), "--transform-workers", str(args.transform_workers),
+                   "--output", out]
+            proc = subprocess.run(cmd, stdout=None if args.verbose else subprocess.DEVNULL)
+            if proc.returncode != 0:
+                print(f"❌ Lần chạy {n:,} dòng lỗi (exit {proc.returncode}) — chạy lại với --verbose")
+                sys.exit(proc.returncode)
+            with open(out, encoding="utf-8") as f:
+                result = json.load(f)
+        results.append(result)
+        print(f"  ✅ {result['rows_read']:,} dòng đọc, {result['rows_inserted']:,} insert, "
+              f"{result['duration_s']:.1f}s (sinh data {result['generate_s']:.1f}s)")
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+    baseline = load_baseline(args.baseline)
+    if args.update_baseline:
+        save_baseline(args.baseline, results, baseline)
+        return
+    if baseline is None:
+        print(f"\n⚠️ Chưa có baseline ({args.baseline}) — chạy với --update-baseline để tạo")
+        return
+
+    print(f"\n📊 So với baseline {baseline['created_at']} (tolerance {args.tolerance:.0%})")
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        for line in regressions:
+            print(f"  ❌ {line}")
+        sys.exit(1)
+    print("  ✅ Không có regression")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+etl_fake.py — Fake Google Sheets client cho ETL (chạy local, không cần token.json)
+Giả lập latency + lỗi 429 (ngẫu nhiên và theo quota/phút) để thử fetch scheduler.
+
+Usage:
+  python etl_fake.py                          # 15 workbook theo ETL_SOURCES, quota 60/phút
+  python etl_fake.py --quota 600 --error-rate 0.1 --workers 8
+"""
+
+import argparse, random, re, threading, time
+from collections import deque
+
+import gspread
+
+
+class _FakeResponse:
+    """Đủ interface để dựng gspread.exceptions.APIError."""
+
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._body = {"error": {"code": code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._body
+
+
+class FakeSheetsClient:
+    """Thay thế gspread.Client (phần http_client mà ETL dùng).
+    workbooks = {doc_id: {"title": str, "sheets": {name: rows}}}
+
+    latency:    (min, max) giây cho mỗi API call
+    error_rate: xác suất 1 call trả 429 ngẫu nhiên
+    quota_per_min: nếu set, trả 429 khi số call trong 60s gần nhất vượt quota (như server thật)
+    drive:      False → Drive metadata trả 403 (token thiếu scope Drive)
+    """
+
+    def __init__(self, workbooks, latency=(0.05, 0.2), error_rate=0.0, quota_per_min=None, seed=None,
+                 drive=True):
+        self.workbooks = workbooks
+        self.drive = drive
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_per_min = quota_per_min
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = deque()
+        self._active = 0
+        self.stats = {"calls": 0, "errors_429": 0, "max_concurrent": 0}
+
+    def _api_call(self, what):
+        with self._lock:
+            now = time.monotonic()
+            self.stats["calls"] += 1
+            self._active += 1
+            self.stats["max_concurrent"] = max(self.stats["max_concurrent"], self._active)
+            while self._window and now - self._window[0] > 60:
+                self._window.popleft()
+            self._window.append(now)
+            over_quota = self.quota_per_min is not None and len(self._window) > self.quota_per_min
+            random_429 = self._rng.random() < self.error_rate
+            delay = self._rng.uniform(*self.latency)
+        try:
+            time.sleep(delay)
+            if over_quota or random_429:
+                with self._lock:
+                    self.stats["errors_429"] += 1
+                raise gspread.exceptions.APIError(_FakeResponse(429, f"Quota exceeded ({what})"))
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    @property
+    def http_client(self):
+        """ETL gọi thẳng gc.http_client.* (metadata + values.batchGet + Drive) — fake tự đảm nhận."""
+        return self
+
+    def _workbook(self, key):
+        if key not in self.workbooks:
+            raise gspread.exceptions.APIError(_FakeResponse(404, f"Requested entity was not found ({key})"))
+        return self.workbooks[key]
+
+    def fetch_sheet_metadata(self, id, params=None):
+        self._api_call(f"metadata {id}")
+        spec = self._workbook(id)
+        # Lưới sheet thật thường dài hơn phần có dữ liệu (mặc định 1000 dòng)
+        return {"properties": {"title": spec.get("title", id)},
+                "sheets": [{"properties": {"title": name, "gridProperties": {"rowCount": max(len(rows), 1000)}}}
+                           for name, rows in spec.get("sheets", {}).items()]}
+
+    def get_file_drive_metadata(self, id):
+        """Drive files.get (id, name, modifiedTime) — ETL --daemon dùng để phát hiện workbook đổi."""
+        self._api_call(f"drive {id}")
+        if not self.drive:
+            raise gspread.exceptions.APIError(_FakeResponse(403, "Request had insufficient authentication scopes"))
+        spec = self._workbook(id)
+        return {"id": id, "name": spec.get("title", id),
+                "modifiedTime": spec.get("modifiedTime", "2025-01-01T00:00:00.000Z")}
+
+    def update_sheet(self, id, name, rows):
+        """Ghi đè 1 sheet và cập nhật modifiedTime như khi có người sửa trên Google Sheets."""
+        with self._lock:
+            spec = self._workbook(id)
+            spec["sheets"][name] = rows
+            spec["modifiedTime"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{time.time_ns() % 10**9:09d}Z"
+
+    def values_batch_get(self, id, ranges, params=None):
+        self._api_call(f"batchGet {id}")
+        sheets = self._workbook(id).get("sheets", {})
+        value_ranges = []
+        for rng in ranges:
+            name, _, rows_part = rng.rpartition("!") if re.search(r"!\d+:\d+$", rng) else (rng, "", "")
+            if name.startswith("'") and name.endswith("'"):
+                name = name[1:-1].replace("''", "'")
+            if name not in sheets:
+                raise gspread.exceptions.APIError(_FakeResponse(400, f"Unable to parse range: {rng}"))
+            rows = sheets[name]
+            if rows_part:  # "'sheet'!5001:10000" (1-based, gồm cả 2 đầu)
+                first, last = map(int, rows_part.split(":"))
+                rows = rows[first - 1:last]
+            # API thật cắt bỏ ô rỗng cuối dòng và dòng rỗng cuối range
+            values = [list(r) for r in rows]
+            for row in values:
+                while row and row[-1] == "":
+                    row.pop()
+            while values and not values[-1]:
+                values.pop()
+            value_ranges.append({"range": rng, "majorDimension": "ROWS", "values": values})
+        return {"spreadsheetId": id, "valueRanges": value_ranges}
+
+
+# ──────────────────────────────────────────────────────────────
+# Dữ liệu giả theo cấu hình ETL_SOURCES
+# ──────────────────────────────────────────────────────────────
+NK_HEADER = ["STT", "Ngày", "Đội Thực Hiện", "Lô", "Hạng mục", "Số công", "KLCV", "Thành tiền"]
+VT_HEADER = ["STT", "Ngày", "Lô", "Hạng mục", "Vật tư", "SL", "Đơn giá", "Thành tiền"]
+
+
+def fake_rows(kind, n, seed=0):
+    rng = random.Random(seed)
+    header = NK_HEADER if kind == "nk" else VT_HEADER
+    rows = [header]
+    for i in range(n):
+        ngay = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025"
+        lo = rng.choice(["1A", "1B", "3A", "7A", "8A"])
+        if kind == "nk":
+            so_cong = rng.randint(1, 20)
+            rows.append([str(i + 1), ngay, "Đội NT1", lo, "Làm cỏ", str(so_cong), "1", f"{so_cong * 250_000:,}"])
+        else:
+            sl = rng.randint(1, 50)
+            rows.append([str(i + 1), ngay, lo, "Bón phân", "Urê", str(sl), "15,000", f"{sl * 15_000:,}"])
+    return rows
+
+
+def fake_workbooks_for(sources, rows_per_sheet=200):
+    """Dựng workbooks giả đúng doc_id + tên sheet của ETL_SOURCES."""
+    workbooks, seed = {}, 0
+    for farm_label, source in sources.items():
+        if source.get("master"):
+            sheets = {"README": [["ghi chú"]]}
+            sheets[source.get("fact_cong_sheet") or "Công (fact)"] = fake_rows("nk", rows_per_sheet, seed)
+            sheets[source.get("fact_vt_sheet") or "Vật Tư (fact)"] = fake_rows("vt", rows_per_sheet, seed + 1)
+            workbooks[source["master"]] = {"title": f"{farm_label} — Master", "sheets": sheets}
+            seed += 2
+        for team in source.get("teams", []):
+            sheets = {s["name"]: fake_rows(s["type"], rows_per_sheet, seed + i)
+                      for i, s in enumerate(team["sheets"])}
+            workbooks[team["id"]] = {"title": f"{farm_label} — {team['name']}", "sheets": sheets}
+            seed += len(team["sheets"])
+    return workbooks
+
+
+def main():
+    from etl_sync import ETL_SOURCES, FETCH_MAX_WORKERS, TokenBucket, fetch_all, plan_fetch_jobs
+
+    parser = argparse.ArgumentParser(description="Chạy fetch scheduler với fake Sheets client")
+    parser.add_argument("--quota", type=int, default=60, help="Quota server giả (call/phút)")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="Xác suất 429 ngẫu nhiên")
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.05, 0.3), metavar=("MIN", "MAX"))
+    parser.add_argument("--workers", type=int, default=FETCH_MAX_WORKERS)
+    parser.add_argument("--rows", type=int, default=200, help="Số dòng mỗi sheet")
+    args = parser.parse_args()
+
+    gc = FakeSheetsClient(fake_workbooks_for(ETL_SOURCES, args.rows), latency=tuple(args.latency),
+                          error_rate=args.error_rate, quota_per_min=args.quota, seed=42)
+    jobs = plan_fetch_jobs(ETL_SOURCES)
+    t0 = time.monotonic()
+    results = fetch_all(gc, jobs, TokenBucket.per_minute(args.quota), max_workers=args.workers)
+    elapsed = time.monotonic() - t0
+
+    ok = sum(1 for r in results if r["ok"])
+    print(f"\n📊 {ok}/{len(results)} workbook OK trong {elapsed:.1f}s")
+    print(f"   API calls: {gc.stats['calls']}, 429: {gc.stats['errors_429']}, "
+          f"song song tối đa: {gc.stats['max_concurrent']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,33 @@ Usage:
   python etl_sync.py --full-reload      # Xoá tất cả + INSERT lại
   python etl_sync.py --farm 126         # Chỉ chạy cho 1 farm
   python etl_sync.py --farm 126 --full-reload
+  python etl_sync.py --workers 8 --quota 60   # Đọc song song 8 workbook, quota 60 req/phút
+  python etl_sync.py --ignore-state           # Xử lý lại cả sheet không đổi
+  python etl_sync.py --since-last-run         # Chỉ parse dòng mới sau watermark (+ lookback)
+  python etl_sync.py --window-rows 5000       # Sheet lớn đọc theo cửa sổ 5k dòng (0 = cả sheet 1 lần)
+  python etl_sync.py --dedup-batch            # Bỏ dòng trùng trong batch trước khi load
+  python etl_sync.py --batch-rows 5000        # Flush xuống DB mỗi 5k dòng, commit theo farm
+  python etl_sync.py --report-db              # Ghi run report (JSON) vào bảng etl_runs
+  python etl_sync.py --snapshot-dir snap      # Lưu raw rows đã fetch vào snap/ (gzip JSON + manifest)
+  python etl_sync.py --snapshot-dir snap --replay   # Transform + load lại từ snap/, không gọi Google
+  python etl_sync.py --transform-workers 6    # Transform 6 sheet song song (process pool)
+  python etl_sync.py --plan                   # In số dòng sẽ insert theo farm / tháng, không ghi DB
+  python etl_sync.py --refresh-rollups --farm 195   # Dựng lại rollup tháng (fact bị sửa ngoài ETL)
+  python etl_sync.py --farm 195 --tong-file fact_195_tong.csv   # Cập nhật OBT Dự toán theo phần đổi
+  python etl_sync.py --daemon --poll-interval 120   # Chạy liên tục, chỉ sync farm có workbook đổi
+  python etl_sync.py --resume                 # Chạy tiếp run lỗi: bỏ farm đã commit, dùng lại sheet đã transform
 """
 
-import argparse, json, time, sys, os, re
-from datetime import datetime
+import argparse, json, time, sys, os, re, random, threading, hashlib, io, csv, gzip, operator, pickle, shutil, signal, unicodedata
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from datetime import date, datetime
+from decimal import Decimal
 
+import numpy as np
 import pandas as pd
 import psycopg2
 import psycopg2.extras
@@ -240,10 +262,89 @@ def get_db_pool():
 
 
 # ──────────────────────────────────────────────────────────────
-# DIM LOADING: Load toàn bộ dim tables 1 lần
+# DIM LOADING: Load toàn bộ dim tables 1 lần (cache snapshot trên đĩa)
 # ──────────────────────────────────────────────────────────────
-def load_dim_maps(conn):
-    """Load tất cả dim tables vào dictionaries."""
+# Alias tên đội phổ biến trong GSheet → doi_code chuẩn
+DOI_ALIAS = {
+    "Điện nước": "Đội Điện Nước", "Điện Nước": "Đội Điện Nước",
+    "ĐIỆN NƯỚC": "Đội Điện Nước", "ĐIện Nước": "Đội Điện Nước",
+    "Đội Điện nước": "Đội Điện Nước", "Đội Điên Nước": "Đội Điện Nước",
+    "Đội điện nước": "Đội Điện Nước",
+    "Cơ giới": "Đội Cơ Giới", "Cờ Giới 157": "Đội Cơ Giới",
+    "Cơ Giới": "Đội Cơ Giới",
+    "Thu hoạch": "Đội Thu Hoạch", "Thu Hoạch": "Đội Thu Hoạch",
+    "Thu hoạch 157": "Đội Thu Hoạch",
+    "BVTV": "Đội BVTV",
+    "NT1": "Đội NT1", "Đội 1A": "Đội NT1", "Đội 1B": "Đội NT1",
+    "NT2": "Đội NT2", "Đội 2A": "Đội NT2", "Đội 2B": "Đội NT2",
+    "NT1+NT2": "Đội NT1",  # Gán mặc định
+    "NT3+NT4": "Đội NT1",  # Gán mặc định
+    "Vườn Ươm": "Đội Vườn Ươm",
+    "XDG": "XĐG",
+}
+
+DIM_SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), "dim_snapshot.pkl")
+DIM_SNAPSHOT_FORMAT = 1  # Tăng khi đổi cách dựng maps trong build_dim_maps
+
+# 1 query rẻ: md5 nội dung các cột dùng để dựng maps (~1.3k dòng, chỉ trả về vài chục byte)
+DIM_FINGERPRINT_SQL = """
+    SELECT
+        (SELECT md5(COALESCE(string_agg((farm_id, farm_code)::text, '|' ORDER BY farm_id), '')) FROM dim_farm),
+        (SELECT md5(COALESCE(string_agg((doi_id, doi_code)::text, '|' ORDER BY doi_id), '')) FROM dim_doi),
+        (SELECT md5(COALESCE(string_agg((lo_id, lo_code, farm_id)::text, '|' ORDER BY lo_id), '')) FROM dim_lo),
+        (SELECT md5(COALESCE(string_agg((cong_viec_id, ten_cong_viec)::text, '|' ORDER BY cong_viec_id), ''))
+           FROM dim_cong_viec),
+        (SELECT md5(COALESCE(string_agg((vat_tu_id, ma_vat_tu, ten_vat_tu)::text, '|' ORDER BY vat_tu_id), ''))
+           FROM dim_vat_tu)
+"""
+
+
+def dim_fingerprint(conn):
+    """Version của dim tables + code dựng maps: đổi khi DB hoặc DOI_ALIAS / DIM_SNAPSHOT_FORMAT đổi."""
+    with conn.cursor() as cur:
+        cur.execute(DIM_FINGERPRINT_SQL)
+        db_part = tuple(cur.fetchone())
+    code_part = hashlib.sha256(json.dumps(DOI_ALIAS, sort_keys=True).encode("utf-8")).hexdigest()
+    return (DIM_SNAPSHOT_FORMAT, code_part) + db_part
+
+
+def load_dim_maps(conn, snapshot_path=DIM_SNAPSHOT_PATH, refresh=False):
+    """Load tất cả dim tables vào dictionaries.
+    Dùng snapshot trên đĩa nếu fingerprint khớp DB (1 query), ngược lại dựng lại + ghi snapshot.
+    snapshot_path=None: luôn đọc DB, không cache. refresh=True: bỏ qua snapshot hiện có.
+    """
+    if not snapshot_path:
+        return build_dim_maps(conn)
+
+    fingerprint = dim_fingerprint(conn)
+    if not refresh:
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot.get("fingerprint") == fingerprint:
+                maps = snapshot["maps"]
+                print(f"  📦 Dim snapshot khớp DB: {len(maps['farm'])} farm, {len(maps['doi'])} đội, "
+                      f"{len(maps['lo'])} lô, {len(maps['cv'])} CV, {len(maps['vt'])} VT")
+                return maps
+            print("  🔄 Dim tables (hoặc DOI_ALIAS) đã đổi → dựng lại snapshot")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"  ⚠️ Snapshot dim lỗi ({e}), dựng lại")
+
+    maps = build_dim_maps(conn)
+    try:
+        tmp = snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({"fingerprint": fingerprint, "maps": maps}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, snapshot_path)
+    except OSError as e:
+        print(f"  ⚠️ Không ghi được snapshot dim: {e}")
+    return maps
+
+
+def build_dim_maps(conn):
+    """Đọc dim tables từ DB và dựng các dict lookup (kể cả alias, case-insensitive)."""
     maps = {}
     with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
         # Farm: farm_code → farm_id
@@ -255,24 +356,7 @@ def load_dim_maps(conn):
         cur.execute("SELECT doi_id, doi_code FROM dim_doi")
         maps["doi"] = {r["doi_code"].strip(): r["doi_id"] for r in cur.fetchall()}
         # Thêm alias phổ biến
-        doi_alias = {
-            "Điện nước": "Đội Điện Nước", "Điện Nước": "Đội Điện Nước",
-            "ĐIỆN NƯỚC": "Đội Điện Nước", "ĐIện Nước": "Đội Điện Nước",
-            "Đội Điện nước": "Đội Điện Nước", "Đội Điên Nước": "Đội Điện Nước",
-            "Đội điện nước": "Đội Điện Nước",
-            "Cơ giới": "Đội Cơ Giới", "Cờ Giới 157": "Đội Cơ Giới",
-            "Cơ Giới": "Đội Cơ Giới",
-            "Thu hoạch": "Đội Thu Hoạch", "Thu Hoạch": "Đội Thu Hoạch",
-            "Thu hoạch 157": "Đội Thu Hoạch",
-            "BVTV": "Đội BVTV",
-            "NT1": "Đội NT1", "Đội 1A": "Đội NT1", "Đội 1B": "Đội NT1",
-            "NT2": "Đội NT2", "Đội 2A": "Đội NT2", "Đội 2B": "Đội NT2",
-            "NT1+NT2": "Đội NT1",  # Gán mặc định
-            "NT3+NT4": "Đội NT1",  # Gán mặc định
-            "Vườn Ươm": "Đội Vườn Ươm",
-            "XDG": "XĐG",
-        }
-        for alias, real in doi_alias.items():
+        for alias, real in DOI_ALIAS.items():
             if real in maps["doi"] and alias not in maps["doi"]:
                 maps["doi"][alias] = maps["doi"][real]
         print(f"  dim_doi: {len(maps['doi'])} entries (incl. aliases)")
@@ -445,86 +529,693 @@ def _map_value(val, lookup, missing_set, fallback_lookup=None):
     return None
 
 
-def _resolve_lo(lo_raw, lo_code_val, farm_id, maps, missing_lo):
-    """Resolve lô ID với ưu tiên: lo_raw (lô thật) > lo_code (Lô 2), case-insensitive fallback.
-    Trả (lo_id, lo_display) — lo_display dùng cho missing tracking.
+def dim_key(val):
+    """Khoá so khớp dim: Unicode NFC, gộp khoảng trắng, casefold ("  Lô  3a " ≡ "lô 3A")."""
+    return " ".join(unicodedata.normalize("NFC", str(val)).split()).casefold()
+
+
+class DimResolver:
+    """Index lookup FK dựng 1 lần / run trên khoá dim_key + memo theo giá trị thô.
+    Sheet lặp lại cùng vài chục mã lô / hạng mục hàng nghìn lần → mỗi giá trị chỉ resolve 1 lần.
+    Ghi giá trị không khớp vào missing (dict set của ETLProcessor).
     """
-    lo_id = None
-
-    # 1) Thử lo_raw (cột Lô) — thường là lô thật (3A, 1B...)
-    if lo_raw:
-        lo_id = maps["lo"].get(lo_raw)
-        if not lo_id:
-            lo_id = maps["lo_by_farm"].get((farm_id, lo_raw))
-        if not lo_id:  # case-insensitive fallback
-            lo_id = maps["lo_ci"].get(lo_raw.lower())
-        if not lo_id:
-            lo_id = maps["lo_by_farm_ci"].get((farm_id, lo_raw.lower()))
-
-    # 2) Fallback: lo_code (cột Lô 2) — thường là nhóm đội (NT1+NT2)
-    if not lo_id and lo_code_val:
-        lo_id = maps["lo"].get(lo_code_val)
-        if not lo_id:
-            lo_id = maps["lo_by_farm"].get((farm_id, lo_code_val))
-        if not lo_id:
-            lo_id = maps["lo_ci"].get(lo_code_val.lower())
-        if not lo_id:
-            lo_id = maps["lo_by_farm_ci"].get((farm_id, lo_code_val.lower()))
-
-    # 3) Ghi missing
-    if not lo_id:
-        lo_display = lo_raw or lo_code_val
-        if lo_display:
-            missing_lo.add(lo_display)
-
-    return lo_id
-
-
-def _resolve_cv(ma_cv, hang_muc, loai_cong, maps, conn, missing_cv):
-    """Resolve công việc ID chỉ bằng tên (case-insensitive).
-    ma_cv từ sheet được bỏ qua — DB dùng mã chung thống nhất.
-    
-    Returns: cong_viec_id hoặc None
+
+    def __init__(self, maps, missing):
+        self.maps = maps
+        self.missing = missing
+        # Lô: mã chung (mọi farm) thắng mã theo farm — giữ thứ tự ưu tiên cũ lo → lo_by_farm
+        self._lo_global = {dim_key(code): lo_id for code, lo_id in {**maps["lo_ci"], **maps["lo"]}.items()}
+        self._lo_farm = {}
+        for (farm_id, code), lo_id in {**maps["lo_by_farm_ci"], **maps["lo_by_farm"]}.items():
+            self._lo_farm.setdefault(farm_id, {})[dim_key(code)] = lo_id
+        self._lo_index = {}  # farm_id → {dim_key: lo_id} đã gộp
+        self._cv_index = {}
+        for name, cv_id in maps["cv"].items():
+            self._cv_index.setdefault(dim_key(name), cv_id)  # giữ entry đầu tiên như maps["cv"]
+        self._vt_name_index = {dim_key(name): vt_id for name, vt_id in maps["vt_by_name"].items()}
+        self._memo = {"lo": {}, "cv": {}, "vt": {}}
+
+    def _lo_for_farm(self, farm_id):
+        index = self._lo_index.get(farm_id)
+        if index is None:
+            index = {**self._lo_farm.get(farm_id, {}), **self._lo_global}
+            self._lo_index[farm_id] = index
+        return index
+
+    def lo(self, farm_id, lo_raw, lo_code):
+        """Lô ID: ưu tiên lo_raw (cột Lô, lô thật) > lo_code (cột Lô 2, thường là nhóm đội)."""
+        key = (farm_id, lo_raw, lo_code)
+        memo = self._memo["lo"]
+        if key not in memo:
+            index = self._lo_for_farm(farm_id)
+            lo_id = (lo_raw and index.get(dim_key(lo_raw))) or (lo_code and index.get(dim_key(lo_code))) or None
+            if not lo_id and (lo_raw or lo_code):
+                self.missing["lo"].add(lo_raw or lo_code)
+            memo[key] = lo_id
+        return memo[key]
+
+    def cv(self, ma_cv, hang_muc):
+        """Công việc ID chỉ bằng tên hạng mục (ma_cv chỉ dùng làm tên nếu thiếu hạng mục) —
+        DB dùng mã chung thống nhất. Không tìm thấy → ghi missing, KHÔNG tự động tạo mới.
+        """
+        key = (ma_cv, hang_muc)
+        memo = self._memo["cv"]
+        if key not in memo:
+            name = normalize_text(hang_muc) or normalize_text(ma_cv)
+            cv_id = self._cv_index.get(dim_key(name)) if name else None
+            if name and not cv_id:
+                self.missing["cv"].add(name)
+            memo[key] = cv_id
+        return memo[key]
+
+    def vt(self, code, name):
+        """Vật tư ID: thử mã VT (chính xác) trước, rồi tên VT."""
+        key = (code, name)
+        memo = self._memo["vt"]
+        if key not in memo:
+            vt_id = None
+            if code:
+                vt_id = _map_value(code, self.maps["vt"], self.missing["vt"])
+            if not vt_id and name:
+                vt_id = self._vt_name_index.get(dim_key(name))
+                if not vt_id:
+                    self.missing["vt"].add(name)
+            memo[key] = vt_id
+        return memo[key]
+
+
+# ──────────────────────────────────────────────────────────────
+# TRANSFORM (vectorized): sheet → DataFrame cột chuẩn, parse theo cột
+# ──────────────────────────────────────────────────────────────
+def sheet_frame(rows, col_map):
+    """rows (list[list]) → DataFrame với cột chuẩn theo col_map, mọi ô là str ("" nếu thiếu).
+    Giống hệt vòng lặp `vals[target] = row[idx]`: nhiều cột cùng target → cột sau (nếu dòng
+    đủ dài) ghi đè cột trước.
     """
-    # 1) Thử tên hạng mục (case-insensitive)
-    name = normalize_text(hang_muc)
-    if not name:
-        # Fallback: dùng ma_cv từ sheet như tên nếu không có hang_muc
-        name = normalize_text(ma_cv)
-    if not name:
-        return None
+    raw = pd.DataFrame(rows, dtype=object)
+    lens = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    cols = {}
+    for idx, target in col_map.items():
+        if idx >= raw.shape[1]:
+            continue
+        fallback = cols.get(target, "")
+        cols[target] = raw[idx].where(lens > idx, fallback)
+    df = pd.DataFrame(cols, index=raw.index)
+    return df.fillna("").astype(str)
 
-    key = name.lower()
-    cv_id = maps["cv"].get(key)
-    if cv_id:
-        return cv_id
 
-    # 2) Không tìm thấy → report missing, KHÔNG tự động tạo mới
-    missing_cv.add(name)
-    return None
+def _col(df, name):
+    """Cột đã strip (như normalize_text); cột không có trong sheet → toàn ""."""
+    if name not in df:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[name].str.strip()
+
+
+def _map_unique(fn, *cols):
+    """Áp fn lên từng giá trị (hoặc tuple giá trị) DUY NHẤT rồi broadcast về từng dòng.
+    Sheet lặp lại cùng vài chục lô/đội/hạng mục hàng nghìn lần → fn chỉ chạy vài chục lần.
+    """
+    if len(cols) == 1:
+        codes, uniques = pd.factorize(cols[0])
+        mapped = [fn(u) for u in uniques]
+    else:
+        codes, uniques = pd.MultiIndex.from_arrays(cols).factorize()
+        mapped = [fn(*u) for u in uniques]
+    out = np.empty(len(mapped), dtype=object)
+    out[:] = mapped
+    return out[codes]
+
+
+def parse_date_series(col):
+    """Vectorized parse_date: fast path dd/mm/yyyy cho cả cột, phần còn lại qua parse_date."""
+    codes, uniques = pd.factorize(col)
+    uniques = np.asarray(uniques, dtype=object)
+    uniq = pd.Series(uniques, dtype=object).str.strip()
+    dt = pd.to_datetime(uniq, format="%d/%m/%Y", errors="coerce")
+    limit = pd.Timestamp.now() + pd.Timedelta(days=30)
+    parsed = np.where(dt.notna() & (dt <= limit), dt.dt.strftime("%Y-%m-%d"), None).astype(object)
+    for i in np.flatnonzero(dt.isna().to_numpy()):
+        parsed[i] = parse_date(uniques[i])
+    return parsed[codes]
+
+
+def parse_number_series(col):
+    """Vectorized parse_number (float64): bỏ khoảng trắng + dấu phẩy, ô rỗng/lỗi → 0.0."""
+    cleaned = col.str.strip().str.replace(" ", "", regex=False).str.replace(",", "", regex=False)
+    codes, uniques = pd.factorize(cleaned)
+    uniques = np.asarray(uniques, dtype=object)
+    values = np.zeros(len(uniques))
+    nonempty = np.flatnonzero(uniques != "")
+    try:
+        values[nonempty] = uniques[nonempty].astype(np.float64)
+    except ValueError:
+        for i in nonempty:
+            try:
+                values[i] = float(uniques[i])
+            except ValueError:
+                pass
+    return values[codes]
+
+
+# ──────────────────────────────────────────────────────────────
+# LOAD: COPY → staging table → INSERT ... SELECT ON CONFLICT
+# ──────────────────────────────────────────────────────────────
+NK_COLUMNS = ("farm_id", "ngay", "doi_id", "lo_id", "cong_viec_id",
+              "so_cong", "klcv", "dinh_muc", "ti_le_display", "thanh_tien", "is_ho_tro")
+VT_COLUMNS = ("farm_id", "lo_id", "cong_viec_id", "vat_tu_id",
+              "ngay", "so_luong", "don_gia", "thanh_tien")
+FACT_TABLES = {
+    "nk": {"table": "fact_nhat_ky_san_xuat", "constraint": "uq_nk_natural_key",
+           "columns": NK_COLUMNS, "staging": "stg_nk", "swap": "swap_nk", "id": "nhat_ky_id",
+           "key": ("farm_id", "ngay", "doi_id", "lo_id", "cong_viec_id", "so_cong", "klcv", "thanh_tien")},
+    "vt": {"table": "fact_vat_tu", "constraint": "uq_vt_natural_key",
+           "columns": VT_COLUMNS, "staging": "stg_vt", "swap": "swap_vt", "id": "vat_tu_fact_id",
+           "key": ("farm_id", "ngay", "lo_id", "cong_viec_id", "vat_tu_id", "so_luong", "don_gia", "thanh_tien")},
+}
+COPY_CHUNK_ROWS = 50_000
+LOAD_BATCH_ROWS = 5_000  # Flush buffer xuống DB mỗi khi đủ số dòng này (trong 1 farm)
+
+
+# Vị trí natural key (khớp FACT_TABLES[kind]["key"]) trong tuple nk_buffer / vt_buffer
+BUFFER_KEYS = {
+    "nk": (0, 1, 2, 3, 4, 5, 6, 9),
+    "vt": (0, 4, 1, 2, 3, 5, 6, 7),
+}
+
+
+def nk_db_row(r):
+    """nk_buffer tuple → đúng NK_COLUMNS (bỏ is_khoan, is_ho_tro = False)."""
+    return r[:10] + (False,)
+
+
+# ── Delta local: hash 64-bit natural key (md5 của dạng text chuẩn, giống hệt phía SQL) ──
+NUMERIC_KEYS = {"so_cong", "klcv", "so_luong", "don_gia", "thanh_tien"}
+
+
+def _key_text(v):
+    """Giá trị key → text như Postgres in ra: ngày 'YYYY-MM-DD', số như trim_scale(numeric)."""
+    if isinstance(v, str):
+        return v
+    if isinstance(v, float):
+        if v.is_integer():
+            return str(int(v))
+        return format(Decimal(repr(v)).normalize(), "f")
+    return str(v)
+
+
+def key_hash(values):
+    """Natural key (không có NULL) → bigint, khớp key_hash_sql."""
+    text = "|".join(map(_key_text, values))
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big", signed=True)
+
+
+def key_hash_sql(kind):
+    """SELECT hash natural key các dòng của 1 farm trong [from, to). Dòng có key NULL không bao giờ
+    trùng theo ON CONFLICT nên không cần tải."""
+    spec = FACT_TABLES[kind]
+    parts = [("to_char(ngay, 'YYYY-MM-DD')" if c == "ngay" else f"trim_scale({c})" if c in NUMERIC_KEYS else c)
+             for c in spec["key"]]
+    not_null = " AND ".join(f"{c} IS NOT NULL" for c in spec["key"])
+    return f"""
+        SELECT ('x' || left(md5(concat_ws('|', {', '.join(parts)})), 16))::bit(64)::bigint
+        FROM {spec['table']}
+        WHERE farm_id = %s AND ngay >= %s AND ngay < %s AND {not_null}
+    """
+
+
+def month_ranges(months):
+    """['2026-01', '2026-02', '2026-04'] → [(2026-01-01, 2026-03-01), (2026-04-01, 2026-05-01)]."""
+    ranges = []
+    for m in sorted(months):
+        start = date(int(m[:4]), int(m[5:7]), 1)
+        end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def copy_rows(cur, table, columns, rows):
+    """Stream rows vào table bằng COPY FROM STDIN (CSV), từng chunk COPY_CHUNK_ROWS dòng.
+    None → ô rỗng không quote = NULL. Trả số dòng đã gửi.
+    """
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    it, total = iter(rows), 0
+    while True:
+        chunk = list(islice(it, COPY_CHUNK_ROWS))
+        if not chunk:
+            return total
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(chunk)
+        buf.seek(0)
+        cur.copy_expert(sql, buf)
+        total += len(chunk)
+
+
+def bulk_insert(cur, kind, rows):
+    """COPY rows vào temp staging (ON COMMIT DROP) rồi 1 lệnh INSERT ... SELECT ... ON CONFLICT
+    DO NOTHING vào bảng fact. Mỗi row = cột FACT_TABLES[kind] + src (index nguồn sheet).
+
+    Dòng insert thành công được đếm từ RETURNING (không COUNT(*) cả bảng), join ngược về staging
+    theo natural key để biết nguồn. Trả (số dòng gửi, [(farm_id, "YYYY-MM", src, số dòng mới)]).
+    """
+    spec = FACT_TABLES[kind]
+    stg = spec["staging"]
+    cols = ", ".join(spec["columns"])
+    cur.execute(f"DROP TABLE IF EXISTS {stg}")
+    cur.execute(f"CREATE TEMP TABLE {stg} ON COMMIT DROP AS SELECT {cols} FROM {spec['table']} WITH NO DATA")
+    cur.execute(f"ALTER TABLE {stg} ADD COLUMN src INT")
+    sent = copy_rows(cur, stg, spec["columns"] + ("src",), rows)
+
+    # Trùng trong batch: ORDER BY src → bản của nguồn xử lý trước được insert (và được ghi nhận)
+    match = " AND ".join(f"s.{c} IS NOT DISTINCT FROM i.{c}" for c in spec["key"][2:])
+    cur.execute(f"""
+        WITH ins AS (
+            INSERT INTO {spec['table']} ({cols})
+            SELECT {cols} FROM {stg} ORDER BY src
+            ON CONFLICT ON CONSTRAINT {spec['constraint']} DO NOTHING
+            RETURNING {spec['id']}, {', '.join(spec['key'])}
+        ), attributed AS (
+            SELECT DISTINCT ON (i.{spec['id']}) i.farm_id, i.ngay, s.src
+            FROM ins i
+            LEFT JOIN {stg} s ON s.farm_id = i.farm_id AND s.ngay = i.ngay AND {match}
+            ORDER BY i.{spec['id']}, s.src
+        )
+        SELECT farm_id, to_char(ngay, 'YYYY-MM'), src, COUNT(*)
+        FROM attributed GROUP BY 1, 2, 3
+    """)
+    return sent, cur.fetchall()
+
+
+def stage_swap_rows(cur, kind, rows, create=False):
+    """Full reload: COPY rows (cột FACT_TABLES[kind] + src) vào staging swap_* của farm — chưa đụng
+    bảng fact. create=True ở batch đầu tiên của farm; seq giữ thứ tự gửi trong cùng src.
+    """
+    spec = FACT_TABLES[kind]
+    stg = spec["swap"]
+    if create:
+        cur.execute(f"DROP TABLE IF EXISTS {stg}")
+        cur.execute(f"CREATE TEMP TABLE {stg} ON COMMIT DROP AS "
+                    f"SELECT {', '.join(spec['columns'])} FROM {spec['table']} WITH NO DATA")
+        cur.execute(f"ALTER TABLE {stg} ADD COLUMN src INT, ADD COLUMN seq BIGSERIAL")
+    return copy_rows(cur, stg, spec["columns"] + ("src",), rows)
+
+
+def swap_window(cur, kind, farm_id, since, plan=False):
+    """Thay cửa sổ (farm_id, ngay >= since) của bảng fact bằng nội dung staging swap_* (chưa commit).
+
+    Mỗi natural key (NULL-safe) lấy bản đầu tiên theo (src, seq) — giống INSERT ... ORDER BY src
+    rồi dedup giữ id nhỏ nhất như trước. So khớp cả dòng qua md5(ROW(...)): dòng không đổi được giữ
+    nguyên (không xoá / insert lại → ít bloat, id ổn định); chỉ xoá dòng cũ không còn hoặc trùng
+    lặp, và insert dòng mới / bị sửa. Caller commit ngay sau đó → đoạn giữ lock rất ngắn, người đọc
+    luôn thấy hoặc toàn bộ dữ liệu cũ hoặc toàn bộ dữ liệu mới.
+    plan=True: chỉ đếm, không ghi.
+    Trả {"deleted", "duplicates", "kept", "breakdown": [(farm_id, "YYYY-MM", src, số dòng mới)]}.
+    """
+    spec = FACT_TABLES[kind]
+    table, stg, pk = spec["table"], spec["swap"], spec["id"]
+    cols = ", ".join(spec["columns"])
+    key = ", ".join(spec["key"])
+    f_hash = f"md5(ROW({', '.join('f.' + c for c in spec['columns'])})::text)"
+    window = "f.farm_id = %(farm_id)s AND f.ngay >= %(since)s"
+    params = {"farm_id": farm_id, "since": since}
+
+    cur.execute(f"DROP TABLE IF EXISTS {stg}_w")
+    cur.execute(f"""
+        CREATE TEMP TABLE {stg}_w ON COMMIT DROP AS
+        SELECT DISTINCT ON ({key}) {cols}, src, seq, md5(ROW({cols})::text) AS row_hash
+        FROM {stg}
+        ORDER BY {key}, src, seq
+    """)
+    cur.execute(f"ANALYZE {stg}_w")
+
+    # Dòng cũ trong cửa sổ: giữ đúng 1 dòng (ưu tiên dòng giống hệt bản mới) cho mỗi key còn trong staging
+    old_rows = f"""
+        SELECT f.{pk} AS id, w.row_hash IS NOT NULL AS same,
+               ROW_NUMBER() OVER (PARTITION BY {', '.join('f.' + c for c in spec['key'])}
+                                  ORDER BY w.row_hash IS NULL, f.{pk}) AS rn
+        FROM {table} f
+        LEFT JOIN {stg}_w w ON w.row_hash = {f_hash}
+        WHERE {window}
+    """
+    new_rows = f"""
+        SELECT {cols}, src, seq, row_hash FROM {stg}_w w
+        WHERE NOT EXISTS (SELECT 1 FROM {table} f WHERE {window} AND {f_hash} = w.row_hash)
+    """
+    if plan:
+        cur.execute(f"SELECT COUNT(*), COUNT(*) FILTER (WHERE rn > 1) FROM ({old_rows}) d "
+                    f"WHERE d.rn > 1 OR NOT d.same", params)
+        deleted, duplicates = cur.fetchone()
+        cur.execute(f"SELECT farm_id, to_char(ngay, 'YYYY-MM'), src, COUNT(*) FROM ({new_rows}) n "
+                    f"GROUP BY 1, 2, 3", params)
+    else:
+        cur.execute(f"""
+            WITH del AS (
+                DELETE FROM {table} t USING ({old_rows}) d
+                WHERE t.{pk} = d.id AND (d.rn > 1 OR NOT d.same)
+                RETURNING d.rn > 1 AS dup
+            )
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE dup) FROM del
+        """, params)
+        deleted, duplicates = cur.fetchone()
+        cur.execute(f"""
+            WITH ins AS (
+                INSERT INTO {table} ({cols})
+                SELECT {cols} FROM ({new_rows}) n ORDER BY src, seq
+                ON CONFLICT ON CONSTRAINT {spec['constraint']} DO NOTHING
+                RETURNING md5(ROW({cols})::text) AS row_hash, farm_id, ngay
+            )
+            SELECT i.farm_id, to_char(i.ngay, 'YYYY-MM'), w.src, COUNT(*)
+            FROM ins i JOIN {stg}_w w ON w.row_hash = i.row_hash
+            GROUP BY 1, 2, 3
+        """, params)
+    breakdown = cur.fetchall()
+    cur.execute(f"SELECT COUNT(*) FROM {stg}_w")
+    kept = cur.fetchone()[0] - sum(n for *_, n in breakdown)
+    return {"deleted": deleted, "duplicates": duplicates, "kept": kept, "breakdown": breakdown}
+
+
+# ──────────────────────────────────────────────────────────────
+# ROLLUP: Bảng tổng hợp theo tháng cho dashboard (chỉ tính lại các tháng mà lần load chạm tới)
+# ──────────────────────────────────────────────────────────────
+ROLLUP_TABLES = {
+    "nk": {"table": "agg_cong_thang", "keys": ("farm_id", "lo_id", "doi_id", "cong_viec_id", "is_ho_tro"),
+           "sums": ("so_cong", "thanh_tien")},
+    "vt": {"table": "agg_vat_tu_thang", "keys": ("farm_id", "lo_id", "vat_tu_id"),
+           "sums": ("so_luong", "thanh_tien")},
+}
+
+
+def refresh_rollup(cur, kind, farm_id=None, months=(), since=None):
+    """Tính lại rollup tháng của farm_id cho các tháng months ("YYYY-MM") và mọi tháng từ since
+    (full reload xoá cửa sổ ngay >= since). farm_id=None hoặc bảng rollup chưa có → dựng lại toàn bộ.
+    Chạy trong transaction của farm → rollup luôn khớp bảng fact. Trả số dòng rollup đã ghi.
+    """
+    spec, fact = ROLLUP_TABLES[kind], FACT_TABLES[kind]["table"]
+    table = spec["table"]
+    keys = ", ".join(spec["keys"])
+    sums = ", ".join(spec["sums"])
+    cur.execute("SELECT to_regclass(%s) IS NULL", (table,))
+    if cur.fetchone()[0]:
+        # Cùng kiểu cột với bảng fact; ngay_min / ngay_max: dashboard biết nhóm có nằm trọn trong
+        # khoảng ngày đang lọc không
+        cur.execute(f"""
+            CREATE TABLE {table} AS
+            SELECT {keys}, NULL::date AS thang, {sums},
+                   0 AS so_dong, NULL::date AS ngay_min, NULL::date AS ngay_max
+            FROM {fact} WITH NO DATA
+        """)
+        cur.execute(f"CREATE INDEX idx_{table}_farm_thang ON {table} (farm_id, thang)")
+        farm_id = None
+    if farm_id is None:
+        where, agg_where, params = "TRUE", "TRUE", {}
+    elif months or since:
+        where = "farm_id = %(farm_id)s AND (thang = ANY(%(months)s::date[]) OR thang >= %(since)s)"
+        agg_where = ("farm_id = %(farm_id)s AND (DATE_TRUNC('month', ngay)::date = ANY(%(months)s::date[]) "
+                     "OR ngay >= %(since)s)")
+        params = {"farm_id": farm_id, "months": sorted(f"{m}-01" for m in months),
+                  "since": since.replace(day=1) if since else date.max}
+    else:
+        return 0
+    cur.execute(f"DELETE FROM {table} WHERE {where}", params)
+    cur.execute(f"""
+        INSERT INTO {table} ({keys}, thang, {sums}, so_dong, ngay_min, ngay_max)
+        SELECT {keys}, DATE_TRUNC('month', ngay)::date, {', '.join(f'SUM({c})' for c in spec['sums'])},
+               COUNT(*), MIN(ngay), MAX(ngay)
+        FROM {fact}
+        WHERE ngay IS NOT NULL AND {agg_where}
+        GROUP BY {keys}, DATE_TRUNC('month', ngay)
+    """, params)
+    return cur.rowcount
+
+
+# ──────────────────────────────────────────────────────────────
+# FACT_195_TONG: Cập nhật OBT Farm 195 theo phần thay đổi thay vì TRUNCATE + reload (--tong-file)
+# ──────────────────────────────────────────────────────────────
+TONG_TABLE = "fact_195_tong"
+TONG_ID = "tong_id"
+
+
+def tong_columns(cur):
+    """Cột nghiệp vụ của fact_195_tong (trừ tong_id) theo thứ tự trong DB → {cột: kiểu dữ liệu}."""
+    cur.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name <> %s
+        ORDER BY ordinal_position
+    """, (TONG_TABLE, TONG_ID))
+    return dict(cur.fetchall())
+
+
+def tong_row_hash_sql(alias, types):
+    """Biểu thức md5 cả dòng của alias (numeric qua trim_scale: "1.00" và "1.0" là cùng giá trị)."""
+    return "md5(ROW({})::text)".format(", ".join(
+        f"trim_scale({alias}.{c})" if t == "numeric" else f"{alias}.{c}" for c, t in types.items()))
+
+
+def load_tong_file(path):
+    """Đọc file CSV (header = tên cột fact_195_tong) do bước dựng OBT xuất ra. Ô rỗng → NULL."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader, [])]
+        rows = [[v if v.strip() != "" else None for v in row] for row in reader if any(v.strip() for v in row)]
+    return header, rows
+
+
+def sync_195_tong(conn, header, rows, farm_id=None, plan=False):
+    """Đồng bộ fact_195_tong với rows (toàn bộ nội dung mới) trong 1 transaction ngắn, không TRUNCATE.
+
+    Bảng không có khoá nghiệp vụ → natural key = md5 cả dòng (numeric bỏ số 0 thừa) + thứ tự xuất
+    hiện trong các dòng giống hệt nhau. Dòng không đổi giữ nguyên (tong_id ổn định), chỉ xoá dòng
+    không còn trong nguồn và insert dòng mới / bị sửa → chi phí theo số dòng đổi; trang Dự toán luôn
+    thấy bảng cũ hoặc mới đầy đủ, không bao giờ rỗng. Nguồn rỗng → bỏ qua (không xoá sạch bảng).
+    farm_id: điền cột farm_id nếu file không có. plan=True: chỉ đếm, rollback.
+    Trả {"source", "inserted", "deleted", "kept"}.
+    """
+    if not rows:
+        print(f"  ⚠️ Nguồn {TONG_TABLE} rỗng — giữ nguyên bảng")
+        return {"source": 0, "inserted": 0, "deleted": 0, "kept": None}
+    with conn.cursor() as cur:
+        types = tong_columns(cur)
+        unknown = [c for c in header if c not in types]
+        if unknown or len(set(header)) != len(header):
+            raise ValueError(f"Header file {TONG_TABLE} sai (cột lạ / trùng): {unknown or header}")
+        if "farm_id" in types and "farm_id" not in header and farm_id is not None:
+            header = header + ["farm_id"]
+            rows = [row + [farm_id] for row in rows]
+        cols = list(types)
+        if not plan:
+            # Lock trước khi diff: 2 lần sync cùng lúc (cron + --tong-file tay) chờ nhau thay vì cùng
+            # diff trên bảng cũ rồi insert trùng. SHARE ROW EXCLUSIVE vẫn cho trang Dự toán đọc.
+            cur.execute(f"LOCK TABLE {TONG_TABLE} IN SHARE ROW EXCLUSIVE MODE")
+
+        cur.execute("DROP TABLE IF EXISTS tong_stage")
+        cur.execute(f"CREATE TEMP TABLE tong_stage ON COMMIT DROP AS "
+                    f"SELECT {', '.join(cols)} FROM {TONG_TABLE} WITH NO DATA")
+        cur.execute("ALTER TABLE tong_stage ADD COLUMN seq BIGSERIAL")
+        copy_rows(cur, "tong_stage", header, (row[:len(header)] + [None] * (len(header) - len(row))
+                                              for row in rows))
+        cur.execute(f"""
+            CREATE TEMP TABLE tong_diff ON COMMIT DROP AS
+            WITH new AS (
+                SELECT seq, {tong_row_hash_sql('s', types)} AS row_hash FROM tong_stage s
+            ), old AS (
+                SELECT t.{TONG_ID} AS id, {tong_row_hash_sql('t', types)} AS row_hash FROM {TONG_TABLE} t
+            ), new_k AS (
+                SELECT seq, row_hash, ROW_NUMBER() OVER (PARTITION BY row_hash ORDER BY seq) AS n FROM new
+            ), old_k AS (
+                SELECT id, row_hash, ROW_NUMBER() OVER (PARTITION BY row_hash ORDER BY id) AS n FROM old
+            )
+            SELECT o.id, n.seq FROM old_k o FULL JOIN new_k n USING (row_hash, n)
+            WHERE o.id IS NULL OR n.seq IS NULL
+        """)
+        cur.execute("SELECT COUNT(*) FILTER (WHERE seq IS NULL), COUNT(*) FILTER (WHERE id IS NULL) FROM tong_diff")
+        deleted, inserted = cur.fetchone()
+        if plan:
+            conn.rollback()
+        else:
+            cur.execute(f"DELETE FROM {TONG_TABLE} t USING tong_diff d WHERE d.seq IS NULL AND t.{TONG_ID} = d.id")
+            cur.execute(f"""
+                INSERT INTO {TONG_TABLE} ({', '.join(cols)})
+                SELECT {', '.join('s.' + c for c in cols)} FROM tong_stage s JOIN tong_diff d USING (seq)
+                ORDER BY s.seq
+            """)
+            conn.commit()
+    kept = len(rows) - inserted
+    print(f"  {'📋' if plan else '✅'} {TONG_TABLE}: {inserted} mới, {deleted} xoá, {kept} giữ nguyên"
+          f"{' (plan)' if plan else ''}")
+    return {"source": len(rows), "inserted": inserted, "deleted": deleted, "kept": kept}
 
 
 # ──────────────────────────────────────────────────────────────
 # PROCESSOR
 # ──────────────────────────────────────────────────────────────
 class ETLProcessor:
-    def __init__(self, conn, dim_maps):
+    """Transform sheet → buffer, rồi load theo từng farm (start_farm → process_* → finish_farm).
+    Trong 1 farm, buffer được flush xuống staging mỗi khi đủ batch_rows dòng (kể cả giữa 1 sheet lớn);
+    commit ở finish_farm.
+    Trước khi gửi, dòng có natural key đã có trong DB bị lọc local (xem _delta).
+    plan=True: chỉ tính số dòng sẽ insert theo farm / tháng / sheet, không ghi gì xuống DB.
+    transform_workers > 1: transform_sheet chạy song song trong process pool; kết quả được gộp theo
+    đúng thứ tự submit ngay khi sheet đầu hàng đợi xong (buffer, stats, missing giống hệt chạy tuần tự).
+    checkpoint: Checkpoint — kết quả transform từng sheet được spool ra đĩa cho --resume.
+    """
+
+    def __init__(self, conn, dim_maps, batch_rows=LOAD_BATCH_ROWS, dedup_in_batch=False, report=None,
+                 plan=False, transform_workers=1, checkpoint=None):
         self.conn = conn
         self.maps = dim_maps
+        self.report = report or RunReport()
+        self.batch_rows = batch_rows
+        self.dedup_in_batch = dedup_in_batch
+        self.plan = plan
+        self.transform_workers = transform_workers
+        self.checkpoint = checkpoint
+        self._pool = None     # ProcessPoolExecutor, tạo ở lần submit đầu tiên
+        self._pending = deque()  # (future | None, hàm gộp kết quả sheet — xem _apply), theo thứ tự submit
+        self._farm = None  # farm đang load (xem start_farm)
+        self._seen = {"nk": set(), "vt": set()}  # natural key đã gửi trong farm (--dedup-batch)
+        # Hash natural key đã có trong DB (+ đã gửi) của farm đang load, và các tháng đã tải
+        self._known = {"nk": set(), "vt": set()}
+        self._known_months = {"nk": set(), "vt": set()}
         self.nk_buffer = []
         self.vt_buffer = []
         self.missing = {"lo": set(), "doi": set(), "cv": set(), "vt": set()}
+        self.resolver = DimResolver(dim_maps, self.missing)
         self.stats = {
             "nk_total": 0, "nk_skipped": 0,
             "vt_total": 0, "vt_skipped": 0,
         }
+        # Số dòng bị bỏ theo từng rule (mỗi dòng tính cho rule đầu tiên nó vi phạm)
+        self.skip_rules = {"nk": Counter(), "vt": Counter()}
+        # Nguồn của từng đoạn buffer: sources[src] = tag sheet, segments = [(end_index, src)]
+        self.sources = []
+        self.segments = {"nk": [], "vt": []}
+        # Kết quả load (đọc bởi print_summary / monitoring): cộng dồn qua mọi batch, xem _record_load
+        self.run_stats = {"load": {}, "dedup_batch": {"nk": 0, "vt": 0}, "dedup_db": {"nk": 0, "vt": 0},
+                          "rollup": {"nk": 0, "vt": 0}}
+
+    def _append(self, kind, source_name, rows, timer=None):
+        """Thêm các dòng (iterable) của 1 sheet vào buffer như 1 đoạn nguồn source_name.
+        Đang load farm: flush mỗi khi buffer đủ batch_rows dòng, nên sheet lớn không nằm trọn trong buffer.
+        timer: StageTimer của process_*_sheet — thời gian flush không bị tính vào stage "filter".
+        """
+        buffer = self.nk_buffer if kind == "nk" else self.vt_buffer
+        self.sources.append(source_name)
+        src = len(self.sources) - 1
+        batch_rows = self.batch_rows if self._farm is not None else 0
+        rows = iter(rows)
+        while True:
+            buffer.extend(islice(rows, max(1, batch_rows - len(buffer))) if batch_rows else rows)
+            self.segments[kind].append((len(buffer), src))
+            if not batch_rows or len(buffer) < batch_rows:
+                return
+            if timer is not None:
+                timer.lap("filter")
+            self._flush(kind)
+            if timer is not None:
+                timer.skip()
+
+    def db_rows(self, kind, keep=None):
+        """Buffer → rows cho bulk_insert (cột DB + src), tuỳ chọn lọc theo keep(ngay)."""
+        buffer = self.nk_buffer if kind == "nk" else self.vt_buffer
+        ngay_idx = 1 if kind == "nk" else 4
+        start = 0
+        for end, src in self.segments[kind]:
+            for r in buffer[start:end]:
+                if keep is None or keep(r[ngay_idx]):
+                    yield (nk_db_row(r) if kind == "nk" else r) + (src,)
+            start = end
+
+    # ── Transform tuần tự hoặc song song (process pool) ──
+    def transform_sheet(self, kind, data, farm_id, source_name, override_doi=None, start_row=0, done=None,
+                        checkpoint_id=None):
+        """Transform 1 sheet NK / VT; done(max_ngay) được gọi khi kết quả đã vào buffer.
+        Có pool: submit rồi trả về ngay — kết quả được gộp ở drain() (finish_farm tự gọi).
+        checkpoint_id: ghi kết quả vào self.checkpoint trước khi gộp (xem Checkpoint.sheet_id).
+        """
+        if self.transform_workers <= 1:
+            if checkpoint_id is not None:
+                result = transform_sheet_result(self, kind, data, farm_id, source_name, override_doi, start_row)
+                self._apply(kind, source_name, result, done, checkpoint_id)
+                return
+            fn = self.process_cong_sheet if kind == "nk" else self.process_vattu_sheet
+            max_ngay = fn(data, farm_id, source_name, override_doi=override_doi, start_row=start_row)
+            if done:
+                done(max_ngay)
+            return
+        if self._pool is None:
+            # dim maps gửi sang mỗi worker đúng 1 lần (initializer), không kèm theo từng sheet
+            self._pool = ProcessPoolExecutor(max_workers=self.transform_workers,
+                                             initializer=_init_transform_worker, initargs=(self.maps,))
+        future = self._pool.submit(_transform_sheet_task, kind, data, farm_id, source_name,
+                                   override_doi, start_row)
+        if checkpoint_id is not None:
+            # Spool ngay khi worker xong (không chờ drain ở finish_farm)
+            def save(f):
+                if not f.cancelled() and f.exception() is None:  # huỷ bởi close() → không spool
+                    self.checkpoint.save(checkpoint_id, f.result())
+            future.add_done_callback(save)
+        self._pending.append((future, lambda: self._apply(kind, source_name, future.result(), done)))
+        self._drain_ready()
+
+    def restore_sheet(self, kind, source_name, result, done=None):
+        """Gộp kết quả transform lấy từ checkpoint (--resume), sau các sheet còn chờ trong pool."""
+        self._pending.append((None, lambda: self._apply(kind, source_name, result, done)))
+        self._drain_ready()
+
+    def _drain_ready(self):
+        """Gộp các sheet đầu hàng đợi đã transform xong (dừng ở sheet đầu tiên còn chạy) — buffer
+        được flush dần trong lúc submit thay vì dồn hết kết quả của farm tới finish_farm."""
+        while self._pending and (self._pending[0][0] is None or self._pending[0][0].done()):
+            self._pending.popleft()[1]()
+
+    def drain(self):
+        """Gộp kết quả mọi sheet còn trong hàng đợi (chờ pool), theo đúng thứ tự submit."""
+        while self._pending:
+            self._pending.popleft()[1]()
+
+    def _apply(self, kind, source_name, result, done=None, checkpoint_id=None):
+        if checkpoint_id is not None:
+            self.checkpoint.save(checkpoint_id, result)
+        max_ngay = self._merge_transform(kind, source_name, result)
+        if done:
+            done(max_ngay)
+
+    def _merge_transform(self, kind, source_name, result):
+        """Áp kết quả 1 worker như thể process_*_sheet vừa chạy tại đây; trả max_ngay."""
+        print(result["log"], end="")
+        for k, v in result["stats"].items():
+            self.stats[k] += v
+        self.skip_rules[kind].update(result["skip_rules"])
+        for k, vals in result["missing"].items():
+            self.missing[k].update(vals)
+        if result["vt_outliers"]:
+            if not hasattr(self, '_vt_outlier_logged'):
+                self._vt_outlier_logged = set()
+            self._vt_outlier_logged.update(result["vt_outliers"])
+        for stage, seconds in result["stages"].items():
+            self.report.add_time(stage, seconds)
+        if result["marked"]:
+            self._append(kind, source_name, result["rows"])
+        return result["max_ngay"]
+
+    def close(self):
+        """Dừng process pool; sheet còn chờ trong hàng đợi (run lỗi giữa chừng) bị huỷ."""
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
 
     # ── Xử lý Sheet Nhật Ký (NK) — Master hoặc Team ──
-    def process_cong_sheet(self, data, farm_id, source_name, override_doi=None):
+    def process_cong_sheet(self, data, farm_id, source_name, override_doi=None, start_row=0):
         """Xử lý sheet Công/NK (cả Master lẫn Team).
         Hỗ trợ cả 2 kiểu mapping: mã CV (code) lẫn hạng mục (tên).
         override_doi: Nếu set, dùng tên này thay cho cột 'Đội Thực Hiện' trong GSheet.
+        start_row: Chỉ đọc từ dòng này của data (watermark --since-last-run).
+        Trả về ngày lớn nhất đọc được (YYYY-MM-DD) hoặc None.
         """
+        timer = self.report.timer()
         header_idx = detect_header_row(data)
         header = data[header_idx]
         col_map = map_columns(header)
@@ -536,7 +1227,7 @@ class ETLProcessor:
         has_num_col = "so_cong" in mapped_names or "thanh_tien" in mapped_names
         if not has_cv_col or not has_num_col:
             print(f"  ⚠️ {source_name}: Thiếu cột cần thiết (mapped: {mapped_names})")
-            return
+            return None
 
         # Pre-resolve override_doi nếu có
         override_doi_id = None
@@ -545,95 +1236,83 @@ class ETLProcessor:
             if override_doi_id:
                 print(f"  🔄 Override đội: tất cả rows → '{override_doi}'")
 
-        rows = data[header_idx + 1:]
-        print(f"  📥 {source_name}: {len(rows)} dòng (header row {header_idx})")
-
-        for row in rows:
-            self.stats["nk_total"] += 1
-
-            # Đọc giá trị theo col_map
-            vals = {}
-            for idx, target in col_map.items():
-                if idx < len(row):
-                    vals[target] = row[idx]
+        rows = data[max(header_idx + 1, start_row):]
+        print(f"  📥 {source_name}: {len(rows)} dòng (header row {header_idx}"
+              f"{f', từ dòng {start_row}' if start_row else ''})")
+        self.stats["nk_total"] += len(rows)
+        if not rows:
+            return None
 
-            # Ngày
-            ngay = parse_date(vals.get("ngay"))
-            if not ngay:
-                self.stats["nk_skipped"] += 1
-                continue
+        # Ngày — dòng không có ngày hợp lệ bị bỏ trước cả khi resolve FK (không ghi missing)
+        df = sheet_frame(rows, col_map)
+        ngay_all = parse_date_series(_col(df, "ngay"))
+        has_date = pd.notna(ngay_all)
+        df, ngay = df[has_date], ngay_all[has_date]
+        max_ngay = max(ngay) if len(ngay) else None
+        self.skip_rules["nk"]["no_date"] += len(rows) - len(df)
+        timer.lap("parse")
+
+        # FK mapping — Lô (ưu tiên lo_raw > lo_code, CI fallback)
+        lo_raw, lo_code_val = _col(df, "lo_raw"), _col(df, "lo_code")
+        lo_id = _map_unique(lambda raw, code: self.resolver.lo(farm_id, raw, code), lo_raw, lo_code_val)
+
+        # FK mapping — Đội (override nếu đọc từ team sheet)
+        if override_doi_id:
+            doi_id = np.full(len(df), override_doi_id, dtype=object)
+        else:
+            doi_id = _map_unique(lambda v: _map_value(v, self.maps["doi"], self.missing["doi"]),
+                                 _col(df, "doi_name"))
 
-            # FK mapping — Lô (ưu tiên lo_raw > lo_code, CI fallback)
-            lo_raw = normalize_text(vals.get("lo_raw", ""))
-            lo_code_val = normalize_text(vals.get("lo_code", ""))
-            lo_id = _resolve_lo(lo_raw, lo_code_val, farm_id, self.maps, self.missing["lo"])
+        # FK mapping — Công việc (mã CV hoặc tên hạng mục)
+        cv_id = _map_unique(self.resolver.cv, _col(df, "ma_cv"), _col(df, "hang_muc"))
+        timer.lap("resolve")
 
-            # FK mapping — Đội (override nếu đọc từ team sheet)
-            if override_doi_id:
-                doi_id = override_doi_id
-            else:
-                doi_name = normalize_text(vals.get("doi_name", ""))
-                doi_id = _map_value(doi_name, self.maps["doi"], self.missing["doi"])
-
-            # FK mapping — Công việc (mã CV hoặc tên hạng mục)
-            ma_cv = normalize_text(vals.get("ma_cv", ""))
-            hang_muc = normalize_text(vals.get("hang_muc", ""))
-            loai_cong_val = normalize_text(vals.get("loai_cong", ""))
-            cv_id = _resolve_cv(ma_cv, hang_muc, loai_cong_val,
-                                self.maps, self.conn, self.missing["cv"])
-
-            # Số liệu
-            so_cong = parse_number(vals.get("so_cong"))
-            klcv = parse_number(vals.get("klcv"))
-            thanh_tien = parse_number(vals.get("thanh_tien"))
-            don_gia = parse_number(vals.get("don_gia", 0))
-            dinh_muc = parse_number(vals.get("dinh_muc", 0))
+        # Số liệu
+        so_cong = parse_number_series(_col(df, "so_cong"))
+        klcv = parse_number_series(_col(df, "klcv"))
+        thanh_tien = parse_number_series(_col(df, "thanh_tien"))
+        don_gia = parse_number_series(_col(df, "don_gia"))
+        dinh_muc = parse_number_series(_col(df, "dinh_muc"))
 
+        with np.errstate(divide="ignore", invalid="ignore"):
             # Tự tính thanh_tien nếu = 0 nhưng có don_gia và so_cong
-            if thanh_tien == 0 and don_gia > 0 and so_cong > 0:
-                thanh_tien = so_cong * don_gia
-
-            # Tính ti_le_display
-            ti_le_display = None
-            if so_cong > 0 and dinh_muc > 0:
-                ns_thuc = klcv / so_cong
-                ti_le_display = (ns_thuc / dinh_muc) * 100
-
-            # Bỏ qua dòng rỗng
-            if so_cong == 0 and klcv == 0 and thanh_tien == 0:
-                self.stats["nk_skipped"] += 1
-                continue
-
-            # RULE: NK phải có hạng mục (cv_id), nếu không → skip
-            if not cv_id:
-                self.stats["nk_skipped"] += 1
-                continue
-
-            # RULE: Bỏ lô lỗi nhập (12, 12.00)
-            lo_check = lo_raw or lo_code_val
-            if lo_check in ("12", "12.00"):
-                self.stats["nk_skipped"] += 1
-                continue
-
-            # RULE: Bỏ NK outlier — thanh_tien > 20 triệu VND/record
-            # (Nguyên nhân: nhập sai số công hoặc đơn giá bất thường)
-            NK_OUTLIER_THRESHOLD = 20_000_000
-            if thanh_tien > NK_OUTLIER_THRESHOLD:
-                self.stats["nk_skipped"] += 1
-                continue
-
-            # is_khoan
-            loai_cong = normalize_text(vals.get("loai_cong", "")).lower()
-            is_khoan = "kho" in loai_cong  # "Khoán" → True
-
-            self.nk_buffer.append((
-                farm_id, ngay, doi_id, lo_id, cv_id,
-                so_cong, klcv, dinh_muc, ti_le_display, thanh_tien, is_khoan, False
-            ))
+            thanh_tien = np.where((thanh_tien == 0) & (don_gia > 0) & (so_cong > 0),
+                                  so_cong * don_gia, thanh_tien)
+            # Tính ti_le_display (chỉ dùng ở dòng có so_cong > 0 và dinh_muc > 0)
+            has_ti_le = (so_cong > 0) & (dinh_muc > 0)
+            ti_le = (klcv / so_cong / dinh_muc) * 100
+        timer.lap("parse")
+
+        # RULES (mask): dòng rỗng, thiếu hạng mục (cv_id), lô lỗi nhập (12, 12.00),
+        # NK outlier — thanh_tien > 20 triệu VND/record (nhập sai số công hoặc đơn giá bất thường)
+        NK_OUTLIER_THRESHOLD = 20_000_000
+        lo_check = lo_raw.where(lo_raw != "", lo_code_val)
+        empty = (so_cong == 0) & (klcv == 0) & (thanh_tien == 0)
+        no_cv = ~empty & pd.isna(cv_id)
+        lo_12 = ~empty & ~no_cv & lo_check.isin(("12", "12.00")).to_numpy()
+        outlier = ~empty & ~no_cv & ~lo_12 & (thanh_tien > NK_OUTLIER_THRESHOLD)
+        keep = ~(empty | no_cv | lo_12 | outlier)
+        n = int(keep.sum())
+        self.stats["nk_skipped"] += len(rows) - n
+        self.skip_rules["nk"].update(empty=int(empty.sum()), no_cv=int(no_cv.sum()),
+                                     lo_12=int(lo_12.sum()), outlier=int(outlier.sum()))
+
+        # is_khoan
+        is_khoan = _col(df, "loai_cong").str.lower().str.contains("kho", regex=False).to_numpy()
+
+        ti_le_display = [v if ok else None for v, ok in zip(ti_le[keep].tolist(), has_ti_le[keep].tolist())]
+        self._append("nk", source_name, zip(
+            [farm_id] * n, ngay[keep].tolist(), doi_id[keep].tolist(), lo_id[keep].tolist(),
+            cv_id[keep].tolist(), so_cong[keep].tolist(), klcv[keep].tolist(), dinh_muc[keep].tolist(),
+            ti_le_display, thanh_tien[keep].tolist(), is_khoan[keep].tolist(), [False] * n,
+        ), timer=timer)
+        timer.lap("filter")
+        return max_ngay
 
     # ── Xử lý Sheet Vật Tư (VT) — Master hoặc Team ──
-    def process_vattu_sheet(self, data, farm_id, source_name, override_doi=None):
-        """Xử lý sheet Vật Tư (cả Master lẫn Team)."""
+    def process_vattu_sheet(self, data, farm_id, source_name, override_doi=None, start_row=0):
+        """Xử lý sheet Vật Tư (cả Master lẫn Team). start_row/giá trị trả về như process_cong_sheet."""
+        timer = self.report.timer()
         header_idx = detect_header_row(data)
         header = data[header_idx]
         col_map = map_columns(header)
@@ -641,246 +1320,322 @@ class ETLProcessor:
         mapped_names = set(col_map.values())
         if "thanh_tien" not in mapped_names and "so_luong" not in mapped_names:
             print(f"  ⚠️ {source_name}: Thiếu cột VT cần thiết (mapped: {mapped_names})")
-            return
-
-        rows = data[header_idx + 1:]
-        print(f"  📥 {source_name}: {len(rows)} dòng (header row {header_idx})")
-
-        for row in rows:
-            self.stats["vt_total"] += 1
-
-            vals = {}
-            for idx, target in col_map.items():
-                if idx < len(row):
-                    vals[target] = row[idx]
-
-            ngay = parse_date(vals.get("ngay"))
-            if not ngay:
-                self.stats["vt_skipped"] += 1
-                continue
-
-            # Lô mapping (ưu tiên lo_raw > lo_code, CI fallback)
-            lo_raw = normalize_text(vals.get("lo_raw", ""))
-            lo_code_val = normalize_text(vals.get("lo_code", ""))
-            lo_id = _resolve_lo(lo_raw, lo_code_val, farm_id, self.maps, self.missing["lo"])
-
-            # Công việc (VT giữ lại dù thiếu hạng mục — khác NK)
-            ma_cv = normalize_text(vals.get("ma_cv", ""))
-            hang_muc = normalize_text(vals.get("hang_muc", ""))
-            cv_id = _resolve_cv(ma_cv, hang_muc, "",
-                                self.maps, self.conn, self.missing["cv"])
-
-            # Vật tư: thử mã VT trước, rồi tên VT (case-insensitive)
-            vt_code = normalize_text(vals.get("ma_vt", ""))
-            vt_name = normalize_text(vals.get("ten_vt", ""))
-            vt_id = None
-            if vt_code:
-                vt_id = _map_value(vt_code, self.maps["vt"], self.missing["vt"])
-            if not vt_id and vt_name:
-                vt_key = vt_name.lower()
-                vt_id = self.maps["vt_by_name"].get(vt_key)
-                if not vt_id:
-                    self.missing["vt"].add(vt_name)
-
-            so_luong = parse_number(vals.get("so_luong"))
-            don_gia = parse_number(vals.get("don_gia"))
-            thanh_tien = parse_number(vals.get("thanh_tien"))
-
-            # Tự tính thanh_tien nếu = 0
-            if thanh_tien == 0 and so_luong > 0 and don_gia > 0:
-                thanh_tien = so_luong * don_gia
-
-            if thanh_tien == 0 and so_luong == 0:
-                self.stats["vt_skipped"] += 1
-                continue
-
-            # RULE: Bỏ lô lỗi nhập (12, 12.00)
-            lo_check = lo_raw or lo_code_val
-            if lo_check in ("12", "12.00"):
-                self.stats["vt_skipped"] += 1
-                continue
+            return None
 
-            # RULE: Bỏ VT outlier — thanh_tien > 100 triệu VND/record
-            # (Nguyên nhân: nhập sai đơn giá hoặc lẫn đơn mua hàng lô lớn)
-            VT_OUTLIER_THRESHOLD = 100_000_000
-            if thanh_tien > VT_OUTLIER_THRESHOLD:
-                self.stats["vt_skipped"] += 1
-                vt_label = vt_name or vt_code or "?"
-                if not hasattr(self, '_vt_outlier_logged'):
-                    self._vt_outlier_logged = set()
-                key = f"{vt_label}|{ngay}"
-                if key not in self._vt_outlier_logged:
-                    self._vt_outlier_logged.add(key)
-                continue
+        rows = data[max(header_idx + 1, start_row):]
+        print(f"  📥 {source_name}: {len(rows)} dòng (header row {header_idx}"
+              f"{f', từ dòng {start_row}' if start_row else ''})")
+        self.stats["vt_total"] += len(rows)
+        if not rows:
+            return None
 
-            self.vt_buffer.append((
-                farm_id, lo_id, cv_id, vt_id,
-                ngay, so_luong, don_gia, thanh_tien
-            ))
+        df = sheet_frame(rows, col_map)
+        ngay_all = parse_date_series(_col(df, "ngay"))
+        has_date = pd.notna(ngay_all)
+        df, ngay = df[has_date], ngay_all[has_date]
+        max_ngay = max(ngay) if len(ngay) else None
+        self.skip_rules["vt"]["no_date"] += len(rows) - len(df)
+        timer.lap("parse")
+
+        # Lô mapping (ưu tiên lo_raw > lo_code, CI fallback)
+        lo_raw, lo_code_val = _col(df, "lo_raw"), _col(df, "lo_code")
+        lo_id = _map_unique(lambda raw, code: self.resolver.lo(farm_id, raw, code), lo_raw, lo_code_val)
+
+        # Công việc (VT giữ lại dù thiếu hạng mục — khác NK)
+        cv_id = _map_unique(self.resolver.cv, _col(df, "ma_cv"), _col(df, "hang_muc"))
+
+        # Vật tư: thử mã VT trước, rồi tên VT (case-insensitive)
+        vt_code, vt_name = _col(df, "ma_vt"), _col(df, "ten_vt")
+        vt_id = _map_unique(self.resolver.vt, vt_code, vt_name)
+        timer.lap("resolve")
+
+        so_luong = parse_number_series(_col(df, "so_luong"))
+        don_gia = parse_number_series(_col(df, "don_gia"))
+        thanh_tien = parse_number_series(_col(df, "thanh_tien"))
+
+        # Tự tính thanh_tien nếu = 0
+        with np.errstate(invalid="ignore"):
+            thanh_tien = np.where((thanh_tien == 0) & (so_luong > 0) & (don_gia > 0),
+                                  so_luong * don_gia, thanh_tien)
+        timer.lap("parse")
+
+        # RULES (mask): dòng rỗng, lô lỗi nhập (12, 12.00),
+        # VT outlier — thanh_tien > 100 triệu VND/record (nhập sai đơn giá hoặc lẫn đơn mua hàng lô lớn)
+        VT_OUTLIER_THRESHOLD = 100_000_000
+        lo_check = lo_raw.where(lo_raw != "", lo_code_val)
+        empty = (thanh_tien == 0) & (so_luong == 0)
+        lo_12 = lo_check.isin(("12", "12.00")).to_numpy()
+        outlier = ~empty & ~lo_12 & (thanh_tien > VT_OUTLIER_THRESHOLD)
+        keep = ~empty & ~lo_12 & ~outlier
+        n = int(keep.sum())
+        self.stats["vt_skipped"] += len(rows) - n
+        self.skip_rules["vt"].update(empty=int(empty.sum()), lo_12=int((lo_12 & ~empty).sum()),
+                                     outlier=int(outlier.sum()))
+
+        if outlier.any():
+            if not hasattr(self, '_vt_outlier_logged'):
+                self._vt_outlier_logged = set()
+            vt_label = vt_name.where(vt_name != "", vt_code).replace("", "?")
+            self._vt_outlier_logged.update(
+                f"{label}|{d}" for label, d in zip(vt_label[outlier].tolist(), ngay[outlier].tolist()))
+
+        self._append("vt", source_name, zip(
+            [farm_id] * n, lo_id[keep].tolist(), cv_id[keep].tolist(), vt_id[keep].tolist(),
+            ngay[keep].tolist(), so_luong[keep].tolist(), don_gia[keep].tolist(), thanh_tien[keep].tolist(),
+        ), timer=timer)
+        timer.lap("filter")
+        return max_ngay
 
     # ── INSERT Methods ──
-    def insert_incremental(self):
-        """INSERT ... ON CONFLICT DO NOTHING — chỉ thêm mới."""
-        insert_nk = """
-            INSERT INTO fact_nhat_ky_san_xuat (
-                farm_id, ngay, doi_id, lo_id, cong_viec_id,
-                so_cong, klcv, dinh_muc, ti_le_display, thanh_tien, is_ho_tro
-            ) VALUES %s
-            ON CONFLICT ON CONSTRAINT uq_nk_natural_key DO NOTHING
+    def _record_load(self, kind, sent, breakdown, known=0):
+        """Cộng kết quả 1 batch vào run_stats["load"][kind]; trả số dòng mới của batch.
+        sent: số dòng đưa vào load; known: phần trong đó bị lọc local vì đã có trong DB (không upload).
         """
-
-        insert_vt = """
-            INSERT INTO fact_vat_tu (
-                farm_id, lo_id, cong_viec_id, vat_tu_id,
-                ngay, so_luong, don_gia, thanh_tien
-            ) VALUES %s
-            ON CONFLICT ON CONSTRAINT uq_vt_natural_key DO NOTHING
+        farm_codes = {v: k for k, v in self.maps["farm"].items()}
+        entry = self.run_stats["load"].setdefault(
+            kind, {"sent": 0, "known": 0, "inserted": 0, "duplicates": 0,
+                   "by_farm": {}, "by_source": {}, "by_month": {}})
+        inserted = 0
+        for farm_id, thang, src, n in breakdown:
+            if self._farm is not None and n:
+                self._farm["months"][kind].add(thang)
+            farm = farm_codes.get(farm_id, str(farm_id))
+            source = self.sources[src] if src is not None else "?"
+            inserted += n
+            entry["by_farm"][farm] = entry["by_farm"].get(farm, 0) + n
+            entry["by_source"][source] = entry["by_source"].get(source, 0) + n
+            entry["by_month"][thang] = entry["by_month"].get(thang, 0) + n
+        entry["sent"] += sent
+        entry["known"] += known
+        entry["inserted"] += inserted
+        entry["duplicates"] = entry["sent"] - entry["inserted"]
+        return inserted
+
+    def start_farm(self, farm_id, full_reload=False):
+        """Bắt đầu 1 transaction load cho farm. full_reload: thay 1 THÁNG GẦN NHẤT của farm bằng data
+        vừa đọc (gom vào staging, swap ở finish_farm) — KHÔNG động vào data cũ.
         """
-
-        new_nk = new_vt = 0
+        from dateutil.relativedelta import relativedelta
+        self._farm = {
+            "farm_id": farm_id, "full_reload": full_reload, "swap": set(),
+            "cutoff": date.today() - relativedelta(months=1),
+            "rows": {"nk": 0, "vt": 0}, "sent": {"nk": 0, "vt": 0}, "new": {"nk": 0, "vt": 0},
+            "known": {"nk": 0, "vt": 0},
+            "months": {"nk": set(), "vt": set()},  # tháng có dòng mới → refresh rollup
+            "since": {"nk": None, "vt": None},      # full reload có xoá → refresh mọi tháng từ cutoff
+        }
+        self._seen = {"nk": set(), "vt": set()}
+        self._known = {"nk": set(), "vt": set()}
+        self._known_months = {"nk": set(), "vt": set()}
+
+    def _is_recent(self, ngay_val):
+        if isinstance(ngay_val, str):
+            try:
+                ngay_val = date.fromisoformat(ngay_val)
+            except ValueError:
+                return False
+        return ngay_val >= self._farm["cutoff"]
+
+    def _flush(self, kind):
+        """COPY buffer hiện tại → staging → fact (chưa commit), rồi giải phóng buffer.
+        Full reload: chỉ COPY vào staging swap_* — bảng fact được thay 1 lần ở finish_farm."""
+        buffer = self.nk_buffer if kind == "nk" else self.vt_buffer
+        if not buffer:
+            return
+        if self.dedup_in_batch:
+            with self.report.stage("dedup"):
+                self.dedup_batch(kinds=(kind,))
+        farm = self._farm
+        full_reload = farm is not None and farm["full_reload"]
         try:
-            with self.conn.cursor() as cur:
-                if self.nk_buffer:
-                    vals = [(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], r[8], r[9], False)
-                            for r in self.nk_buffer]
-                    before = self._count_rows(cur, "fact_nhat_ky_san_xuat")
-                    psycopg2.extras.execute_values(cur, insert_nk, vals, page_size=500)
-                    after = self._count_rows(cur, "fact_nhat_ky_san_xuat")
-                    new_nk = after - before
-
-                if self.vt_buffer:
-                    before = self._count_rows(cur, "fact_vat_tu")
-                    psycopg2.extras.execute_values(cur, insert_vt, self.vt_buffer, page_size=500)
-                    after = self._count_rows(cur, "fact_vat_tu")
-                    new_vt = after - before
-
-                self.conn.commit()
-
-            print(f"\n✅ Nhật Ký: {new_nk} mới / {len(self.nk_buffer)} tổng ({len(self.nk_buffer) - new_nk} trùng)")
-            print(f"✅ Vật Tư: {new_vt} mới / {len(self.vt_buffer)} tổng ({len(self.vt_buffer) - new_vt} trùng)")
-
+            keep = self._is_recent if full_reload else None
+            rows = list(self.db_rows(kind, keep))
+            upload = rows
+            if farm is not None and rows:
+                with self.report.stage("delta"):
+                    # Full reload: cửa sổ sẽ được thay → chỉ lọc trùng trong farm, không tải key từ DB
+                    upload = self._delta(kind, rows, from_db=not full_reload)
+            with self.report.stage("load"), self.conn.cursor() as cur:
+                breakdown = []
+                if full_reload:
+                    stage_swap_rows(cur, kind, upload, create=kind not in farm["swap"])
+                    farm["swap"].add(kind)
+                elif self.plan:
+                    breakdown = self._plan_breakdown(kind, upload)
+                elif upload:
+                    _, breakdown = bulk_insert(cur, kind, upload)
         except Exception as e:
             self.conn.rollback()
             print(f"❌ Lỗi INSERT: {e}")
             raise
-
-    def full_reload(self, farm_ids):
-        """Xoá dữ liệu 1 THÁNG GẦN NHẤT của các farm, rồi insert lại + dedup.
-        Data cũ hơn 1 tháng được giữ nguyên (đã cleanup thủ công).
-        Chỉ insert records trong 1 tháng gần nhất — KHÔNG động vào data cũ.
+        sent, known = len(rows), len(rows) - len(upload)
+        new = self._record_load(kind, sent, breakdown, known)
+        if farm is not None:
+            farm["rows"][kind] += len(buffer)
+            farm["sent"][kind] += sent
+            farm["known"][kind] += known
+            farm["new"][kind] += new
+        buffer.clear()
+        self.segments[kind] = []
+
+    def _delta(self, kind, rows, from_db=True):
+        """Bỏ các dòng có natural key đã có trong DB (hoặc đã gửi trước đó trong farm) — ON CONFLICT
+        sẽ bỏ chúng đằng nào cũng vậy, nhưng khỏi upload. Hash key trong DB tải 1 lần mỗi tháng / farm
+        (8 byte / dòng). Dòng có key NULL luôn gửi (NULL không bao giờ trùng theo ON CONFLICT).
         """
-        from datetime import date
-        from dateutil.relativedelta import relativedelta
-        cutoff_date = date.today() - relativedelta(months=1)
-
-        try:
+        spec = FACT_TABLES[kind]
+        ngay_idx = spec["columns"].index("ngay")
+        known, fetched = self._known[kind], self._known_months[kind]
+        months = {str(r[ngay_idx])[:7] for r in rows} - fetched if from_db else set()
+        if months:
+            sql = key_hash_sql(kind)
             with self.conn.cursor() as cur:
-                ph = ",".join(["%s"] * len(farm_ids))
-                # Chỉ xóa 1 tháng gần nhất
-                cutoff_sql = "CURRENT_DATE - INTERVAL '1 month'"
-                cur.execute(f"DELETE FROM fact_nhat_ky_san_xuat WHERE farm_id IN ({ph}) AND ngay >= {cutoff_sql}", farm_ids)
-                del_nk = cur.rowcount
-                cur.execute(f"DELETE FROM fact_vat_tu WHERE farm_id IN ({ph}) AND ngay >= {cutoff_sql}", farm_ids)
-                del_vt = cur.rowcount
-                print(f"🗑️ Đã xoá (1 tháng gần nhất): {del_nk} NK + {del_vt} VT")
-
-                # Filter buffer: chỉ giữ records trong 1 tháng gần nhất
-                # nk_buffer: (farm_id, ngay, ...) → index 1 = ngay
-                # vt_buffer: (farm_id, lo_id, cv_id, vt_id, ngay, ...) → index 4 = ngay
-                def _is_recent(ngay_val):
-                    if isinstance(ngay_val, str):
-                        try:
-                            ngay_val = date.fromisoformat(ngay_val)
-                        except ValueError:
-                            return False
-                    return ngay_val >= cutoff_date
-
-                nk_recent = [r for r in self.nk_buffer if _is_recent(r[1])]
-                vt_recent = [r for r in self.vt_buffer if _is_recent(r[4])]
-                nk_skipped = len(self.nk_buffer) - len(nk_recent)
-                vt_skipped = len(self.vt_buffer) - len(vt_recent)
-                if nk_skipped or vt_skipped:
-                    print(f"🔒 Bỏ qua data cũ: {nk_skipped} NK + {vt_skipped} VT (trước {cutoff_date})")
-
-                insert_nk = """
-                    INSERT INTO fact_nhat_ky_san_xuat (
-                        farm_id, ngay, doi_id, lo_id, cong_viec_id,
-                        so_cong, klcv, dinh_muc, ti_le_display, thanh_tien, is_ho_tro
-                    ) VALUES %s
-                    ON CONFLICT ON CONSTRAINT uq_nk_natural_key DO NOTHING
-                """
-                insert_vt = """
-                    INSERT INTO fact_vat_tu (
-                        farm_id, lo_id, cong_viec_id, vat_tu_id,
-                        ngay, so_luong, don_gia, thanh_tien
-                    ) VALUES %s
-                    ON CONFLICT ON CONSTRAINT uq_vt_natural_key DO NOTHING
-                """
-                if nk_recent:
-                    vals = [(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], r[8], r[9], False)
-                            for r in nk_recent]
-                    psycopg2.extras.execute_values(cur, insert_nk, vals, page_size=500)
-                if vt_recent:
-                    psycopg2.extras.execute_values(cur, insert_vt, vt_recent, page_size=500)
-
+                for start, end in month_ranges(months):
+                    cur.execute(sql, (self._farm["farm_id"], start, end))
+                    known.update(h for (h,) in cur)
+            fetched.update(months)
+
+        key_of = operator.itemgetter(*(spec["columns"].index(c) for c in spec["key"]))
+        upload = []
+        for r in rows:
+            k = key_of(r)
+            if None in k:
+                upload.append(r)
+                continue
+            h = key_hash(k)
+            if h not in known:
+                known.add(h)
+                upload.append(r)
+        return upload
+
+    def _plan_breakdown(self, kind, rows):
+        """--plan: số dòng sẽ insert theo (farm, tháng, src), tính local thay cho bulk_insert.
+        rows đã qua _delta nên mỗi key không NULL chỉ còn 1 lần."""
+        ngay_idx = FACT_TABLES[kind]["columns"].index("ngay")
+        counts = Counter((r[0], str(r[ngay_idx])[:7], r[-1]) for r in rows)
+        return [(farm_id, thang, src, n) for (farm_id, thang, src), n in counts.items()]
+
+    def finish_farm(self):
+        """Flush phần còn lại và commit farm (--plan: rollback). Full reload: swap cửa sổ rồi commit ngay."""
+        farm = self._farm
+        self.drain()
+        for kind in ("nk", "vt"):
+            self._flush(kind)
+        swapped = self._swap() if farm is not None and farm["full_reload"] else {}
+        if farm is not None and not self.plan:
+            self._refresh_rollups(farm)
+        with self.report.stage("commit"):
+            if self.plan:
+                self.conn.rollback()
+            else:
                 self.conn.commit()
-            print(f"✅ Full Reload: {len(nk_recent)} NK + {len(vt_recent)} VT inserted (chỉ 1 tháng)")
+        self._farm = None
+        self._seen = {"nk": set(), "vt": set()}
+        self._known = {"nk": set(), "vt": set()}
+        self._known_months = {"nk": set(), "vt": set()}
+        if farm is None:
+            return
 
-            # Dedup: loại bỏ duplicate dựa trên natural key (NULL-safe)
-            self._dedup()
+        new, sent, rows, known = farm["new"], farm["sent"], farm["rows"], farm["known"]
+        if self.plan:
+            print(f"  📋 Plan: sẽ insert {new['nk']} NK / {sent['nk']} + {new['vt']} VT / {sent['vt']} "
+                  f"(không ghi DB)")
+        elif farm["full_reload"]:
+            old_nk, old_vt = rows["nk"] - sent["nk"], rows["vt"] - sent["vt"]
+            if old_nk or old_vt:
+                print(f"  🔒 Bỏ qua data cũ: {old_nk} NK + {old_vt} VT (trước {farm['cutoff']})")
+            for kind, label in (("nk", "NK"), ("vt", "VT")):
+                sw = swapped.get(kind)
+                if sw:
+                    print(f"  🔁 Swap {label} (từ {farm['cutoff']}): +{new[kind]} mới/sửa, -{sw['deleted']} xoá "
+                          f"({sw['duplicates']} trùng lặp), {sw['kept']} giữ nguyên")
+            print(f"  ✅ Full Reload: {new['nk']} NK + {new['vt']} VT inserted (chỉ 1 tháng)")
+        else:
+            print(f"  ✅ Nhật Ký: {new['nk']} mới / {sent['nk']} tổng ({sent['nk'] - new['nk']} trùng, "
+                  f"{known['nk']} lọc trước khi gửi)")
+            print(f"  ✅ Vật Tư: {new['vt']} mới / {sent['vt']} tổng ({sent['vt'] - new['vt']} trùng, "
+                  f"{known['vt']} lọc trước khi gửi)")
 
+    def _refresh_rollups(self, farm):
+        """Tính lại rollup tháng (refresh_rollup) cho các tháng farm vừa đổi, trước commit của farm."""
+        try:
+            with self.report.stage("rollup"), self.conn.cursor() as cur:
+                for kind in ("nk", "vt"):
+                    n = refresh_rollup(cur, kind, farm["farm_id"], farm["months"][kind], farm["since"][kind])
+                    self.run_stats["rollup"][kind] += n
         except Exception as e:
             self.conn.rollback()
-            print(f"❌ Lỗi full reload: {e}")
+            print(f"❌ Lỗi refresh rollup: {e}")
             raise
 
-    def _dedup(self):
-        """Loại bỏ duplicate rows sau insert (NULL-safe)."""
+    def _swap(self):
+        """Full reload: thay cửa sổ của farm bằng staging swap_* (swap_window), trong transaction
+        của farm — finish_farm commit ngay sau. Như trước (xoá cả NK + VT ở batch đầu): farm có
+        dòng nào thì thay cả 2 bảng (bảng không có dòng → staging rỗng); farm rỗng thì không đụng DB.
+        """
+        farm = self._farm
+        swapped = {}
+        if not farm["swap"]:
+            return swapped
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    DELETE FROM fact_nhat_ky_san_xuat
-                    WHERE nhat_ky_id NOT IN (
-                        SELECT MIN(nhat_ky_id)
-                        FROM fact_nhat_ky_san_xuat
-                        GROUP BY farm_id, ngay, COALESCE(doi_id, -1), COALESCE(lo_id, -1),
-                                 cong_viec_id, so_cong, klcv, thanh_tien
-                    )
-                """)
-                dup_nk = cur.rowcount
-
-                cur.execute("""
-                    DELETE FROM fact_vat_tu
-                    WHERE vat_tu_fact_id NOT IN (
-                        SELECT MIN(vat_tu_fact_id)
-                        FROM fact_vat_tu
-                        GROUP BY farm_id, ngay, COALESCE(lo_id, -1), COALESCE(cong_viec_id, -1),
-                                 COALESCE(vat_tu_id, -1), so_luong, don_gia, thanh_tien
-                    )
-                """)
-                dup_vt = cur.rowcount
-
-                self.conn.commit()
-
-                if dup_nk or dup_vt:
-                    print(f"🧹 Dedup: xoá {dup_nk} NK + {dup_vt} VT trùng lặp")
-                else:
-                    print("✅ Không có duplicate")
-
+            with self.report.stage("swap"), self.conn.cursor() as cur:
+                for kind in ("nk", "vt"):
+                    if kind not in farm["swap"]:
+                        stage_swap_rows(cur, kind, [], create=True)
+                    sw = swap_window(cur, kind, farm["farm_id"], farm["cutoff"], plan=self.plan)
+                    farm["new"][kind] += self._record_load(kind, 0, sw["breakdown"])
+                    self.run_stats["dedup_db"][kind] += sw["duplicates"]
+                    if sw["deleted"]:
+                        farm["since"][kind] = farm["cutoff"]
+                    swapped[kind] = sw
         except Exception as e:
             self.conn.rollback()
-            print(f"⚠️ Lỗi dedup (non-critical): {e}")
+            print(f"❌ Lỗi swap: {e}")
+            raise
+        return swapped
 
-    def _count_rows(self, cur, table):
-        cur.execute(f"SELECT COUNT(*) FROM {table}")
-        return cur.fetchone()[0]
+    def dedup_batch(self, kinds=("nk", "vt")):
+        """Dedup phòng ngừa: bỏ dòng trùng natural key trong buffer (giữ bản đầu tiên, nhớ key
+        đã gửi qua các batch của farm) trước khi gửi xuống DB. Bắt được cả dòng trùng có FK NULL
+        mà ON CONFLICT bỏ lọt.
+        """
+        removed = {}
+        for kind in kinds:
+            buffer = self.nk_buffer if kind == "nk" else self.vt_buffer
+            key_of = operator.itemgetter(*BUFFER_KEYS[kind])
+            seen = self._seen[kind]
+            kept, segments, start = [], [], 0
+            for end, src in self.segments[kind]:
+                for r in buffer[start:end]:
+                    k = key_of(r)
+                    if k not in seen:
+                        seen.add(k)
+                        kept.append(r)
+                segments.append((len(kept), src))
+                start = end
+            removed[kind] = len(buffer) - len(kept)
+            buffer[:] = kept
+            self.segments[kind] = segments
+            self.run_stats["dedup_batch"][kind] += removed[kind]
+        return removed
 
     def print_summary(self):
         print(f"\n{'='*50}")
         print("📊 THỐNG KÊ")
         print(f"{'='*50}")
-        print(f"  NK: {self.stats['nk_total']} tổng, {self.stats['nk_skipped']} bỏ qua, {len(self.nk_buffer)} hợp lệ")
-        print(f"  VT: {self.stats['vt_total']} tổng, {self.stats['vt_skipped']} bỏ qua, {len(self.vt_buffer)} hợp lệ")
+        st = self.stats
+        print(f"  NK: {st['nk_total']} tổng, {st['nk_skipped']} bỏ qua, {st['nk_total'] - st['nk_skipped']} hợp lệ")
+        print(f"  VT: {st['vt_total']} tổng, {st['vt_skipped']} bỏ qua, {st['vt_total'] - st['vt_skipped']} hợp lệ")
+        for kind, label in (("nk", "NK"), ("vt", "VT")):
+            rules = {k: v for k, v in self.skip_rules[kind].items() if v}
+            if rules:
+                print(f"  ⏭️ {label} bỏ qua theo rule: " + ", ".join(f"{k} {v}" for k, v in rules.items()))
+        dup = self.run_stats["dedup_batch"]
+        if dup["nk"] or dup["vt"]:
+            print(f"  🧹 Dedup batch: bỏ {dup['nk']} NK + {dup['vt']} VT trùng trong batch")
+        rollup = self.run_stats["rollup"]
+        if rollup["nk"] or rollup["vt"]:
+            print(f"  📈 Rollup tháng: tính lại {rollup['nk']} nhóm NK + {rollup['vt']} nhóm VT")
 
         for key, vals in self.missing.items():
             if vals:
@@ -888,41 +1643,1123 @@ class ETLProcessor:
                 extra = f" (+{len(vals)-15} more)" if len(vals) > 15 else ""
                 print(f"  ⚠️ Missing {key.upper()}: {display}{extra}")
 
+        for kind, label in (("nk", "NK"), ("vt", "VT")):
+            load = self.run_stats["load"].get(kind)
+            if not load or not load["sent"]:
+                continue
+            if self.plan:
+                print(f"  📋 {label} (plan): {load['inserted']} sẽ insert / {load['sent']} dòng "
+                      f"({load['duplicates']} đã có hoặc trùng)")
+            else:
+                print(f"  💾 {label}: {load['inserted']} mới / {load['sent']} gửi ({load['duplicates']} trùng, "
+                      f"{load['known']} lọc local không upload)")
+            for group in ("by_farm", "by_month", "by_source"):
+                parts = sorted(load[group].items(),
+                               key=(lambda kv: kv[0]) if group == "by_month" else (lambda kv: (-kv[1], kv[0])))
+                if parts:
+                    shown = ", ".join(f"{k}: {v}" for k, v in parts[:10])
+                    extra = f" (+{len(parts)-10} more)" if len(parts) > 10 else ""
+                    print(f"     {group}: {shown}{extra}")
+
 
 # ──────────────────────────────────────────────────────────────
-# GSheet Helper: Mở workbook với retry
+# TRANSFORM SONG SONG: worker của ETLProcessor.transform_sheet (--transform-workers)
 # ──────────────────────────────────────────────────────────────
-def open_gsheet_with_retry(gc, doc_id, retries=3):
-    """Mở GSheet workbook, retry nếu bị rate limit."""
-    for attempt in range(retries):
+TRANSFORM_WORKERS = min(4, os.cpu_count() or 1)
+_worker_processor = None  # processor (không DB) của process worker, dựng 1 lần bởi initializer
+
+
+def _init_transform_worker(dim_maps):
+    # 1 DimResolver (index + memo) cho cả đời worker, dùng lại qua mọi sheet worker nhận
+    global _worker_processor
+    _worker_processor = ETLProcessor(None, dim_maps, batch_rows=0)
+
+
+def _transform_sheet_task(kind, data, farm_id, source_name, override_doi, start_row):
+    return transform_sheet_result(_worker_processor, kind, data, farm_id, source_name, override_doi, start_row)
+
+
+def transform_sheet_result(p, kind, data, farm_id, source_name, override_doi, start_row):
+    """Chạy process_*_sheet trên processor p — của worker, hoặc chính processor của run khi cần checkpoint.
+    Tách phần sheet này thêm vào (buffer, stats / skip_rules / missing, thời gian stage, log) thành kết quả
+    để ETLProcessor._merge_transform gộp, rồi trả p về như trước sheet (chỉ giữ memo của resolver).
+    Không flush giữa sheet: kết quả chứa đủ mọi dòng của sheet (để spool).
+    """
+    buffer = p.nk_buffer if kind == "nk" else p.vt_buffer
+    n_rows, n_segments, n_sources = len(buffer), len(p.segments[kind]), len(p.sources)
+    stats, skip_rules, stages = dict(p.stats), Counter(p.skip_rules[kind]), dict(p.report.stages)
+    missing = {k: set(vals) for k, vals in p.missing.items()}
+    outliers = set(getattr(p, "_vt_outlier_logged", ()))
+    farm, p._farm = p._farm, None
+    log = io.StringIO()
+    try:
+        with redirect_stdout(log):
+            fn = p.process_cong_sheet if kind == "nk" else p.process_vattu_sheet
+            max_ngay = fn(data, farm_id, source_name, override_doi=override_doi, start_row=start_row)
+    finally:
+        p._farm = farm
+    result = {
+        "rows": buffer[n_rows:],
+        "marked": len(p.segments[kind]) > n_segments,
+        "max_ngay": max_ngay,
+        "stats": {k: v - stats[k] for k, v in p.stats.items()},
+        "skip_rules": Counter({k: v - skip_rules[k] for k, v in p.skip_rules[kind].items()}),
+        "missing": {k: vals - missing[k] for k, vals in p.missing.items()},
+        "vt_outliers": getattr(p, "_vt_outlier_logged", set()) - outliers,
+        "stages": {k: v - stages.get(k, 0.0) for k, v in p.report.stages.items() if v != stages.get(k)},
+        "log": log.getvalue(),
+    }
+    del buffer[n_rows:], p.segments[kind][n_segments:], p.sources[n_sources:]
+    p.stats.update(stats)
+    p.skip_rules[kind] = skip_rules
+    for k, vals in result["missing"].items():
+        p.missing[k].difference_update(vals)  # cùng set với DimResolver → sửa tại chỗ
+    if result["vt_outliers"]:
+        p._vt_outlier_logged.difference_update(result["vt_outliers"])
+    for k in result["stages"]:
+        if k in stages:
+            p.report.stages[k] = stages[k]
+        else:
+            del p.report.stages[k]
+    return result
+
+
+# ──────────────────────────────────────────────────────────────
+# FETCH: Token bucket + retry + scheduler song song (theo quota Sheets)
+# ──────────────────────────────────────────────────────────────
+SHEETS_READ_QUOTA_PER_MIN = 60  # Sheets API: 60 read requests / phút / user
+FETCH_MAX_WORKERS = 6           # Số workbook mở song song
+FETCH_WINDOW_ROWS = 5_000       # Sheet lớn hơn → đọc theo cửa sổ N dòng, mỗi batchGet ≤ N dòng (0 = cả sheet)
+HEADER_BAND_ROWS = 5            # Dòng đầu luôn đọc khi chỉ đọc đuôi sheet (detect_header_row quét 5 dòng)
+
+
+class TokenBucket:
+    """Token bucket thread-safe: nạp `rate` token/giây, tối đa `capacity` token.
+    Dùng chung 1 bucket cho mọi worker để tổng số request không vượt quota.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, quota, burst=None):
+        """Bucket theo quota/phút. Burst mặc định = 1/6 quota để không dồn 429 đầu phút."""
+        burst = burst or max(1, quota // 6)
+        return cls(rate=quota / 60.0, capacity=burst)
+
+    def acquire(self, n=1):
+        """Chờ tới khi đủ n token rồi trừ. Trả về số giây đã chờ."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return waited
+                wait = (n - self._tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
+
+
+def _is_retryable(e):
+    """429 (rate limit) và 5xx là lỗi tạm thời → retry; còn lại raise luôn."""
+    code = getattr(e, "code", None)
+    if code == 429 or (isinstance(code, int) and code >= 500):
+        return True
+    return "429" in str(e)
+
+
+def call_with_backoff(fn, *args, limiter=None, retries=5, base=1.0, cap=64.0, label="", stats=None, **kwargs):
+    """Gọi fn qua limiter, retry lỗi tạm thời với exponential backoff + full jitter.
+    stats (dict, tuỳ chọn): cộng dồn api_calls / retries / wait_s (chờ limiter + backoff).
+    """
+    stats = stats if stats is not None else {}
+    for attempt in range(retries + 1):
+        if limiter:
+            stats["wait_s"] = stats.get("wait_s", 0.0) + limiter.acquire()
+        stats["api_calls"] = stats.get("api_calls", 0) + 1
         try:
-            wb = gc.open_by_key(doc_id)
-            return wb
+            return fn(*args, **kwargs)
         except gspread.exceptions.APIError as e:
-            if "429" in str(e):
-                wait = 15 * (attempt + 1)
-                print(f"  ⏳ Rate limit, chờ {wait}s...")
-                time.sleep(wait)
-            else:
-                print(f"  ❌ API Error: {e}")
-                return None
-        except Exception as e:
-            print(f"  ❌ Lỗi mở GSheet: {e}")
-            return None
+            if not _is_retryable(e) or attempt == retries:
+                raise
+            wait = random.uniform(0, min(cap, base * 2 ** attempt))
+            print(f"  ⏳ {label or 'Sheets API'}: {getattr(e, 'code', '?')}, thử lại sau {wait:.1f}s "
+                  f"({attempt + 1}/{retries})")
+            stats["retries"] = stats.get("retries", 0) + 1
+            stats["wait_s"] = stats.get("wait_s", 0.0) + wait
+            time.sleep(wait)
+
+
+def fetch_sheet_titles(gc, doc_id, limiter=None, stats=None):
+    """1 API call: lấy title workbook + title và số dòng lưới (rowCount) các sheet (không lấy cell data).
+    Trả (title, [sheet title], {sheet title: rowCount}).
+    """
+    meta = call_with_backoff(gc.http_client.fetch_sheet_metadata, doc_id,
+                             params={"fields": "properties.title,sheets.properties(title,gridProperties.rowCount)"},
+                             limiter=limiter, label=doc_id, stats=stats)
+    props = [sh["properties"] for sh in meta.get("sheets", [])]
+    grid_rows = {p["title"]: p.get("gridProperties", {}).get("rowCount") for p in props}
+    return meta.get("properties", {}).get("title", doc_id), [p["title"] for p in props], grid_rows
+
+
+def _sheet_windows(name, n_rows, start, window_rows):
+    """Các đoạn cần đọc của 1 sheet: [(name, dòng đầu (0-based), số dòng | None = cả sheet)]."""
+    if start <= HEADER_BAND_ROWS:
+        start = 0
+    if not window_rows or not n_rows or (n_rows <= window_rows and not start):
+        return [(name, 0, None)]
+    band = [(name, 0, HEADER_BAND_ROWS)] if start else []
+    return band + [(name, r, min(window_rows, n_rows - r)) for r in range(start, n_rows, window_rows)]
+
+
+def batch_get_sheets(gc, doc_id, sheet_names, limiter=None, stats=None, grid_rows=None, tail_from=None,
+                     window_rows=FETCH_WINDOW_ROWS):
+    """values.batchGet mọi sheet cần đọc → {sheet_name: rows}, pad đều độ dài như ws.get_all_values().
+    Sheet nhỏ: cả sheet, chung 1 call. Sheet có grid_rows > window_rows: đọc theo cửa sổ window_rows
+    dòng ("'sheet'!5001:10000"), mỗi call tối đa window_rows dòng → response không phình theo sheet.
+    tail_from {sheet: dòng}: chỉ đọc HEADER_BAND_ROWS dòng đầu + từ dòng đó tới hết; các dòng ở giữa
+    là [] (không pad) — chỉ số dòng giữ nguyên cho watermark.
+    stats["bytes"]: kích thước JSON response (ước tính, trước gzip).
+    """
+    if not sheet_names:
+        return {}
+    grid_rows, tail_from = grid_rows or {}, tail_from or {}
+    pieces = [w for name in sheet_names
+              for w in _sheet_windows(name, grid_rows.get(name), tail_from.get(name, 0), window_rows)]
+    calls, size = [[]], 0
+    for piece in pieces:
+        n = piece[2] if piece[2] is not None else grid_rows.get(piece[0]) or 0
+        if calls[-1] and window_rows and size + n > window_rows:
+            calls.append([])
+            size = 0
+        calls[-1].append(piece)
+        size += n
+
+    parts = {name: [] for name in sheet_names}
+    for call in calls:
+        ranges = [gspread.utils.absolute_range_name(name) + (f"!{r + 1}:{r + n}" if n else "")
+                  for name, r, n in call]
+        resp = call_with_backoff(gc.http_client.values_batch_get, doc_id, ranges,
+                                 params={"majorDimension": "ROWS"}, limiter=limiter, label=doc_id, stats=stats)
+        if stats is not None:
+            stats["bytes"] = stats.get("bytes", 0) + len(
+                json.dumps(resp, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        for (name, r, _), vr in zip(call, resp.get("valueRanges", [])):
+            rows = parts[name]
+            values = vr.get("values", [])
+            if values and len(rows) < r:
+                rows.extend([[]] * (r - len(rows)))  # dòng trống cuối cửa sổ trước / đoạn bỏ qua
+            rows.extend(values)
+
+    data = {}
+    for name, rows in parts.items():
+        start = tail_from.get(name, 0)
+        if not rows:
+            data[name] = []
+        elif start > HEADER_BAND_ROWS:
+            # Đọc đuôi: chỉ pad dòng đã đọc, các dòng bỏ qua giữ [] dùng chung
+            width = max(len(r) for r in rows)
+            data[name] = [gspread.utils.rightpad(r, width) if (i < HEADER_BAND_ROWS or i >= start) else r
+                          for i, r in enumerate(rows)]
+        else:
+            data[name] = gspread.utils.fill_gaps(rows)
+    return data
+
+
+def plan_fetch_jobs(sources):
+    """Liệt kê các workbook cần đọc theo đúng thứ tự xử lý: Master trước, Teams sau."""
+    jobs = []
+    for farm_label, source in sources.items():
+        if source["type"] in ("master", "both"):
+            jobs.append({"farm_label": farm_label, "kind": "master",
+                         "name": farm_label, "doc_id": source["master"], "source": source})
+        if source["type"] in ("teams", "both"):
+            for team in source.get("teams", []):
+                jobs.append({"farm_label": farm_label, "kind": "team",
+                             "name": team["name"], "doc_id": team["id"], "source": team})
+    return jobs
+
+
+def _find_title(titles, *patterns):
+    """Tìm sheet đầu tiên có title chứa đủ các từ khóa của 1 trong các pattern."""
+    for title in titles:
+        t = title.lower()
+        if any(all(kw in t for kw in pattern) for pattern in patterns):
+            return title
     return None
 
 
-def read_sheet_data(wb, sheet_name):
-    """Đọc dữ liệu sheet, trả về list[list] hoặc None."""
+def plan_sheets(job, titles):
+    """Xác định sheet thực tế cần đọc trong workbook (kể cả fallback tự tìm).
+    Trả list[{"name", "type", "requested"}] — name=None nếu không tìm thấy.
+    """
+    if job["kind"] == "team":
+        return [{"name": s["name"] if s["name"] in titles else None,
+                 "type": s["type"], "requested": s["name"]}
+                for s in job["source"]["sheets"]]
+
+    source = job["source"]
+    plan = []
+    cong = source.get("fact_cong_sheet")
+    if cong:
+        name = cong if cong in titles else _find_title(titles, ("công", "fact"))
+        plan.append({"name": name, "type": "nk", "requested": cong})
+    vt = source.get("fact_vt_sheet")
+    if vt:
+        name = vt if vt in titles else _find_title(titles, ("vật tư", "fact"))
+        plan.append({"name": name, "type": "vt", "requested": vt})
+    else:
+        name = _find_title(titles, ("vật tư", "fact"), ("nhập vật tư",))
+        plan.append({"name": name, "type": "vt", "requested": None})
+    return plan
+
+
+def fetch_workbook(gc, job, limiter=None, tail_from=None, window_rows=FETCH_WINDOW_ROWS):
+    """Đọc 1 workbook: metadata (tìm sheet) + batchGet (toàn bộ data) — 2 API call, thêm call khi có
+    sheet lớn hơn window_rows (xem batch_get_sheets).
+    tail_from(doc_id, sheet) → (dòng bắt đầu, số dòng tối thiểu) | None: chỉ đọc đuôi sheet
+    (SheetState.tail_start); sheet ngắn hơn số dòng tối thiểu (bị xoá bớt) → đọc lại cả sheet.
+    Không raise — lỗi ghi vào result["ok"] = False. result["metrics"]: thời gian, API call, bytes.
+    """
+    result = dict(job, title=None, sheets=[], data={}, ok=False)
+    metrics = {"seconds": 0.0, "api_calls": 0, "retries": 0, "wait_s": 0.0, "bytes": 0, "sheet_rows": {}}
+    t0 = time.perf_counter()
     try:
-        ws = wb.worksheet(sheet_name)
-        data = ws.get_all_values()
-        return data if data else None
-    except gspread.exceptions.WorksheetNotFound:
-        return None
+        result["title"], titles, grid_rows = fetch_sheet_titles(gc, job["doc_id"], limiter, stats=metrics)
+        plan = plan_sheets(job, titles)
+        names = list(dict.fromkeys(e["name"] for e in plan if e["name"]))
+        tails = {name: t for name in names if tail_from and (t := tail_from(job["doc_id"], name))}
+        data = batch_get_sheets(gc, job["doc_id"], names, limiter, stats=metrics, grid_rows=grid_rows,
+                                tail_from={name: t[0] for name, t in tails.items()}, window_rows=window_rows)
+        shrunk = [name for name, (_, min_rows) in tails.items() if len(data[name]) < min_rows]
+        if shrunk:
+            data.update(batch_get_sheets(gc, job["doc_id"], shrunk, limiter, stats=metrics,
+                                         grid_rows=grid_rows, window_rows=window_rows))
+        start = {name: t[0] for name, t in tails.items() if name not in shrunk and t[0] > HEADER_BAND_ROWS}
+        result["data"] = data
+        result["sheets"] = [dict(e, rows=data.get(e["name"]) or None, tail_from=start.get(e["name"], 0))
+                            for e in plan]
+        metrics["sheet_rows"] = {name: len(rows) for name, rows in result["data"].items()}
+        result["ok"] = True
     except Exception as e:
-        print(f"  ❌ Lỗi đọc sheet '{sheet_name}': {e}")
+        print(f"  ❌ Lỗi đọc workbook {job['name']} ({job['doc_id']}): {e}")
+        metrics["error"] = str(e)
+    metrics["seconds"] = time.perf_counter() - t0
+    result["metrics"] = metrics
+    return result
+
+
+def iter_fetch(gc, jobs, limiter=None, max_workers=FETCH_MAX_WORKERS, prefetch=None, tail_from=None,
+               window_rows=FETCH_WINDOW_ROWS):
+    """Đọc song song các workbook qua thread pool giới hạn, chung 1 limiter.
+    Yield kết quả theo đúng thứ tự jobs ngay khi sẵn sàng; chỉ giữ tối đa max_workers + prefetch
+    workbook đang đọc/chờ xử lý → transform + load farm trước chồng lên fetch farm sau,
+    bộ nhớ không tăng theo số workbook. tail_from / window_rows: xem fetch_workbook.
+    """
+    window = max_workers + (max_workers if prefetch is None else prefetch)
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        submit = lambda job: ex.submit(fetch_workbook, gc, job, limiter, tail_from, window_rows)
+        pending = deque(submit(job) for job in islice(jobs, window))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for job in islice(jobs, 1):
+                    pending.append(submit(job))
+                yield result
+        finally:
+            # close() giữa chừng: bỏ các workbook chưa bắt đầu đọc, chỉ chờ các workbook đang đọc
+            for future in pending:
+                future.cancel()
+
+
+def fetch_all(gc, jobs, limiter=None, max_workers=FETCH_MAX_WORKERS):
+    """Đọc toàn bộ workbook (iter_fetch) vào 1 list theo đúng thứ tự jobs."""
+    t0 = time.monotonic()
+    results = list(iter_fetch(gc, jobs, limiter, max_workers))
+    n_sheets = sum(1 for r in results for s in r["sheets"] if s["rows"])
+    print(f"  ✅ Fetch xong {len(results)} workbook / {n_sheets} sheet trong {time.monotonic() - t0:.1f}s")
+    return results
+
+
+# ──────────────────────────────────────────────────────────────
+# SNAPSHOT: Ghi raw rows đã fetch ra đĩa (--snapshot-dir) và chạy lại offline (--replay)
+# ──────────────────────────────────────────────────────────────
+SNAPSHOT_MANIFEST = "manifest.json"
+SNAPSHOT_FORMAT = 1
+
+
+def _snapshot_file(wb):
+    return re.sub(r"[^\w.-]+", "_", f"{wb['farm_label']}__{wb['kind']}__{wb['doc_id']}") + ".json.gz"
+
+
+def record_snapshot(fetched, snapshot_dir):
+    """Bọc iter_fetch: ghi mỗi workbook (title + plan sheet + raw rows) ra 1 file gzip JSON,
+    cập nhật manifest sau mỗi workbook (run lỗi giữa chừng vẫn replay được phần đã ghi).
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    print(f"  💾 Ghi snapshot → {snapshot_dir}")
+    manifest = {"format": SNAPSHOT_FORMAT, "created_at": datetime.now().isoformat(timespec="seconds"),
+                "workbooks": []}
+    try:
+        for wb in fetched:
+            name = _snapshot_file(wb)
+            payload = {k: wb[k] for k in ("farm_label", "kind", "name", "doc_id", "title", "ok")}
+            payload["sheets"] = [{k: e.get(k, 0) for k in ("name", "type", "requested", "rows", "tail_from")}
+                                 for e in wb["sheets"]]
+            with gzip.open(os.path.join(snapshot_dir, name), "wt", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+            manifest["workbooks"].append({
+                **{k: wb[k] for k in ("farm_label", "kind", "name", "doc_id", "ok")}, "file": name,
+                "sheet_rows": {e["name"]: len(e["rows"]) for e in wb["sheets"] if e["rows"]},
+            })
+            tmp = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, os.path.join(snapshot_dir, SNAPSHOT_MANIFEST))
+            yield wb
+    finally:
+        fetched.close()  # dừng iter_fetch bên trong khi bị close() giữa chừng
+
+
+def iter_snapshot(snapshot_dir, jobs):
+    """Thay iter_fetch khi --replay: đọc workbook từ snapshot theo đúng thứ tự jobs, không gọi Google.
+    Workbook không có trong snapshot → ok=False (như lỗi fetch).
+    """
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    files = {(e["farm_label"], e["doc_id"]): e["file"] for e in manifest["workbooks"]}
+    print(f"  ⏮️ Replay snapshot {manifest['created_at']} ({len(files)} workbook) từ {snapshot_dir}")
+    for job in jobs:
+        result = dict(job, title=None, sheets=[], data={}, ok=False)
+        t0 = time.perf_counter()
+        name = files.get((job["farm_label"], job["doc_id"]))
+        if name is None:
+            print(f"  ❌ Snapshot không có workbook {job['name']} ({job['doc_id']})")
+        else:
+            path = os.path.join(snapshot_dir, name)
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                payload = json.load(f)
+            result.update(title=payload["title"], ok=payload["ok"], sheets=payload["sheets"],
+                          data={e["name"]: e["rows"] for e in payload["sheets"] if e["rows"]})
+        result["metrics"] = {"seconds": time.perf_counter() - t0, "api_calls": 0,
+                             "bytes": os.path.getsize(path) if name else 0,
+                             "sheet_rows": {k: len(v) for k, v in result["data"].items()}}
+        yield result
+
+
+# ──────────────────────────────────────────────────────────────
+# STATE: Fingerprint từng sheet → bỏ qua sheet không đổi
+# ──────────────────────────────────────────────────────────────
+STATE_PATH = os.path.join(os.path.dirname(__file__), "etl_state.json")
+
+
+def _fingerprint(rows, prefix_len=None):
+    """sha256 toàn bộ rows + (tuỳ chọn) sha256 của prefix_len dòng đầu, trong 1 lượt duyệt."""
+    h = hashlib.sha256()
+    prefix = h.hexdigest() if prefix_len == 0 else None
+    for i, row in enumerate(rows, 1):
+        h.update("\x1f".join(str(c) for c in row).encode("utf-8"))
+        h.update(b"\x1e")
+        if i == prefix_len:
+            prefix = h.hexdigest()
+    return h.hexdigest(), prefix
+
+
+def _tail_fingerprint(rows, start):
+    """sha256 của HEADER_BAND_ROWS dòng đầu + rows[start:], bỏ ô rỗng cuối dòng — không phụ thuộc
+    độ rộng pad (đọc cả sheet hay chỉ đọc đuôi đều ra cùng hash)."""
+    def trim(row):
+        end = len(row)
+        while end and row[end - 1] == "":
+            end -= 1
+        return row[:end]
+    return _fingerprint(map(trim, rows[:HEADER_BAND_ROWS] + rows[max(start, HEADER_BAND_ROWS):]))[0]
+
+
+WATERMARK_LOOKBACK_ROWS = 200  # --since-last-run: đọc lại N dòng trước watermark (sửa muộn)
+
+
+class SheetState:
+    """State local (JSON cạnh etl_sync.py) cho mỗi (workbook, sheet) đã load:
+    hash + số dòng (bỏ qua sheet không đổi) và watermark last_row/max_ngay (--since-last-run).
+    Mỗi sheet lưu kèm hash dim_fingerprint lúc load: dim đổi → dòng cũ có thể resolve khác → sheet
+    được coi là bị sửa (xử lý lại) dù nội dung không đổi.
+    State mới chỉ được ghi (commit) sau khi load DB thành công.
+    """
+
+    def __init__(self, path=STATE_PATH, skip_unchanged=True, since_last_run=False,
+                 lookback_rows=WATERMARK_LOOKBACK_ROWS, dims=None):
+        self.path = path
+        self.skip_unchanged = skip_unchanged
+        self.since_last_run = since_last_run
+        self.lookback_rows = lookback_rows
+        self.dims = None if dims is None else hashlib.sha1(json.dumps(list(dims)).encode("utf-8")).hexdigest()
+        self.sheets = {}
+        self._pending = {}
+        self._digests = {}  # hash nội dung đã đọc ở lần check() gần nhất (xem digest)
+        self.counts = {"unchanged": 0, "appended": 0, "edited": 0, "new": 0}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.sheets = json.load(f).get("sheets", {})
+
+    @staticmethod
+    def key(doc_id, sheet_name):
+        return f"{doc_id}/{sheet_name}"
+
+    def _dims_changed(self, prev):
+        """Sheet đã load với dim khác hiện tại (state cũ chưa lưu dims cũng tính là khác)."""
+        return bool(prev) and self.dims is not None and prev.get("dims") != self.dims
+
+    def check(self, doc_id, sheet_name, rows, tail_from=0):
+        """So rows với fingerprint đã lưu.
+        Trả (status, delta): status ∈ unchanged | appended | edited | new,
+        delta = số dòng thêm (appended) hoặc chênh lệch số dòng. Dim đổi từ lần load trước → edited.
+        tail_from > 0: rows chỉ có band đầu + đuôi từ dòng đó (tail_start) → so với "tail" lần trước
+        (hash band đầu + lookback dòng cuối) thay vì hash cả sheet; không lưu được hash cả sheet.
+        """
+        key = self.key(doc_id, sheet_name)
+        prev = self.sheets.get(key)
+        n = len(rows)
+        tail_start = max(0, n - self.lookback_rows)
+        tail = [tail_start, _tail_fingerprint(rows, tail_start)]
+        if tail_from:
+            digest = None
+            same = bool(prev and prev.get("tail") and prev["rows"] <= n
+                        and _tail_fingerprint(rows[:prev["rows"]], prev["tail"][0]) == prev["tail"][1])
+            self._digests[key] = _tail_fingerprint(rows, tail_from)
+        else:
+            prev_rows = prev["rows"] if prev and prev["rows"] <= n else None
+            digest, prefix = _fingerprint(rows, prev_rows)
+            self._digests[key] = digest
+        self._pending[key] = {"hash": digest, "rows": n, "tail": tail, "dims": self.dims,
+                              "updated": datetime.now().isoformat(timespec="seconds")}
+
+        if not prev:
+            status = "new"
+        elif self._dims_changed(prev):
+            status = "edited"
+        elif tail_from:
+            status = "edited" if not same else "unchanged" if n == prev["rows"] else "appended"
+        elif digest == prev["hash"]:
+            status = "unchanged"
+        elif prev["hash"] and prefix == prev["hash"]:  # hash None: lần trước chỉ đọc đuôi
+            status = "appended"
+        else:
+            status = "edited"
+        delta = n if status == "new" else n - prev["rows"]
+        self.counts[status] += 1
+        if status == "unchanged":
+            self._pending.pop(key)
+            if "tail" not in prev:  # state cũ chưa có tail → bổ sung để lần sau đọc đuôi được
+                self._pending[key] = dict(prev, tail=tail)
+        return status, delta
+
+    def tail_start(self, doc_id, sheet_name):
+        """--since-last-run: chỉ cần đọc sheet từ dòng nào (xem fetch_workbook).
+        Trả (dòng bắt đầu, số dòng tối thiểu sheet phải còn) hoặc None = đọc cả sheet
+        (kể cả khi dim đã đổi từ lần load trước: cả sheet phải transform lại 1 lần).
+        """
+        prev = self.sheets.get(self.key(doc_id, sheet_name))
+        if not self.since_last_run or not prev or not prev.get("tail") or not prev.get("last_row"):
+            return None
+        if self._dims_changed(prev):
+            return None
+        start = min(prev["tail"][0], max(0, prev["last_row"] - self.lookback_rows))
+        if start <= HEADER_BAND_ROWS:
+            return None
+        return start, max(prev["rows"], prev["last_row"])
+
+    def digest(self, doc_id, sheet_name):
+        """Hash nội dung sheet đã đọc ở lần check() gần nhất (đọc đuôi: hash band đầu + phần đuôi)."""
+        return self._digests.get(self.key(doc_id, sheet_name))
+
+    def start_row(self, doc_id, sheet_name, n_rows):
+        """Dòng bắt đầu đọc ở chế độ --since-last-run: watermark − lookback.
+        Sheet mới, bị xoá bớt dòng, dim đã đổi, hoặc không bật chế độ → đọc từ đầu (0).
+        """
+        prev = self.sheets.get(self.key(doc_id, sheet_name))
+        if not self.since_last_run or not prev or prev.get("last_row", 0) > n_rows:
+            return 0
+        if self._dims_changed(prev):
+            return 0
+        return max(0, prev.get("last_row", 0) - self.lookback_rows)
+
+    def mark(self, doc_id, sheet_name, last_row, max_ngay):
+        """Ghi watermark (chờ commit): đã xử lý tới last_row, ngày lớn nhất max_ngay."""
+        key = self.key(doc_id, sheet_name)
+        if key not in self._pending:
+            return
+        prev_ngay = self.sheets.get(key, {}).get("max_ngay")
+        self._pending[key]["last_row"] = last_row
+        self._pending[key]["max_ngay"] = max(filter(None, [max_ngay, prev_ngay]), default=None)
+
+    def commit(self):
+        """Ghi fingerprint của các sheet đã xử lý (atomic: file tạm + os.replace).
+        path=None: state chỉ trong bộ nhớ (--replay không đụng tới state thật).
+        """
+        if not self._pending:
+            return
+        self.sheets.update(self._pending)
+        if not self.path:
+            self._pending = {}
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"sheets": self.sheets}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+        self._pending = {}
+
+    def print_summary(self):
+        c = self.counts
+        print(f"  Sheets: {c['unchanged']} không đổi (bỏ qua), {c['appended']} thêm dòng, "
+              f"{c['edited']} bị sửa, {c['new']} mới")
+
+
+# ──────────────────────────────────────────────────────────────
+# CHECKPOINT: Spool kết quả transform từng sheet + farm đã commit → --resume
+# ──────────────────────────────────────────────────────────────
+SPOOL_DIR = os.path.join(os.path.dirname(__file__), "etl_spool")
+SPOOL_MANIFEST = "manifest.json"
+SPOOL_TOTALS = "totals.pkl"
+SPOOL_FORMAT = 1  # Tăng khi đổi format kết quả transform_sheet_result
+
+
+class Checkpoint:
+    """Spool local (thư mục cạnh etl_sync.py) để chạy tiếp run bị lỗi giữa chừng bằng --resume:
+    - mỗi sheet vừa transform: buffer + stats + skip_rules + missing (gzip pickle, theo sheet_id);
+    - mỗi farm vừa commit: ghi vào manifest + số liệu cộng dồn của processor (cho summary), xoá spool sheet.
+    --resume bỏ qua farm đã commit (không fetch lại) và dùng lại sheet đã transform của farm đang dở.
+    Run thành công xoá cả thư mục (clear); run mới không --resume bỏ checkpoint cũ.
+    run: tham số quyết định kết quả (phải giống nhau mới resume); dims: dim_fingerprint lúc chạy.
+    """
+
+    def __init__(self, spool_dir=SPOOL_DIR, run=None, dims=None, resume=False):
+        self.dir = spool_dir
+        self.run = run or {}
+        self.dims = dims
+        self.farms_done = []
+        self.totals = None
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        manifest = self._read_manifest()
+        if resume and manifest is None:
+            print("  ⚠️ Không có checkpoint để resume → chạy từ đầu")
+        elif resume:
+            if manifest.get("format") != SPOOL_FORMAT or manifest.get("run") != self.run:
+                raise ValueError(f"Checkpoint {manifest.get('started_at')} là của lần chạy với tham số khác "
+                                 f"({manifest.get('run')}) — bỏ --resume để chạy lại từ đầu")
+            self.started_at = manifest["started_at"]
+            self.farms_done = manifest["farms_done"]
+            totals_path = os.path.join(self.dir, SPOOL_TOTALS)
+            if os.path.exists(totals_path):
+                with open(totals_path, "rb") as f:
+                    self.totals = pickle.load(f)
+            if manifest.get("dims") != self.dims:
+                # Dòng đã transform chứa id dim cũ → chỉ giữ các farm đã commit
+                print("  🔄 Dim tables đã đổi từ lần chạy trước → transform lại farm đang dở")
+                self._clear_sheets()
+            print(f"  ♻️ Resume checkpoint {self.started_at}: {len(self.farms_done)} farm đã commit "
+                  f"({', '.join(self.farms_done) or '—'})")
+            return
+        elif manifest is not None:
+            print(f"  🗑️ Bỏ checkpoint của lần chạy lỗi {manifest.get('started_at')} (dùng --resume để chạy tiếp)")
+        self.clear()
+        os.makedirs(self.dir, exist_ok=True)
+        self._write_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.dir, SPOOL_MANIFEST), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        tmp = os.path.join(self.dir, SPOOL_MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": SPOOL_FORMAT, "started_at": self.started_at, "run": self.run,
+                       "dims": self.dims, "farms_done": self.farms_done}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, os.path.join(self.dir, SPOOL_MANIFEST))
+
+    def _clear_sheets(self):
+        for name in os.listdir(self.dir):
+            if name.endswith(".pkl.gz"):
+                os.remove(os.path.join(self.dir, name))
+
+    @staticmethod
+    def sheet_id(doc_id, sheet_name, digest, start_row):
+        """Id spool của 1 lần transform: đổi khi nội dung sheet (digest) hoặc dòng bắt đầu đổi."""
+        return hashlib.sha1(f"{doc_id}/{sheet_name}/{digest}/{start_row}".encode("utf-8")).hexdigest()
+
+    def is_done(self, farm_label):
+        return farm_label in self.farms_done
+
+    def load(self, sheet_id):
+        """Kết quả transform đã spool (như transform_sheet_result), None nếu chưa có."""
+        path = os.path.join(self.dir, f"{sheet_id}.pkl.gz")
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, "rb") as f:
+            result = pickle.load(f)
+        return dict(result, stages={})  # thời gian transform đã tính ở run trước
+
+    def save(self, sheet_id, result):
+        path = os.path.join(self.dir, f"{sheet_id}.pkl.gz")
+        with gzip.open(path + ".tmp", "wb", compresslevel=1) as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def farm_done(self, farm_label, processor, state=None):
+        """Farm đã commit: lưu số liệu cộng dồn của processor (+ SheetState), ghi manifest, bỏ spool sheet."""
+        totals = {"stats": processor.stats, "skip_rules": processor.skip_rules,
+                  "missing": processor.missing, "run_stats": processor.run_stats,
+                  "sheets": state.counts if state is not None else {}}
+        tmp = os.path.join(self.dir, SPOOL_TOTALS + ".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(totals, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, os.path.join(self.dir, SPOOL_TOTALS))
+        self.farms_done.append(farm_label)
+        self._write_manifest()
+        self._clear_sheets()
+
+    def restore_totals(self, processor, state=None):
+        """--resume: nạp lại stats / missing / kết quả load của các farm đã commit vào processor."""
+        if not self.totals:
+            return
+        if state is not None:
+            state.counts.update(self.totals["sheets"])
+        processor.stats.update(self.totals["stats"])
+        for kind, rules in self.totals["skip_rules"].items():
+            processor.skip_rules[kind].update(rules)
+        for key, vals in self.totals["missing"].items():
+            processor.missing[key].update(vals)  # cùng set với DimResolver → update tại chỗ
+        processor.run_stats.update(self.totals["run_stats"])
+
+    def clear(self):
+        if os.path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+
+
+# ──────────────────────────────────────────────────────────────
+# REPORT: Thời gian / khối lượng theo stage → JSON + bảng etl_runs
+# ──────────────────────────────────────────────────────────────
+RUN_REPORT_PATH = os.path.join(os.path.dirname(__file__), "etl_last_run.json")
+
+ETL_RUNS_DDL = """
+    CREATE TABLE IF NOT EXISTS etl_runs (
+        run_id       BIGSERIAL PRIMARY KEY,
+        started_at   TIMESTAMPTZ NOT NULL,
+        finished_at  TIMESTAMPTZ,
+        status       TEXT NOT NULL,
+        duration_s   NUMERIC(10, 2),
+        nk_inserted  INT,
+        vt_inserted  INT,
+        report       JSONB NOT NULL
+    )
+"""
+
+
+def peak_rss_mb():
+    """Peak RSS của process (MB); None nếu không đo được (Windows không có module resource)."""
+    try:
+        import resource
+    except ImportError:
         return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageTimer:
+    """Đo nhiều stage nối tiếp trong 1 hàm: lap(stage) cộng thời gian kể từ lap trước vào stage."""
+
+    def __init__(self, report):
+        self.report = report
+        self._t = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.report.add_time(stage, now - self._t)
+        self._t = now
+
+    def skip(self):
+        """Bỏ khoảng thời gian kể từ lap trước (đã được tính vào stage khác, VD flush giữa sheet)."""
+        self._t = time.perf_counter()
+
+
+class RunReport:
+    """Metrics 1 lần chạy ETL: giây theo stage (auth, dim_load, fetch, parse, resolve, filter, delta,
+    load, swap, rollup, commit, dedup, tong), fetch từng workbook, số dòng bị bỏ theo từng rule, rows/s, peak RSS.
+    attach() processor/state để đọc stats lúc xuất báo cáo.
+    """
+
+    def __init__(self, args=None):
+        self.args = args or {}
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self._t0 = time.perf_counter()
+        self.duration_s = None
+        self.status = "running"
+        self.error = None
+        self.stages = {}     # stage → giây (cộng dồn)
+        self.workbooks = []  # metrics fetch từng workbook (xem fetch_workbook)
+        self.processor = None
+        self.state = None
+        self.tong = None     # số dòng đổi của fact_195_tong (sync_195_tong)
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def timer(self):
+        return StageTimer(self)
+
+    def add_workbook(self, wb):
+        self.workbooks.append({"farm": wb["farm_label"], "kind": wb["kind"], "name": wb["name"],
+                               "doc_id": wb["doc_id"], "ok": wb["ok"], **wb.get("metrics", {})})
+
+    def attach(self, processor=None, state=None):
+        self.processor = processor or self.processor
+        self.state = state or self.state
+
+    def finish(self, status="ok", error=None):
+        self.status = status
+        self.error = f"{type(error).__name__}: {error}" if error is not None else None
+        self.finished_at = datetime.now()
+        self.duration_s = time.perf_counter() - self._t0
+
+    def to_dict(self):
+        duration = self.duration_s if self.duration_s is not None else time.perf_counter() - self._t0
+        wbs = self.workbooks
+        report = {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "finished_at": self.finished_at.isoformat(timespec="seconds") if self.finished_at else None,
+            "status": self.status,
+            "error": self.error,
+            "args": self.args,
+            "duration_s": round(duration, 2),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages_s": {k: round(v, 3) for k, v in self.stages.items()},
+            "fetch": {
+                "workbooks": len(wbs),
+                "failed": sum(1 for w in wbs if not w["ok"]),
+                "api_calls": sum(w.get("api_calls", 0) for w in wbs),
+                "retries": sum(w.get("retries", 0) for w in wbs),
+                "wait_s": round(sum(w.get("wait_s", 0.0) for w in wbs), 2),
+                "bytes": sum(w.get("bytes", 0) for w in wbs),
+                "worker_s": round(sum(w.get("seconds", 0.0) for w in wbs), 2),
+                "by_workbook": wbs,
+            },
+        }
+        p = self.processor
+        if p is not None:
+            rows_read = p.stats["nk_total"] + p.stats["vt_total"]
+            transform_s = sum(self.stages.get(k, 0.0) for k in ("parse", "resolve", "filter"))
+            sent = sum(v["sent"] for v in p.run_stats["load"].values())
+            report["rows"] = dict(p.stats)
+            report["skip_rules"] = {kind: dict(c) for kind, c in p.skip_rules.items()}
+            report["load"] = p.run_stats["load"]
+            report["dedup"] = {"batch": p.run_stats["dedup_batch"], "db": p.run_stats["dedup_db"]}
+            report["rollup"] = p.run_stats["rollup"]
+            report["throughput"] = {
+                "rows_per_s": round(rows_read / duration, 1) if duration else None,
+                "transform_rows_per_s": round(rows_read / transform_s, 1) if transform_s else None,
+                "load_rows_per_s": round(sent / self.stages["load"], 1) if self.stages.get("load") else None,
+            }
+        if self.state is not None:
+            report["sheets"] = dict(self.state.counts)
+        if self.tong is not None:
+            report["tong"] = self.tong
+        return report
+
+    def write(self, path=RUN_REPORT_PATH):
+        """Ghi JSON (atomic: file tạm + os.replace)."""
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=1, default=str)
+        os.replace(tmp, path)
+        print(f"📝 Run report: {path}")
+
+    def save_db(self, conn):
+        """Append 1 dòng vào bảng etl_runs (tự tạo nếu chưa có). Lỗi không làm hỏng run."""
+        report = self.to_dict()
+        load = report.get("load", {})
+        try:
+            with conn.cursor() as cur:
+                cur.execute(ETL_RUNS_DDL)
+                cur.execute("""
+                    INSERT INTO etl_runs (started_at, finished_at, status, duration_s,
+                                          nk_inserted, vt_inserted, report)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """, (self.started_at, self.finished_at, self.status, report["duration_s"],
+                      load.get("nk", {}).get("inserted"), load.get("vt", {}).get("inserted"),
+                      psycopg2.extras.Json(report, dumps=lambda o: json.dumps(o, ensure_ascii=False, default=str))))
+            conn.commit()
+            print("📝 Đã ghi run report vào etl_runs")
+        except Exception as e:
+            conn.rollback()
+            print(f"⚠️ Không ghi được etl_runs (non-critical): {e}")
+
+    def print_summary(self):
+        d = self.to_dict()
+        stages = ", ".join(f"{k} {v:.1f}s" for k, v in sorted(d["stages_s"].items(), key=lambda kv: -kv[1]))
+        print(f"  ⏱️ {d['duration_s']:.1f}s — {stages}")
+        f = d["fetch"]
+        print(f"  📡 Fetch: {f['api_calls']} API call ({f['retries']} retry, chờ {f['wait_s']:.1f}s), "
+              f"{f['bytes'] / 1e6:.1f} MB")
+        tp = d.get("throughput", {})
+        if tp.get("rows_per_s"):
+            parts = [f"{tp['rows_per_s']:.0f} dòng/s toàn run"]
+            if tp["transform_rows_per_s"]:
+                parts.append(f"transform {tp['transform_rows_per_s']:.0f} dòng/s")
+            if tp["load_rows_per_s"]:
+                parts.append(f"load {tp['load_rows_per_s']:.0f} dòng/s")
+            print(f"  🚀 {', '.join(parts)}")
+        if d["peak_rss_mb"] is not None:
+            print(f"  🧠 Peak RSS: {d['peak_rss_mb']:.0f} MB")
+
+
+# ──────────────────────────────────────────────────────────────
+# DAEMON: Giữ client / pool / dim maps ấm, poll thay đổi từng farm, chỉ sync farm đổi (--daemon)
+# ──────────────────────────────────────────────────────────────
+DAEMON_POLL_S = 300  # Mỗi farm kiểm tra thay đổi 5 phút / lần (ETL_SOURCES[farm]["poll_s"] để đặt riêng)
+HEALTH_PORT = 8765   # GET /health (JSON) + /metrics (Prometheus text) trên 127.0.0.1, 0 = tắt
+
+
+class ChangeDetector:
+    """Phát hiện workbook đổi qua Drive modifiedTime: 1 call nhẹ / workbook, không tốn quota Sheets.
+    Token không có quyền Drive → mỗi chu kỳ đều sync; sheet không đổi vẫn bị bỏ qua nhờ fingerprint
+    trong SheetState (chỉ tốn phần fetch).
+    """
+
+    def __init__(self, gc, limiter=None):
+        self.gc = gc
+        self.limiter = limiter
+        self.seen = {}        # doc_id → modifiedTime đã sync thành công
+        self.drive_ok = True
+
+    def check(self, doc_ids):
+        """Trả (đổi?, {doc_id: modifiedTime hiện tại}) — lần đầu luôn là đổi."""
+        if not self.drive_ok:
+            return True, {}
+        current = {}
+        for doc_id in doc_ids:
+            try:
+                meta = call_with_backoff(self.gc.http_client.get_file_drive_metadata, doc_id,
+                                         limiter=self.limiter, label=doc_id)
+            except gspread.exceptions.APIError as e:
+                if getattr(e, "code", None) not in (401, 403):
+                    raise
+                print(f"  ⚠️ Không đọc được Drive modifiedTime ({e}) → poll bằng fingerprint sheet")
+                self.drive_ok = False
+                return True, {}
+            current[doc_id] = meta.get("modifiedTime")
+        return any(self.seen.get(d) != m for d, m in current.items()), current
+
+    def commit(self, current):
+        self.seen.update(current)
+
+    def reset(self):
+        """Quên modifiedTime đã sync → lần kiểm tra sau mọi workbook đều tính là đổi."""
+        self.seen.clear()
+
+
+class DaemonHealth:
+    """Trạng thái daemon (thread-safe) cho endpoint /health và /metrics.
+    Mỗi farm: status/error = kết quả lần sync gần nhất, check_error = lỗi của lần kiểm tra Drive gần nhất
+    (tự xoá khi lần kiểm tra sau thành công). Farm lỗi nếu 1 trong 2 đang lỗi."""
+
+    def __init__(self, farms):
+        self._lock = threading.Lock()
+        self.started_at = datetime.now()
+        self.syncs = {"ok": 0, "error": 0}
+        self.inserted = {"nk": 0, "vt": 0}
+        self.last_run = None
+        self.farms = {label: {"last_check": None, "last_change": None, "last_sync": None,
+                              "status": None, "error": None, "check_error": None} for label in farms}
+
+    def record_check(self, farm_label, changed, error=None):
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            farm = self.farms[farm_label]
+            farm["last_check"] = now
+            if changed:
+                farm["last_change"] = now
+            farm["check_error"] = None if error is None else str(error)
+
+    def record_sync(self, farm_labels, report):
+        d = report.to_dict()
+        with self._lock:
+            self.syncs[d["status"]] = self.syncs.get(d["status"], 0) + 1
+            for kind, load in d.get("load", {}).items():
+                self.inserted[kind] = self.inserted.get(kind, 0) + load["inserted"]
+            self.last_run = {k: d.get(k) for k in ("started_at", "status", "error", "duration_s")}
+            self.last_run["farms"] = list(farm_labels)
+            for label in farm_labels:
+                farm = self.farms[label]
+                farm["status"], farm["error"] = d["status"], d["error"]
+                if d["status"] == "ok":
+                    farm["last_sync"] = d["finished_at"]
+
+    def snapshot(self):
+        with self._lock:
+            ok = all(_farm_ok(f) for f in self.farms.values())
+            return {"status": "ok" if ok else "error",
+                    "started_at": self.started_at.isoformat(timespec="seconds"),
+                    "uptime_s": round((datetime.now() - self.started_at).total_seconds()),
+                    "syncs": dict(self.syncs), "inserted": dict(self.inserted),
+                    "last_run": self.last_run, "farms": json.loads(json.dumps(self.farms))}
+
+    def metrics_text(self):
+        h = self.snapshot()
+        lines = ["etl_daemon_up 1", f"etl_daemon_uptime_seconds {h['uptime_s']}"]
+        lines += [f'etl_daemon_syncs_total{{status="{k}"}} {v}' for k, v in h["syncs"].items()]
+        lines += [f'etl_daemon_rows_inserted_total{{kind="{k}"}} {v}' for k, v in h["inserted"].items()]
+        for label, farm in h["farms"].items():
+            if farm["last_sync"]:
+                ts = datetime.fromisoformat(farm["last_sync"]).timestamp()
+                lines.append(f'etl_daemon_last_sync_timestamp_seconds{{farm="{label}"}} {ts:.0f}')
+            lines.append(f'etl_daemon_farm_ok{{farm="{label}"}} {int(_farm_ok(farm))}')
+        return "\n".join(lines) + "\n"
+
+
+def _farm_ok(farm):
+    return farm["status"] != "error" and not farm["check_error"]
+
+
+def serve_health(health, port):
+    """HTTP server nền (thread daemon) trên 127.0.0.1:port — GET /health (503 nếu farm lỗi), /metrics."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/health":
+                snap = health.snapshot()
+                code, ctype = (200 if snap["status"] == "ok" else 503), "application/json"
+                body = json.dumps(snap, ensure_ascii=False).encode("utf-8")
+            elif self.path == "/metrics":
+                code, ctype, body = 200, "text/plain; version=0.0.4", health.metrics_text().encode("utf-8")
+            else:
+                code, ctype, body = 404, "text/plain", b"not found\n"
+            self.send_response(code)
+            self.send_header("Content-Type", f"{ctype}; charset=utf-8" if "charset" not in ctype else ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # không lẫn access log vào log ETL
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"  🩺 Health: http://127.0.0.1:{server.server_port}/health, /metrics")
+    return server
+
+
+def _usable_conn(pool, conn):
+    """Kết nối còn dùng được (rollback phần dở); hỏng / bị pooler cắt → lấy kết nối mới."""
+    try:
+        if not conn.closed:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return conn
+    except psycopg2.Error:
+        pass
+    pool.putconn(conn, close=True)
+    return pool.getconn()
+
+
+def run_daemon(args):
+    """--daemon: xác thực, mở pool và load dim 1 lần, rồi lặp: farm nào tới hạn poll thì hỏi Drive
+    modifiedTime các workbook của farm; gom các farm có thay đổi vào 1 lần sync_farms.
+    Dim maps chỉ dựng lại khi dim_fingerprint đổi (khi đó mọi farm được sync lại). Lỗi 1 lần sync không dừng daemon (thử lại ở chu kỳ sau).
+    SIGINT / SIGTERM: dừng sau lần sync đang chạy.
+    """
+    sources = _select_sources(args)
+    print("\n📡 Khởi tạo kết nối (giữ suốt daemon)...")
+    gc = get_google_client()
+    pool = get_db_pool()
+    conn = pool.getconn()
+    dim_maps = load_dim_maps(conn, refresh=args.refresh_dims)
+    dims = dim_fingerprint(conn)
+
+    detector = ChangeDetector(gc)
+    health = DaemonHealth(sources)
+    server = serve_health(health, args.health_port) if args.health_port else None
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    next_due = dict.fromkeys(sources, 0.0)
+    intervals = {label: source.get("poll_s", args.poll_interval) for label, source in sources.items()}
+    print(f"  🔁 Poll: " + ", ".join(f"{label} mỗi {sec}s" for label, sec in intervals.items()))
+    try:
+        while not stop.is_set():
+            changed = {}
+            due = [k for k, t in next_due.items() if t <= time.monotonic()]
+            if due:
+                # Dim đổi → sheet không đổi cũng phải xử lý lại (SheetState) → sync lại mọi farm
+                try:
+                    conn = _usable_conn(pool, conn)
+                    fingerprint = dim_fingerprint(conn)
+                    if fingerprint != dims:
+                        print("  🔄 Dim tables đã đổi → dựng lại dim maps, sync lại mọi farm")
+                        dim_maps, dims = load_dim_maps(conn), fingerprint
+                        detector.reset()
+                except Exception as e:
+                    print(f"  ❌ Lỗi kiểm tra dim tables: {e} — thử lại ở chu kỳ sau")
+            for label in due:
+                next_due[label] = time.monotonic() + intervals[label]
+                doc_ids = [job["doc_id"] for job in plan_fetch_jobs({label: sources[label]})]
+                try:
+                    is_changed, current = detector.check(doc_ids)
+                except Exception as e:
+                    print(f"  ❌ {label}: lỗi kiểm tra thay đổi: {e}")
+                    health.record_check(label, False, error=e)
+                    continue
+                health.record_check(label, is_changed)
+                if is_changed:
+                    changed[label] = current
+
+            if changed:
+                print(f"\n{'#'*55}\n🔔 {datetime.now().strftime('%H:%M:%S')} — có thay đổi: {', '.join(changed)}")
+                report = RunReport(vars(args))
+                try:
+                    conn = _usable_conn(pool, conn)
+                    sync_farms(args, report, {k: sources[k] for k in changed}, gc, conn, dim_maps)
+                    report.finish("ok")
+                    for current in changed.values():
+                        detector.commit(current)
+                except Exception as e:
+                    report.finish("error", e)
+                    print(f"❌ Sync lỗi ({', '.join(changed)}): {e} — thử lại ở chu kỳ sau")
+                health.record_sync(changed, report)
+                report.write(args.report)
+                if args.report_db:
+                    conn = _usable_conn(pool, conn)
+                    report.save_db(conn)
+
+            stop.wait(max(0.0, min(next_due.values()) - time.monotonic()))
+    finally:
+        if server is not None:
+            server.shutdown()
+        pool.putconn(conn)
+        pool.closeall()
+        print(f"\n👋 Dừng daemon — {datetime.now().strftime('%H:%M:%S')}")
 
 
 # ──────────────────────────────────────────────────────────────
@@ -932,16 +2769,101 @@ def main():
     parser = argparse.ArgumentParser(description="ETL: GSheets → Supabase (Unified)")
     parser.add_argument("--full-reload", action="store_true", help="Xoá hết + INSERT lại")
     parser.add_argument("--farm", type=str, help="Chỉ chạy cho 1 farm (VD: 126, 157, 195)")
+    parser.add_argument("--workers", type=int, default=FETCH_MAX_WORKERS,
+                        help=f"Số workbook đọc song song (mặc định {FETCH_MAX_WORKERS})")
+    parser.add_argument("--quota", type=int, default=SHEETS_READ_QUOTA_PER_MIN,
+                        help=f"Quota Sheets read requests/phút (mặc định {SHEETS_READ_QUOTA_PER_MIN})")
+    parser.add_argument("--ignore-state", action="store_true",
+                        help="Xử lý lại mọi sheet, kể cả sheet không đổi so với lần chạy trước")
+    parser.add_argument("--since-last-run", action="store_true",
+                        help="Chỉ parse các dòng sau watermark lần chạy trước (+ lookback)")
+    parser.add_argument("--window-rows", type=int, default=FETCH_WINDOW_ROWS,
+                        help=f"Sheet lớn hơn số dòng này được đọc theo cửa sổ, 0 = cả sheet (mặc định {FETCH_WINDOW_ROWS})")
+    parser.add_argument("--lookback-rows", type=int, default=WATERMARK_LOOKBACK_ROWS,
+                        help=f"Số dòng đọc lại trước watermark (mặc định {WATERMARK_LOOKBACK_ROWS})")
+    parser.add_argument("--dedup-batch", action="store_true",
+                        help="Bỏ dòng trùng natural key trong batch trước khi load")
+    parser.add_argument("--refresh-dims", action="store_true",
+                        help="Bỏ qua snapshot dim trên đĩa, đọc lại dim tables từ DB")
+    parser.add_argument("--batch-rows", type=int, default=LOAD_BATCH_ROWS,
+                        help=f"Flush xuống DB mỗi khi buffer đủ số dòng này (mặc định {LOAD_BATCH_ROWS})")
+    parser.add_argument("--report", type=str, default=RUN_REPORT_PATH,
+                        help="File JSON run report (thời gian theo stage, fetch, rule skip, rows/s, RSS)")
+    parser.add_argument("--report-db", action="store_true",
+                        help="Append run report vào bảng etl_runs")
+    parser.add_argument("--snapshot-dir", type=str,
+                        help="Ghi raw rows mọi sheet đã fetch vào thư mục này (gzip JSON + manifest)")
+    parser.add_argument("--replay", action="store_true",
+                        help="Chạy transform + load từ --snapshot-dir, không gọi Google Sheets")
+    parser.add_argument("--transform-workers", type=int, default=TRANSFORM_WORKERS,
+                        help=f"Số process transform sheet song song, 1 = tuần tự (mặc định {TRANSFORM_WORKERS})")
+    parser.add_argument("--plan", action="store_true",
+                        help="Chỉ in số dòng sẽ insert theo farm / tháng, không ghi DB (kể cả etl_state.json)")
+    parser.add_argument("--refresh-rollups", action="store_true",
+                        help="Dựng lại toàn bộ agg_cong_thang / agg_vat_tu_thang (sau khi sửa fact ngoài ETL)")
+    parser.add_argument("--tong-file", type=str, default=None,
+                        help="CSV nội dung mới của fact_195_tong: chỉ cập nhật dòng đổi (không TRUNCATE)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Chạy liên tục: poll thay đổi từng farm (Drive modifiedTime), chỉ sync farm đổi")
+    parser.add_argument("--poll-interval", type=int, default=DAEMON_POLL_S,
+                        help=f"--daemon: giây giữa 2 lần kiểm tra 1 farm (mặc định {DAEMON_POLL_S})")
+    parser.add_argument("--health-port", type=int, default=HEALTH_PORT,
+                        help=f"--daemon: cổng /health + /metrics trên 127.0.0.1, 0 = tắt (mặc định {HEALTH_PORT})")
+    parser.add_argument("--resume", action="store_true",
+                        help="Chạy tiếp run lỗi trước: bỏ farm đã commit, dùng lại sheet đã transform (--spool-dir)")
+    parser.add_argument("--spool-dir", type=str, default=SPOOL_DIR,
+                        help="Thư mục checkpoint cho --resume (xoá khi run thành công)")
     args = parser.parse_args()
+    if args.replay and not args.snapshot_dir:
+        parser.error("--replay cần --snapshot-dir")
+    if args.resume and args.plan:
+        parser.error("--plan không ghi checkpoint, không dùng được với --resume")
+    if args.daemon and (args.replay or args.plan or args.resume or args.tong_file):
+        parser.error("--daemon không dùng chung với --replay / --plan / --resume / --tong-file")
 
     print("=" * 55)
     print(f"🚀 ETL SYNC — {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"   Mode: {'FULL RELOAD' if args.full_reload else 'INCREMENTAL'}")
+    print(f"   Mode: {'FULL RELOAD' if args.full_reload else 'INCREMENTAL'}"
+          f"{' (since last run)' if args.since_last_run and not args.full_reload else ''}"
+          f"{f' — replay {args.snapshot_dir}' if args.replay else ''}"
+          f"{' — PLAN (không ghi DB)' if args.plan else ''}"
+          f"{' — RESUME' if args.resume else ''}"
+          f"{' — DAEMON' if args.daemon else ''}")
     if args.farm:
         print(f"   Farm: {args.farm}")
     print("=" * 55)
 
-    # Filter sources
+    if args.daemon:
+        run_daemon(args)
+        return
+
+    report = RunReport(vars(args))
+    try:
+        run_etl(args, report)
+        report.finish("ok")
+    except BaseException as e:
+        report.finish("error", e)
+        raise
+    finally:
+        report.write(args.report)
+        if args.report_db:
+            _save_report_db(report)
+
+
+def _save_report_db(report):
+    """Ghi report qua 1 kết nối riêng (kết nối của run có thể đã đóng hoặc hỏng)."""
+    try:
+        pool = get_db_pool()
+        conn = pool.getconn()
+        report.save_db(conn)
+        pool.putconn(conn)
+        pool.closeall()
+    except Exception as e:
+        print(f"⚠️ Không ghi được etl_runs (non-critical): {e}")
+
+
+def _select_sources(args):
+    """ETL_SOURCES, hoặc chỉ farm của --farm (không tồn tại → thoát)."""
     sources = ETL_SOURCES
     if args.farm:
         farm_key = f"Farm {args.farm}"
@@ -949,60 +2871,39 @@ def main():
             print(f"❌ Farm '{args.farm}' không tồn tại. Có: {list(sources.keys())}")
             sys.exit(1)
         sources = {farm_key: sources[farm_key]}
+    return sources
+
+
+def run_etl(args, report):
+    """Toàn bộ pipeline 1 lần chạy: auth → dim → fetch/transform/load theo farm → summary."""
+    sources = _select_sources(args)
 
     # Connect
     print("\n📡 Khởi tạo kết nối...")
-    gc = get_google_client()
-    pool = get_db_pool()
-    conn = pool.getconn()
+    with report.stage("auth"):
+        gc = None if args.replay else get_google_client()
+        pool = get_db_pool()
+        conn = pool.getconn()
 
     print("\n📦 Load Dimension Tables...")
-    dim_maps = load_dim_maps(conn)
+    with report.stage("dim_load"):
+        dim_maps = load_dim_maps(conn, refresh=args.refresh_dims)
 
-    processor = ETLProcessor(conn, dim_maps)
-    processed_farm_ids = []
+    sync_farms(args, report, sources, gc, conn, dim_maps)
 
-    for farm_label, source in sources.items():
-        print(f"\n{'='*55}")
-        print(f"🏠 {farm_label}")
-        print(f"{'='*55}")
-
-        farm_code = source["farm_code"]
-        farm_id = dim_maps["farm"].get(farm_code)
-        if not farm_id:
-            print(f"  ❌ Không tìm thấy farm_id cho '{farm_code}' trong dim_farm!")
-            continue
-        processed_farm_ids.append(farm_id)
-
-        # ── Routing: Teams vs Master vs Both ──
-        if source["type"] == "teams":
-            _process_teams(gc, processor, source, farm_id, farm_label)
-        elif source["type"] == "both":
-            # Đọc Master trước (data cũ đầy đủ), rồi Teams (bổ sung data mới)
-            print("  📋 Mode: Master + Teams (combined)")
-            _process_master(gc, processor, source, farm_id, farm_label)
-            time.sleep(3)
-            _process_teams(gc, processor, source, farm_id, farm_label)
-        else:
-            _process_master(gc, processor, source, farm_id, farm_label)
+    if args.refresh_rollups and not args.plan:
+        print("\n📈 Dựng lại toàn bộ rollup tháng...")
+        with report.stage("rollup"), conn.cursor() as cur:
+            for kind in ("nk", "vt"):
+                print(f"  ✅ {ROLLUP_TABLES[kind]['table']}: {refresh_rollup(cur, kind)} nhóm")
+        conn.commit()
 
-        time.sleep(3)  # Delay giữa các farm tránh rate limit
-
-    # Summary
-    processor.print_summary()
-
-    # Insert
-    if not processor.nk_buffer and not processor.vt_buffer:
-        print("\n⚠️ Không có dữ liệu nào để insert!")
-    else:
-        print(f"\n{'='*55}")
-        print("💾 CHUYỂN DỮ LIỆU VÀO SUPABASE")
-        print(f"{'='*55}")
-
-        if args.full_reload:
-            processor.full_reload(processed_farm_ids)
-        else:
-            processor.insert_incremental()
+    if args.tong_file:
+        print(f"\n📊 {TONG_TABLE} ← {args.tong_file}")
+        with report.stage("tong"):
+            header, rows = load_tong_file(args.tong_file)
+            report.tong = sync_195_tong(conn, header, rows, farm_id=dim_maps["farm"].get("Farm 195"),
+                                        plan=args.plan)
 
     # Final verify
     _print_final_verify(conn)
@@ -1012,107 +2913,194 @@ def main():
     print(f"\n✅ HOÀN TẤT — {datetime.now().strftime('%H:%M:%S')}")
 
 
-def _process_teams(gc, processor, source, farm_id, farm_label):
-    """Xử lý Farm 126: đọc trực tiếp từ GSheet các đội."""
-    teams = source.get("teams", [])
-    print(f"  📋 {len(teams)} đội cần xử lý")
+def sync_farms(args, report, sources, gc, conn, dim_maps):
+    """Fetch → transform → load từng farm của sources, rồi in summary. Dùng chung cho 1 lần chạy
+    (run_etl) và mỗi lần sync của --daemon (client / kết nối / dim maps đã có sẵn).
+    """
+    # Checkpoint cho --resume (--plan không ghi gì nên không cần)
+    dims = dim_fingerprint(conn)
+    checkpoint = None
+    if not args.plan:
+        run_key = {k: getattr(args, k) for k in ("full_reload", "farm", "ignore_state", "since_last_run",
+                                                 "lookback_rows", "replay", "snapshot_dir")}
+        try:
+            checkpoint = Checkpoint(args.spool_dir, run=run_key, dims=list(dims),
+                                    resume=args.resume)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
 
-    for team in teams:
-        team_name = team["name"]
-        doc_id = team["id"]
-        print(f"\n  📂 Đội: {team_name}...")
+    processor = ETLProcessor(conn, dim_maps, batch_rows=args.batch_rows, dedup_in_batch=args.dedup_batch,
+                             report=report, plan=args.plan, transform_workers=args.transform_workers,
+                             checkpoint=checkpoint)
 
-        wb = open_gsheet_with_retry(gc, doc_id)
-        if not wb:
-            print(f"  ❌ Không mở được file của {team_name}, bỏ qua.")
-            continue
+    fetched = None
+    try:
+        # Full reload xoá 1 tháng gần nhất → phải xử lý lại mọi dòng của mọi sheet
+        if args.replay:
+            # Replay: xử lý lại toàn bộ snapshot, không đọc/ghi etl_state.json
+            state = SheetState(path=None, skip_unchanged=False)
+        else:
+            state = SheetState(skip_unchanged=not (args.full_reload or args.ignore_state),
+                               since_last_run=args.since_last_run and not args.full_reload,
+                               lookback_rows=args.lookback_rows, dims=dims)
+        report.attach(processor=processor, state=state)
+        if checkpoint is not None:
+            checkpoint.restore_totals(processor, state)
+
+        # Fetch: mở song song toàn bộ workbook (bỏ farm không có trong dim_farm / đã commit trước --resume)
+        fetch_sources = {k: v for k, v in sources.items() if dim_maps["farm"].get(v["farm_code"])
+                         and not (checkpoint and checkpoint.is_done(k))}
+        jobs = plan_fetch_jobs(fetch_sources)
+        if args.replay:
+            fetched = iter_snapshot(args.snapshot_dir, jobs)
+        else:
+            limiter = TokenBucket.per_minute(args.quota)
+            print(f"\n📥 Đọc {len(jobs)} workbook (workers={args.workers}, quota={args.quota}/phút)...")
+            # Stream: farm đang transform/load trong khi các workbook tiếp theo được fetch ở background
+            fetched = iter_fetch(gc, jobs, limiter, max_workers=args.workers, window_rows=args.window_rows,
+                                 tail_from=state.tail_start if state.since_last_run else None)
+            if args.snapshot_dir:
+                fetched = record_snapshot(fetched, args.snapshot_dir)
+        jobs_per_farm = Counter(job["farm_label"] for job in jobs)
+
+        for farm_label, source in sources.items():
+            print(f"\n{'='*55}")
+            print(f"🏠 {farm_label}")
+            print(f"{'='*55}")
+
+            farm_code = source["farm_code"]
+            farm_id = dim_maps["farm"].get(farm_code)
+            if not farm_id:
+                print(f"  ❌ Không tìm thấy farm_id cho '{farm_code}' trong dim_farm!")
+                continue
+            if checkpoint and checkpoint.is_done(farm_label):
+                print("  ⏩ Đã commit ở lần chạy trước (checkpoint), bỏ qua")
+                continue
 
-        try:
-            print(f"  ✅ \"{wb.title}\"")
-        except Exception:
-            pass
+            # "fetch" = thời gian main thread phải chờ workbook (phần fetch không chồng được lên xử lý)
+            with report.stage("fetch"):
+                farm_wbs = list(islice(fetched, jobs_per_farm[farm_label]))
+            for wb in farm_wbs:
+                report.add_workbook(wb)
+            master = next((r for r in farm_wbs if r["kind"] == "master"), None)
+            teams = [r for r in farm_wbs if r["kind"] == "team"]
+            processor.start_farm(farm_id, full_reload=args.full_reload)
+
+            # ── Routing: Teams vs Master vs Both ──
+            if source["type"] == "teams":
+                _process_teams(processor, teams, farm_id, farm_label, state)
+            elif source["type"] == "both":
+                # Đọc Master trước (data cũ đầy đủ), rồi Teams (bổ sung data mới)
+                print("  📋 Mode: Master + Teams (combined)")
+                _process_master(processor, master, farm_id, farm_label, state)
+                _process_teams(processor, teams, farm_id, farm_label, state)
+            else:
+                _process_master(processor, master, farm_id, farm_label, state)
+            del farm_wbs, master, teams
+
+            # Commit farm → lưu fingerprint các sheet của farm (lỗi load đã raise, state giữ nguyên)
+            print(f"\n  💾 {'Plan' if args.plan else 'Commit'} {farm_label}...")
+            processor.finish_farm()
+            if not args.plan:
+                with report.stage("state"):
+                    state.commit()
+            if checkpoint is not None:
+                checkpoint.farm_done(farm_label, processor, state)
+    finally:
+        # Cả khi lỗi giữa chừng (daemon thử lại ở chu kỳ sau): dừng process pool transform
+        # và thread fetch còn chạy, không để rò qua các lần sync
+        processor.close()
+        if fetched is not None:
+            fetched.close()
+    if checkpoint is not None:
+        checkpoint.clear()
+    if not processor.run_stats["load"]:
+        print("\n⚠️ Không có dữ liệu nào để insert!")
 
-        for sheet_info in team["sheets"]:
-            sheet_name = sheet_info["name"]
-            sheet_type = sheet_info["type"]
+    # Summary (sau load để có số dòng mới theo farm / tháng / sheet)
+    processor.print_summary()
+    state.print_summary()
+    report.print_summary()
 
-            data = read_sheet_data(wb, sheet_name)
-            if not data:
-                print(f"    ⏭️ Sheet '{sheet_name}' không tìm thấy hoặc rỗng")
-                continue
 
-            tag = f"{farm_label}/{team_name}/{sheet_name}"
-            if sheet_type == "nk":
-                processor.process_cong_sheet(data, farm_id, tag, override_doi=team_name)
-            elif sheet_type == "vt":
-                processor.process_vattu_sheet(data, farm_id, tag, override_doi=team_name)
+def _process_sheet(processor, wb, sheet, farm_id, tag, override_doi=None, state=None):
+    """Transform 1 sheet; bỏ qua hẳn nếu nội dung giống lần load trước,
+    chỉ parse phần sau watermark nếu bật --since-last-run.
+    """
+    rows = sheet["rows"]
+    start_row = tail_from = sheet.get("tail_from", 0)  # chỉ đọc đuôi: dòng trước đó là [] (xem batch_get_sheets)
+    if state is not None:
+        status, delta = state.check(wb["doc_id"], sheet["name"], rows, tail_from=tail_from)
+        if status == "unchanged" and state.skip_unchanged:
+            print(f"    ⏩ {tag}: không đổi ({len(sheet['rows'])} dòng), bỏ qua")
+            return
+        if status == "appended":
+            print(f"    🆕 {tag}: +{delta} dòng mới")
+        elif status == "edited":
+            print(f"    ✏️ {tag}: nội dung bị sửa ({delta:+d} dòng)")
+        start_row = max(tail_from, state.start_row(wb["doc_id"], sheet["name"], len(rows)))
+
+    def done(max_ngay):
+        if state is not None:
+            state.mark(wb["doc_id"], sheet["name"], len(rows), max_ngay)
+
+    if sheet["type"] in ("nk", "vt"):
+        checkpoint_id = None
+        if processor.checkpoint is not None and state is not None:
+            checkpoint_id = Checkpoint.sheet_id(wb["doc_id"], sheet["name"],
+                                                state.digest(wb["doc_id"], sheet["name"]), start_row)
+            result = processor.checkpoint.load(checkpoint_id)
+            if result is not None:
+                print(f"    ♻️ {tag}: dùng lại kết quả transform từ checkpoint")
+                processor.restore_sheet(sheet["type"], tag, result, done=done)
+                return
+        processor.transform_sheet(sheet["type"], rows, farm_id, tag, override_doi=override_doi,
+                                  start_row=start_row, done=done, checkpoint_id=checkpoint_id)
+    else:
+        done(None)
 
-        time.sleep(2)  # Delay giữa các đội tránh rate limit
 
+def _process_teams(processor, teams, farm_id, farm_label, state=None):
+    """Xử lý GSheet các đội (đã fetch sẵn)."""
+    print(f"  📋 {len(teams)} đội cần xử lý")
 
-def _process_master(gc, processor, source, farm_id, farm_label):
-    """Xử lý Farm 157/195: đọc từ Master GSheet."""
-    doc_id = source["master"]
-    print(f"  📂 Đang mở GSheet: {doc_id}...")
+    for wb in teams:
+        team_name = wb["name"]
+        print(f"\n  📂 Đội: {team_name}...")
 
-    wb = open_gsheet_with_retry(gc, doc_id)
-    if not wb:
-        print(f"  ❌ Không thể mở GSheet cho {farm_label}, bỏ qua.")
-        return
+        if not wb["ok"]:
+            print(f"  ❌ Không mở được file của {team_name}, bỏ qua.")
+            continue
+        print(f"  ✅ \"{wb['title']}\"")
 
-    try:
-        print(f"  ✅ \"{wb.title}\"")
-    except Exception:
-        pass
+        for sheet in wb["sheets"]:
+            if not sheet["rows"]:
+                print(f"    ⏭️ Sheet '{sheet['requested']}' không tìm thấy hoặc rỗng")
+                continue
+            tag = f"{farm_label}/{team_name}/{sheet['name']}"
+            _process_sheet(processor, wb, sheet, farm_id, tag, override_doi=team_name, state=state)
 
-    # Tìm và xử lý sheet Công (fact)
-    cong_sheet_name = source.get("fact_cong_sheet")
-    if cong_sheet_name:
-        data = read_sheet_data(wb, cong_sheet_name)
-        if data:
-            processor.process_cong_sheet(data, farm_id, f"{farm_label}/{cong_sheet_name}")
-        else:
-            print(f"  ⚠️ Không tìm thấy sheet '{cong_sheet_name}'")
-            # Thử tìm tự động
-            for ws in wb.worksheets():
-                if "công" in ws.title.lower() and "fact" in ws.title.lower():
-                    print(f"  🔎 Tìm thấy sheet thay thế: '{ws.title}'")
-                    data = ws.get_all_values()
-                    if data:
-                        processor.process_cong_sheet(data, farm_id, f"{farm_label}/{ws.title}")
-                    break
-        time.sleep(2)
-
-    # Tìm và xử lý sheet Vật Tư (fact)
-    vt_sheet_name = source.get("fact_vt_sheet")
-    if vt_sheet_name:
-        data = read_sheet_data(wb, vt_sheet_name)
-        if data:
-            processor.process_vattu_sheet(data, farm_id, f"{farm_label}/{vt_sheet_name}")
-        else:
-            print(f"  ⚠️ Không tìm thấy sheet '{vt_sheet_name}'")
-            for ws in wb.worksheets():
-                if "vật tư" in ws.title.lower() and "fact" in ws.title.lower():
-                    print(f"  🔎 Tìm thấy: '{ws.title}'")
-                    data = ws.get_all_values()
-                    if data:
-                        processor.process_vattu_sheet(data, farm_id, f"{farm_label}/{ws.title}")
-                    break
-    else:
-        # Thử tìm tự động sheet VT
-        print(f"  🔎 Tìm tự động sheet Vật Tư...")
-        try:
-            for ws in wb.worksheets():
-                title_lower = ws.title.lower()
-                if ("vật tư" in title_lower and "fact" in title_lower) or \
-                   "nhập vật tư" in title_lower:
-                    print(f"  🔎 Tìm thấy: '{ws.title}'")
-                    data = ws.get_all_values()
-                    if data:
-                        processor.process_vattu_sheet(data, farm_id, f"{farm_label}/{ws.title}")
-                    break
-        except Exception as e:
-            print(f"  ❌ Lỗi tìm tự động VT: {e}")
+
+def _process_master(processor, wb, farm_id, farm_label, state=None):
+    """Xử lý Master GSheet (đã fetch sẵn), kể cả sheet tìm tự động."""
+    if not wb or not wb["ok"]:
+        print(f"  ❌ Không thể mở GSheet cho {farm_label}, bỏ qua.")
+        return
+    print(f"  ✅ \"{wb['title']}\"")
+
+    for sheet in wb["sheets"]:
+        requested = sheet["requested"]
+        if requested is None:
+            print("  🔎 Tìm tự động sheet Vật Tư...")
+            if sheet["name"]:
+                print(f"  🔎 Tìm thấy: '{sheet['name']}'")
+        elif sheet["name"] != requested or not sheet["rows"]:
+            print(f"  ⚠️ Không tìm thấy sheet '{requested}'")
+            if sheet["name"] and sheet["name"] != requested:
+                print(f"  🔎 Tìm thấy sheet thay thế: '{sheet['name']}'")
+        if sheet["rows"]:
+            _process_sheet(processor, wb, sheet, farm_id, f"{farm_label}/{sheet['name']}", state=state)
 
 
 def _print_final_verify(conn):
@@ -10,6 +10,7 @@ import psycopg2
 import psycopg2.extras
 from datetime import date, timedelta
 from db import query
+from etl_sync import refresh_rollup
 import os
 
 # --- Connect ---
@@ -53,6 +54,7 @@ dec_records = query("""
     ORDER BY nk.ngay
 """, params=('%BVTV%',))
 
+dec_records["ngay"] = dec_records["ngay"].dt.date  # query() trả datetime64; day_map bên dưới dùng date
 print(f"  Found {len(dec_records)} December records")
 if dec_records.empty:
     print("❌ No December data to clone!")
@@ -156,6 +158,7 @@ print(f"  Total to insert: {len(all_records)} records")
 
 # --- Step 4: Delete any existing estimated records first ---
 print("\n🗑️ Cleaning up any existing estimated records for BVTV Farm 126 Jan-Feb 2026...")
+# (commit cùng INSERT + rollup ở Step 5)
 with conn.cursor() as cur:
     cur.execute("""
         DELETE FROM fact_nhat_ky_san_xuat
@@ -166,7 +169,6 @@ with conn.cursor() as cur:
     """)
     deleted = cur.rowcount
     print(f"  Deleted {deleted} existing estimated records")
-    conn.commit()
 
 # --- Step 5: Insert ---
 print("\n💾 Inserting imputed records...")
@@ -180,9 +182,11 @@ insert_sql = """
 
 with conn.cursor() as cur:
     psycopg2.extras.execute_values(cur, insert_sql, all_records, page_size=200)
+    # Rollup tháng (agg_cong_thang) của Farm 126 T01-T02/2026 — cùng transaction với DELETE + INSERT
+    n = refresh_rollup(cur, "nk", int(dec_records["farm_id"].iloc[0]), {"2026-01", "2026-02"})
     conn.commit()
 
-print(f"✅ Inserted {len(all_records)} estimated records")
+print(f"✅ Inserted {len(all_records)} estimated records (rollup: {n} nhóm)")
 
 # --- Step 6: Verify ---
 print("\n📊 Verification: BVTV Farm 126 monthly after imputation")
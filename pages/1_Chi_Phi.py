@@ -4,7 +4,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from db import query, load_farms, load_filter_options, load_seasons, load_lo_vu_summary, load_date_range, format_vnd
+from db import query, load_agg, load_farms, load_filter_options, load_seasons, load_lo_vu_summary, load_date_range, format_vnd
 from style import (inject_css, page_header, kpi_row, section_header, tip,
                    drill_badge, apply_plotly_style, chart_or_table,
                    C, BAR_CONG, BAR_VAT_TU)
@@ -64,12 +64,6 @@ if "flt_search_cv" not in st.session_state:
 def clear_all():
     st.session_state.cp_farm = st.session_state.cp_doi = st.session_state.cp_lo = None
 
-def to_num(df, cols):
-    for c in cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-    return df
-
 def fmt_m(val):
     if val >= 1e9: return f"{val/1e9:.1f} tỷ"
     if val >= 1e6: return f"{val/1e6:.0f}M"
@@ -141,68 +135,17 @@ with st.sidebar:
 # ─────────────────────────────────────────────
 # LOAD DATA
 # ─────────────────────────────────────────────
-@st.cache_data(ttl=300)
-def load_cong(farm_ids, s, e, lo_types, sel_los, sel_dois, show_ht, sel_vus=None):
-    conds = [f"nk.farm_id IN ({','.join(['%s']*len(farm_ids))})"]
-    params = list(farm_ids)
-    
-    if sel_vus:
-        or_conds = []
-        for v in sel_vus:
-            or_conds.append(f"(nk.lo_id = %s AND nk.ngay BETWEEN %s AND %s)")
-            params.extend([v["lo_id"], v["vu_start"], v["vu_end"]])
-        conds.append(f"({' OR '.join(or_conds)})")
-    else:
-        conds.append("nk.ngay BETWEEN %s AND %s"); params += [str(s), str(e)]
-        
-    if lo_types: conds.append(f"l.lo_type IN ({','.join(['%s']*len(lo_types))})"); params += list(lo_types)
-    if sel_los:  conds.append(f"l.lo_code IN ({','.join(['%s']*len(sel_los))})");  params += list(sel_los)
-    if sel_dois: conds.append(f"d.doi_code IN ({','.join(['%s']*len(sel_dois))})"); params += list(sel_dois)
-    if not show_ht: conds.append("nk.is_ho_tro = FALSE")
-    return query(f"""
-        SELECT f.farm_code, l.lo_code, d.doi_code,
-               COALESCE(NULLIF(TRIM(cv.cong_doan),''),'Không ghi') as cong_doan,
-               COALESCE(NULLIF(TRIM(cv.ten_cong_viec),''),'Không ghi') as ten_cong_viec,
-               DATE_TRUNC('month',nk.ngay)::date as thang,
-               nk.so_cong, nk.thanh_tien, nk.is_ho_tro
-        FROM fact_nhat_ky_san_xuat nk
-        JOIN dim_farm f ON f.farm_id=nk.farm_id
-        JOIN dim_lo   l ON l.lo_id=nk.lo_id
-        JOIN dim_doi  d ON d.doi_id=nk.doi_id
-        JOIN dim_cong_viec cv ON cv.cong_viec_id=nk.cong_viec_id
-        WHERE {' AND '.join(conds)}
-    """, params)
-
-@st.cache_data(ttl=300)
-def load_vt(farm_ids, s, e, lo_types, sel_los, sel_vus=None):
-    conds = [f"vt.farm_id IN ({','.join(['%s']*len(farm_ids))})"]
-    params = list(farm_ids)
-    
-    if sel_vus:
-        or_conds = []
-        for v in sel_vus:
-            or_conds.append(f"(vt.lo_id = %s AND vt.ngay BETWEEN %s AND %s)")
-            params.extend([v["lo_id"], v["vu_start"], v["vu_end"]])
-        conds.append(f"({' OR '.join(or_conds)})")
-    else:
-        conds.append("vt.ngay BETWEEN %s AND %s"); params += [str(s), str(e)]
-        
-    if lo_types: conds.append(f"l.lo_type IN ({','.join(['%s']*len(lo_types))})"); params += list(lo_types)
-    if sel_los:  conds.append(f"l.lo_code IN ({','.join(['%s']*len(sel_los))})");  params += list(sel_los)
-    return query(f"""
-        SELECT f.farm_code, l.lo_code,
-               COALESCE(NULLIF(TRIM(v.loai_vat_tu), ''), 'Không xác định') as loai_vat_tu,
-               COALESCE(NULLIF(TRIM(v.ten_vat_tu),''), 'Không xác định') as ten_vat_tu,
-               DATE_TRUNC('month',vt.ngay)::date as thang,
-               vt.thanh_tien
-        FROM fact_vat_tu vt
-        JOIN dim_farm f ON f.farm_id=vt.farm_id
-        JOIN dim_lo   l ON l.lo_id=vt.lo_id
-        LEFT JOIN dim_vat_tu v ON v.vat_tu_id=vt.vat_tu_id
-        WHERE {' AND '.join(conds)}
-    """, params)
-
-@st.cache_data(ttl=300)
+# Mọi biểu đồ/bảng bên dưới chỉ cộng thanh_tien / so_cong theo vài bộ chiều → Postgres tính sẵn
+# (load_agg: 1 query GROUPING SETS cho công + 1 cho vật tư), page chỉ nhận các nhóm cần vẽ.
+# Drill đi vào WHERE; card Farm và bảng cuối trang bỏ qua drill (RAW_SETS, thêm 1 lượt khi đang drill).
+CONG_SETS = (("thang",), ("farm_code",), ("doi_code",), ("farm_code", "lo_code"), ("doi_code", "is_ho_tro"),
+             ("cong_doan",), ("ten_cong_viec",),
+             ("farm_code", "doi_code", "lo_code", "cong_doan", "ten_cong_viec"), ())
+VT_SETS = (("thang",), ("farm_code",), ("farm_code", "lo_code"), ("loai_vat_tu",), ("ten_vat_tu",),
+           ("loai_vat_tu", "ten_vat_tu"), ("farm_code", "lo_code", "loai_vat_tu", "ten_vat_tu"), ())
+RAW_SETS = (("farm_code",), ("farm_code", "lo_code"))
+
+@st.cache_data(ttl=300, max_entries=16)
 def load_lo_doi_map(farm_ids):
     return query(f"""
         SELECT DISTINCT l.lo_code, d.doi_code, f.farm_code
@@ -213,63 +156,57 @@ def load_lo_doi_map(farm_ids):
         WHERE nk.farm_id IN ({','.join(['%s']*len(farm_ids))})
     """, list(farm_ids))
 
-raw_c = load_cong(farm_ids, start_d, end_d,
-                  tuple(sel_lo_types), tuple(sel_los), tuple(sel_dois), show_ht, 
-                  tuple(sel_vus) if sel_vus else None)
-raw_v = load_vt(farm_ids, start_d, end_d, tuple(sel_lo_types), tuple(sel_los),
-                tuple(sel_vus) if sel_vus else None)
-to_num(raw_c, ["thanh_tien", "so_cong"])
-to_num(raw_v, ["thanh_tien"])
-
-# Tự động phân loại các vật tư "Không xác định"
-def _map_loai_vat_tu(row):
-    loai = row.get("loai_vat_tu", "")
-    if loai != "Không xác định": 
-        return loai
-    ten = str(row.get("ten_vat_tu", "")).lower()
-    if any(k in ten for k in ["phân", "bio", "calci", "chế phẩm"]):
-        return "Phân Bón"
-    if any(k in ten for k in ["cây", "chuối già"]):
-        return "Cây Giống"
-    if any(k in ten for k in ["xốp", "túi", "băng keo", "bao", "thùng", "carton", "dây", "pallet", "xe gắn máy", "bơm", "máy tính"]):
-        return "Vật Tư Tiêu Hao"
-    return "Không xác định"
-
-if not raw_v.empty and "loai_vat_tu" in raw_v.columns:
-    raw_v["loai_vat_tu"] = raw_v.apply(_map_loai_vat_tu, axis=1)
-
-
 lo_doi_map_df = load_lo_doi_map(farm_ids)
 _doi_to_los: dict = {}
 if not lo_doi_map_df.empty:
     for _, row in lo_doi_map_df.iterrows():
         _doi_to_los.setdefault(row["doi_code"], set()).add(row["lo_code"])
 
-def apply_drill(df):
-    d = df.copy()
-    if st.session_state.cp_farm and "farm_code" in d.columns:
-        d = d[d["farm_code"] == st.session_state.cp_farm]
+def drill_filters(kind):
+    """Drill đang bật → điều kiện cho load_agg. Vật tư không có đội → drill đội lọc theo các lô của đội."""
+    f = []
+    if st.session_state.cp_farm:
+        f.append(("farm_code", (st.session_state.cp_farm,)))
     if st.session_state.cp_doi:
-        if "doi_code" in d.columns:
-            d = d[d["doi_code"] == st.session_state.cp_doi]
-        elif "lo_code" in d.columns:
-            los_of_doi = _doi_to_los.get(st.session_state.cp_doi, set())
-            if los_of_doi:
-                d = d[d["lo_code"].isin(los_of_doi)]
-            else:
-                d = d.iloc[0:0]
-    if st.session_state.cp_lo and "lo_code" in d.columns:
-        d = d[d["lo_code"] == st.session_state.cp_lo]
-    return d
+        if kind == "cong":
+            f.append(("doi_code", (st.session_state.cp_doi,)))
+        else:
+            f.append(("lo_code", tuple(sorted(_doi_to_los.get(st.session_state.cp_doi, set())))))
+    if st.session_state.cp_lo:
+        f.append(("lo_code", (st.session_state.cp_lo,)))
+    return f
+
+flt_c, flt_v = [], []
+if sel_lo_types: flt_c.append(("lo_type", tuple(sel_lo_types))); flt_v.append(("lo_type", tuple(sel_lo_types)))
+if sel_los:      flt_c.append(("lo_code", tuple(sel_los)));      flt_v.append(("lo_code", tuple(sel_los)))
+if sel_dois:     flt_c.append(("doi_code", tuple(sel_dois)))
+if not show_ht:  flt_c.append(("is_ho_tro", (False,)))
+vus_arg = tuple(sel_vus) if sel_vus else None
+
+ac = load_agg("cong", CONG_SETS, farm_ids, start_d, end_d, tuple(flt_c + drill_filters("cong")), vus_arg)
+av = load_agg("vt", VT_SETS, farm_ids, start_d, end_d, tuple(flt_v + drill_filters("vt")), vus_arg)
+if st.session_state.cp_farm or st.session_state.cp_doi or st.session_state.cp_lo:
+    rc = load_agg("cong", RAW_SETS, farm_ids, start_d, end_d, tuple(flt_c), vus_arg)
+    rv = load_agg("vt", RAW_SETS, farm_ids, start_d, end_d, tuple(flt_v), vus_arg)
+else:
+    rc, rv = ac, av
 
-dc, dv = apply_drill(raw_c), apply_drill(raw_v)
-if dc.empty and dv.empty:
+nc, nv = ac[()]["n"].iloc[0], av[()]["n"].iloc[0]
+if not nc and not nv:
     st.warning("Không có dữ liệu."); st.stop()
 
-tc = dc["thanh_tien"].sum() if not dc.empty else 0
-tv = dv["thanh_tien"].sum() if not dv.empty else 0
+tc = ac[()]["thanh_tien"].iloc[0]
+tv = av[()]["thanh_tien"].iloc[0]
 ta = tc + tv
 
+def lo_totals(gc, gv):
+    """Công + vật tư theo (farm_code, lo_code), bỏ lô không có chi phí."""
+    b = gc[["farm_code", "lo_code", "thanh_tien"]].rename(columns={"thanh_tien": "tien_c"}).merge(
+        gv[["farm_code", "lo_code", "thanh_tien"]].rename(columns={"thanh_tien": "tien_v"}),
+        on=["farm_code", "lo_code"], how="outer").fillna(0)
+    b["total"] = b["tien_c"] + b["tien_v"]
+    return b[b["total"] > 0].reset_index(drop=True)
+
 # ─────────────────────────────────────────────
 # HEADER + KPI
 # ─────────────────────────────────────────────
@@ -283,7 +220,7 @@ kpi_row([
     dict(label="Chi phí Vật tư", value=format_vnd(tv), icon="🧪", color=AMB,
          delta=f"{tv/ta*100:.1f}% tổng" if ta else "", delta_positive=True),
     dict(label="Tổng số công",
-         value=f"{dc['so_cong'].sum():,.1f}" if not dc.empty else "0",
+         value=f"{ac[()]['so_cong'].iloc[0]:,.1f}" if nc else "0",
          icon="🗓️", color=C["purple"], footnote="công · ngày"),
 ])
 
@@ -293,8 +230,8 @@ kpi_row([
 section_header("Xu hướng theo tháng")
 col1, col2 = st.columns([3, 1])
 with col1:
-    mc = dc.groupby("thang")["thanh_tien"].sum().reset_index()
-    mv = dv.groupby("thang")["thanh_tien"].sum().reset_index() if not dv.empty else pd.DataFrame(columns=["thang","thanh_tien"])
+    mc = ac[("thang",)][["thang", "thanh_tien"]]
+    mv = av[("thang",)][["thang", "thanh_tien"]]
     m = mc.merge(mv, on="thang", how="outer", suffixes=("_c", "_v")).fillna(0)
     m["ts"] = pd.to_datetime(m["thang"]).dt.strftime("%m/%Y")
     fig = go.Figure()
@@ -320,8 +257,8 @@ with col2:
 # ═════════════════════════════════════════════
 section_header("Theo Farm", "click card để drill · breakdown xuất hiện bên dưới")
 
-fc = raw_c.groupby("farm_code")["thanh_tien"].sum().reset_index().rename(columns={"thanh_tien": "thanh_tien_c"})
-fv_g = raw_v.groupby("farm_code")["thanh_tien"].sum().reset_index().rename(columns={"thanh_tien": "thanh_tien_v"})
+fc = rc[("farm_code",)][["farm_code", "thanh_tien"]].rename(columns={"thanh_tien": "thanh_tien_c"})
+fv_g = rv[("farm_code",)][["farm_code", "thanh_tien"]].rename(columns={"thanh_tien": "thanh_tien_v"})
 
 bf = pd.DataFrame({"farm_code": sel_farms})
 if not fc.empty: bf = bf.merge(fc, on="farm_code", how="left")
@@ -331,7 +268,6 @@ if not fv_g.empty: bf = bf.merge(fv_g, on="farm_code", how="left")
 else: bf["thanh_tien_v"] = 0.0
 
 bf = bf.fillna(0)
-to_num(bf, ["thanh_tien_c", "thanh_tien_v"])
 bf["total"] = bf["thanh_tien_c"] + bf["thanh_tien_v"]
 bf = bf.sort_values("total", ascending=False).reset_index(drop=True)
 
@@ -383,8 +319,6 @@ for i, row in bf.iterrows():
 # ── Breakdown sau khi drill farm ──────────────
 if st.session_state.cp_farm:
     active_f = st.session_state.cp_farm
-    dc_f = dc.copy()
-    dv_f = dv.copy()
 
     st.markdown(
         f'<div style="background:{C["green_pale"]};border-left:3px solid {GRN};'
@@ -394,10 +328,7 @@ if st.session_state.cp_farm:
 
     col1, col2 = st.columns(2)
     with col1:
-        mc_f = dc_f.groupby("thang")["thanh_tien"].sum().reset_index()
-        mv_f = dv_f.groupby("thang")["thanh_tien"].sum().reset_index() if not dv_f.empty else pd.DataFrame(columns=["thang","thanh_tien"])
-        mf = mc_f.merge(mv_f, on="thang", how="outer", suffixes=("_c","_v")).fillna(0)
-        mf["ts"] = pd.to_datetime(mf["thang"]).dt.strftime("%m/%Y")
+        mf = m  # dữ liệu đã lọc theo farm đang drill → trùng biểu đồ tháng phía trên
         fig_ft = go.Figure()
         fig_ft.add_bar(x=mf["ts"], y=mf["thanh_tien_c"], name="Công",   marker_color=BAR_CONG,
                        hovertemplate="<b>%{x}</b><br>Công: %{y:,.0f} VND<extra></extra>")
@@ -409,8 +340,7 @@ if st.session_state.cp_farm:
         apply_plotly_style(fig_ft, 280)
         st.plotly_chart(fig_ft, use_container_width=True, key="farm_trend")
     with col2:
-        doi_f = dc_f.groupby("doi_code")["thanh_tien"].sum().reset_index()
-        doi_f["thanh_tien"] = pd.to_numeric(doi_f["thanh_tien"], errors="coerce").fillna(0)
+        doi_f = ac[("doi_code",)]
         doi_f = doi_f.sort_values("thanh_tien", ascending=True).tail(10)
         fig_fd = go.Figure(go.Bar(
             y=doi_f["doi_code"], x=doi_f["thanh_tien"], orientation="h",
@@ -432,18 +362,7 @@ st.markdown("---")
 # ── Biến dùng chung cho drill lô ─────────────
 farm_color_map = {"Farm 126": GRN, "Farm 157": BLU, "Farm 195": C["purple"]}
 
-lc = dc.groupby(["farm_code", "lo_code"])["thanh_tien"].sum().reset_index()
-lc.columns = ["farm_code", "lo_code", "tien_c"]
-if not dv.empty:
-    lv = dv.groupby(["farm_code", "lo_code"])["thanh_tien"].sum().reset_index()
-    lv.columns = ["farm_code", "lo_code", "tien_v"]
-    bl = lc.merge(lv, on=["farm_code", "lo_code"], how="outer").fillna(0)
-else:
-    bl = lc.copy(); bl["tien_v"] = 0.0
-bl["tien_c"] = pd.to_numeric(bl["tien_c"], errors="coerce").fillna(0)
-bl["tien_v"] = pd.to_numeric(bl["tien_v"], errors="coerce").fillna(0)
-bl["total"]  = bl["tien_c"] + bl["tien_v"]
-bl = bl[bl["total"] > 0].reset_index(drop=True)
+bl = lo_totals(ac[("farm_code", "lo_code")], av[("farm_code", "lo_code")])
 
 # ── Breakdown khi drill lô (từ sidebar/bubble) ─
 if st.session_state.cp_lo:
@@ -457,10 +376,7 @@ if st.session_state.cp_lo:
         unsafe_allow_html=True)
     col1, col2 = st.columns(2)
     with col1:
-        mc_lo = dc[dc["lo_code"] == active_lo_name].groupby("thang")["thanh_tien"].sum().reset_index()
-        mv_lo = dv[dv["lo_code"] == active_lo_name].groupby("thang")["thanh_tien"].sum().reset_index() if not dv.empty else pd.DataFrame(columns=["thang","thanh_tien"])
-        mlo = mc_lo.merge(mv_lo, on="thang", how="outer", suffixes=("_c","_v")).fillna(0)
-        mlo["ts"] = pd.to_datetime(mlo["thang"]).dt.strftime("%m/%Y")
+        mlo = m  # dữ liệu đã lọc theo lô đang drill
         fig_lot = go.Figure()
         fig_lot.add_bar(x=mlo["ts"], y=mlo["thanh_tien_c"], name="Công",   marker_color=BAR_CONG, hovertemplate="<b>%{x}</b><br>Công: %{y:,.0f} VND<extra></extra>")
         fig_lot.add_bar(x=mlo["ts"], y=mlo["thanh_tien_v"], name="Vật tư", marker_color=BAR_VAT_TU, hovertemplate="<b>%{x}</b><br>Vật tư: %{y:,.0f} VND<extra></extra>")
@@ -469,8 +385,7 @@ if st.session_state.cp_lo:
         apply_plotly_style(fig_lot, 280)
         st.plotly_chart(fig_lot, use_container_width=True, key="lo_trend")
     with col2:
-        cd_lo = dc[dc["lo_code"] == active_lo_name].groupby("cong_doan")["thanh_tien"].sum().reset_index()
-        cd_lo["thanh_tien"] = pd.to_numeric(cd_lo["thanh_tien"], errors="coerce").fillna(0)
+        cd_lo = ac[("cong_doan",)]
         cd_lo = cd_lo.sort_values("thanh_tien", ascending=True).tail(10)
         fig_locd = go.Figure(go.Bar(
             y=cd_lo["cong_doan"], x=cd_lo["thanh_tien"], orientation="h",
@@ -563,19 +478,7 @@ if not lo_vu_df.empty:
 
     # ── Bubble chart (ẩn trong expander) ────────────────────────────────
     with st.expander("🔵 Xem Bubble chart Công vs Vật tư theo Lô", expanded=False):
-        lc2 = dc.groupby(["farm_code", "lo_code"])["thanh_tien"].sum().reset_index()
-        lc2.columns = ["farm_code", "lo_code", "tien_c"]
-        if not dv.empty:
-            lv2 = dv.groupby(["farm_code", "lo_code"])["thanh_tien"].sum().reset_index()
-            lv2.columns = ["farm_code", "lo_code", "tien_v"]
-            bl2 = lc2.merge(lv2, on=["farm_code", "lo_code"], how="outer").fillna(0)
-        else:
-            bl2 = lc2.copy(); bl2["tien_v"] = 0.0
-        for col in ["tien_c", "tien_v"]:
-            bl2[col] = pd.to_numeric(bl2[col], errors="coerce").fillna(0)
-        bl2["total"] = bl2["tien_c"] + bl2["tien_v"]
-        bl2 = bl2[bl2["total"] > 0]
-        top40b = bl2.nlargest(40, "total").reset_index(drop=True)
+        top40b = bl.nlargest(40, "total").reset_index(drop=True)
         fig_bub = go.Figure()
         for fn, grp in top40b.groupby("farm_code"):
             clr = farm_color_map.get(fn, GRN)
@@ -607,8 +510,7 @@ st.markdown("---")
 # ═════════════════════════════════════════════
 section_header("Theo Đội", "click bar để drill · breakdown xuất hiện bên dưới")
 
-ht_raw = dc.groupby(["doi_code", "is_ho_tro"])["thanh_tien"].sum().reset_index()
-ht_raw["thanh_tien"] = pd.to_numeric(ht_raw["thanh_tien"], errors="coerce").fillna(0)
+ht_raw = ac[("doi_code", "is_ho_tro")]
 pv = ht_raw.pivot(index="doi_code", columns="is_ho_tro",
                   values="thanh_tien").fillna(0).reset_index()
 pv.columns.name = None
@@ -663,11 +565,9 @@ if st.session_state.cp_doi:
         f'📊 Đang xem chi tiết: <b>Đội {active_doi_name}</b></div>',
         unsafe_allow_html=True)
 
-    dc_doi = dc[dc["doi_code"] == active_doi_name].copy()
     col1, col2 = st.columns(2)
     with col1:
-        doi_farm = dc_doi.groupby("farm_code")["thanh_tien"].sum().reset_index()
-        doi_farm["thanh_tien"] = pd.to_numeric(doi_farm["thanh_tien"], errors="coerce").fillna(0)
+        doi_farm = ac[("farm_code",)]  # dữ liệu đã lọc theo đội đang drill
         fig_df = go.Figure(go.Bar(
             x=doi_farm["farm_code"], y=doi_farm["thanh_tien"],
             marker_color=[farm_color_map.get(f, GRN) for f in doi_farm["farm_code"]],
@@ -681,7 +581,7 @@ if st.session_state.cp_doi:
         apply_plotly_style(fig_df, 260)
         st.plotly_chart(fig_df, use_container_width=True, key="doi_farm_break")
     with col2:
-        doi_thang = dc_doi.groupby("thang")["thanh_tien"].sum().reset_index()
+        doi_thang = ac[("thang",)].copy()
         doi_thang["ts"] = pd.to_datetime(doi_thang["thang"]).dt.strftime("%m/%Y")
         fig_dt = go.Figure()
         fig_dt.add_scatter(x=doi_thang["ts"], y=doi_thang["thanh_tien"],
@@ -709,11 +609,9 @@ col1, col2 = st.columns(2)
 with col1:
     st.markdown(f'<div style="font-size:14px;font-weight:600;color:{C["blue"]};margin-bottom:8px">👷 CHI PHÍ CÔNG</div>', unsafe_allow_html=True)
     
-    dc_cd = dc[dc["cong_doan"].notna()].copy()
-    if not dc_cd.empty:
+    if nc:
         # Chart 1: Công Đoạn
-        cd_grp = dc_cd.groupby("cong_doan")["thanh_tien"].sum().reset_index()
-        cd_grp["thanh_tien"] = pd.to_numeric(cd_grp["thanh_tien"], errors="coerce").fillna(0)
+        cd_grp = ac[("cong_doan",)]
         cd_grp = cd_grp[cd_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
         
         if not cd_grp.empty:
@@ -732,88 +630,79 @@ with col1:
             st.plotly_chart(fig_cd, use_container_width=True, key="bar_cong_doan")
             
         # Chart 2: Tên Công Việc
-        if "ten_cong_viec" in dc_cd.columns:
-            cv_grp = dc_cd.groupby("ten_cong_viec")["thanh_tien"].sum().reset_index()
-            cv_grp["thanh_tien"] = pd.to_numeric(cv_grp["thanh_tien"], errors="coerce").fillna(0)
-            cv_grp = cv_grp[cv_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
+        cv_grp = ac[("ten_cong_viec",)]
+        cv_grp = cv_grp[cv_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
             
-            if not cv_grp.empty:
-                fig_cv = go.Figure(go.Bar(
-                    y=cv_grp["ten_cong_viec"], x=cv_grp["thanh_tien"], orientation="h",
-                    marker_color=C["blue"],
-                    hovertemplate="<b>%{y}</b><br>%{x:,.0f} VND<extra></extra>",
-                    text=[fmt_m(v) for v in cv_grp["thanh_tien"]],
-                    textposition="auto", textfont=dict(color=TS, size=11)
-                ))
-                fig_cv.update_layout(showlegend=False, xaxis_tickformat=",.0f",
-                                     yaxis=dict(automargin=True),
-                                     margin=dict(t=30, b=30, l=120, r=20),
-                                     title=dict(text="Top 10 Tên Công Việc", font=dict(size=12, color=TM)))
-                apply_plotly_style(fig_cv, 280)
-                st.plotly_chart(fig_cv, use_container_width=True, key="bar_cong_viec")
+        if not cv_grp.empty:
+            fig_cv = go.Figure(go.Bar(
+                y=cv_grp["ten_cong_viec"], x=cv_grp["thanh_tien"], orientation="h",
+                marker_color=C["blue"],
+                hovertemplate="<b>%{y}</b><br>%{x:,.0f} VND<extra></extra>",
+                text=[fmt_m(v) for v in cv_grp["thanh_tien"]],
+                textposition="auto", textfont=dict(color=TS, size=11)
+            ))
+            fig_cv.update_layout(showlegend=False, xaxis_tickformat=",.0f",
+                                 yaxis=dict(automargin=True),
+                                 margin=dict(t=30, b=30, l=120, r=20),
+                                 title=dict(text="Top 10 Tên Công Việc", font=dict(size=12, color=TM)))
+            apply_plotly_style(fig_cv, 280)
+            st.plotly_chart(fig_cv, use_container_width=True, key="bar_cong_viec")
     else:
         st.info("Không có dữ liệu công.")
 
 with col2:
     st.markdown(f'<div style="font-size:14px;font-weight:600;color:{C["amber"]};margin-bottom:8px">🧪 CHI PHÍ VẬT TƯ</div>', unsafe_allow_html=True)
     
-    dv_vt = dv.copy()
-    if not dv_vt.empty:
+    if nv:
         # Chart 3: Loại Vật Tư
-        if "loai_vat_tu" in dv_vt.columns:
-            lvt_grp = dv_vt.groupby("loai_vat_tu")["thanh_tien"].sum().reset_index()
-            lvt_grp["thanh_tien"] = pd.to_numeric(lvt_grp["thanh_tien"], errors="coerce").fillna(0)
-            lvt_grp = lvt_grp[lvt_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
+        lvt_grp = av[("loai_vat_tu",)]
+        lvt_grp = lvt_grp[lvt_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
             
-            if not lvt_grp.empty:
-                fig_lvt = go.Figure(go.Bar(
-                    y=lvt_grp["loai_vat_tu"], x=lvt_grp["thanh_tien"], orientation="h",
-                    marker_color=BAR_VAT_TU,
-                    hovertemplate="<b>%{y}</b><br>%{x:,.0f} VND<extra></extra>",
-                    text=[fmt_m(v) for v in lvt_grp["thanh_tien"]],
-                    textposition="auto", textfont=dict(color=TS, size=11)
-                ))
-                fig_lvt.update_layout(showlegend=False, xaxis_tickformat=",.0f",
-                                      yaxis=dict(automargin=True),
-                                      margin=dict(t=30, b=30, l=120, r=20),
-                                      title=dict(text="Top 10 Loại Vật Tư", font=dict(size=12, color=TM)))
-                apply_plotly_style(fig_lvt, 280)
-                st.plotly_chart(fig_lvt, use_container_width=True, key="bar_loai_vat_tu")
+        if not lvt_grp.empty:
+            fig_lvt = go.Figure(go.Bar(
+                y=lvt_grp["loai_vat_tu"], x=lvt_grp["thanh_tien"], orientation="h",
+                marker_color=BAR_VAT_TU,
+                hovertemplate="<b>%{y}</b><br>%{x:,.0f} VND<extra></extra>",
+                text=[fmt_m(v) for v in lvt_grp["thanh_tien"]],
+                textposition="auto", textfont=dict(color=TS, size=11)
+            ))
+            fig_lvt.update_layout(showlegend=False, xaxis_tickformat=",.0f",
+                                  yaxis=dict(automargin=True),
+                                  margin=dict(t=30, b=30, l=120, r=20),
+                                  title=dict(text="Top 10 Loại Vật Tư", font=dict(size=12, color=TM)))
+            apply_plotly_style(fig_lvt, 280)
+            st.plotly_chart(fig_lvt, use_container_width=True, key="bar_loai_vat_tu")
             
         # Chart 4: Tên Vật Tư
-        if "ten_vat_tu" in dv_vt.columns:
-            st.markdown("<br>", unsafe_allow_html=True)
-            dv_tvt = dv_vt.copy()
-            if "loai_vat_tu" in dv_tvt.columns:
-                loai_list = sorted([str(x) for x in dv_tvt["loai_vat_tu"].dropna().unique() if str(x).strip()])
-                loai_list.insert(0, "Tất cả")
-                sel_loai = st.selectbox("Lọc chi tiết theo Loại Vật Tư", loai_list, key="filter_loai_vat_tu")
-                if sel_loai != "Tất cả":
-                    dv_tvt = dv_tvt[dv_tvt["loai_vat_tu"] == sel_loai]
-                chart_title = f"Top 10 Tên Vật Tư ({sel_loai})" if sel_loai != "Tất cả" else "Top 10 Tên Vật Tư"
-            else:
-                chart_title = "Top 10 Tên Vật Tư"
+        st.markdown("<br>", unsafe_allow_html=True)
+        loai_list = sorted([str(x) for x in av[("loai_vat_tu",)]["loai_vat_tu"].unique() if str(x).strip()])
+        loai_list.insert(0, "Tất cả")
+        sel_loai = st.selectbox("Lọc chi tiết theo Loại Vật Tư", loai_list, key="filter_loai_vat_tu")
+        if sel_loai != "Tất cả":
+            tvt_grp = av[("loai_vat_tu", "ten_vat_tu")]
+            tvt_grp = tvt_grp[tvt_grp["loai_vat_tu"] == sel_loai]
+        else:
+            tvt_grp = av[("ten_vat_tu",)]
+        chart_title = f"Top 10 Tên Vật Tư ({sel_loai})" if sel_loai != "Tất cả" else "Top 10 Tên Vật Tư"
 
-            tvt_grp = dv_tvt.groupby("ten_vat_tu")["thanh_tien"].sum().reset_index()
-            tvt_grp["thanh_tien"] = pd.to_numeric(tvt_grp["thanh_tien"], errors="coerce").fillna(0)
-            tvt_grp = tvt_grp[tvt_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
+        tvt_grp = tvt_grp[tvt_grp["thanh_tien"] > 0].sort_values("thanh_tien", ascending=True).tail(10)
             
-            if not tvt_grp.empty:
-                fig_tvt = go.Figure(go.Bar(
-                    y=tvt_grp["ten_vat_tu"], x=tvt_grp["thanh_tien"], orientation="h",
-                    marker_color=C["amber"],
-                    hovertemplate="<b>%{y}</b><br>%{x:,.0f} VND<extra></extra>",
-                    text=[fmt_m(v) for v in tvt_grp["thanh_tien"]],
-                    textposition="auto", textfont=dict(color=TS, size=11)
-                ))
-                fig_tvt.update_layout(showlegend=False, xaxis_tickformat=",.0f",
-                                      yaxis=dict(automargin=True),
-                                      margin=dict(t=30, b=30, l=120, r=20),
-                                      title=dict(text=chart_title, font=dict(size=12, color=TM)))
-                apply_plotly_style(fig_tvt, 280)
-                st.plotly_chart(fig_tvt, use_container_width=True, key="bar_ten_vat_tu")
-            else:
-                st.info("Không có dữ liệu cho phần Lọc này.")
+        if not tvt_grp.empty:
+            fig_tvt = go.Figure(go.Bar(
+                y=tvt_grp["ten_vat_tu"], x=tvt_grp["thanh_tien"], orientation="h",
+                marker_color=C["amber"],
+                hovertemplate="<b>%{y}</b><br>%{x:,.0f} VND<extra></extra>",
+                text=[fmt_m(v) for v in tvt_grp["thanh_tien"]],
+                textposition="auto", textfont=dict(color=TS, size=11)
+            ))
+            fig_tvt.update_layout(showlegend=False, xaxis_tickformat=",.0f",
+                                  yaxis=dict(automargin=True),
+                                  margin=dict(t=30, b=30, l=120, r=20),
+                                  title=dict(text=chart_title, font=dict(size=12, color=TM)))
+            apply_plotly_style(fig_tvt, 280)
+            st.plotly_chart(fig_tvt, use_container_width=True, key="bar_ten_vat_tu")
+        else:
+            st.info("Không có dữ liệu cho phần Lọc này.")
     else:
         st.info("Không có dữ liệu vật tư.")
 
@@ -872,13 +761,10 @@ def pagination_controls(total_rows, page_key, page_size=PAGE_SIZE):
 lbl_cv = _drill_label(include_doi=True)
 tip(f"Công việc chi tiết theo Lô — {lbl_cv}")
 
-if not dc.empty and "ten_cong_viec" in dc.columns:
-    cv_grp = (dc.groupby(["farm_code", "doi_code", "lo_code",
-                           "cong_doan", "ten_cong_viec"])["thanh_tien"]
-               .sum().reset_index())
-    cv_grp["thanh_tien"] = pd.to_numeric(cv_grp["thanh_tien"], errors="coerce").fillna(0)
+if nc:
+    cv_grp = ac[("farm_code", "doi_code", "lo_code", "cong_doan", "ten_cong_viec")]
     cv_all = cv_grp[cv_grp["thanh_tien"] > 0].copy()
-    total_c = dc["thanh_tien"].sum()
+    total_c = tc
     cv_all["pct"] = (cv_all["thanh_tien"] / total_c * 100).round(2) if total_c else 0.0
     cv_all = cv_all.sort_values("thanh_tien", ascending=False).reset_index(drop=True)
 
@@ -939,13 +825,10 @@ if st.session_state.cp_doi:
                 if los_of_doi else " · đội này không có lô trong dim_lo_doi")
 tip(f"Vật tư chi tiết theo Lô — {lbl_vt}{doi_note}")
 
-if not dv.empty and "ten_vat_tu" in dv.columns:
-    vt_grp = (dv.groupby(["farm_code", "lo_code",
-                           "loai_vat_tu", "ten_vat_tu"])["thanh_tien"]
-               .sum().reset_index())
-    vt_grp["thanh_tien"] = pd.to_numeric(vt_grp["thanh_tien"], errors="coerce").fillna(0)
+if nv:
+    vt_grp = av[("farm_code", "lo_code", "loai_vat_tu", "ten_vat_tu")]
     vt_all = vt_grp[vt_grp["thanh_tien"] > 0].copy()
-    total_v = dv["thanh_tien"].sum()
+    total_v = tv
     vt_all["pct"] = (vt_all["thanh_tien"] / total_v * 100).round(2) if total_v else 0.0
     vt_all = vt_all.sort_values("thanh_tien", ascending=False).reset_index(drop=True)
 
@@ -994,16 +877,9 @@ st.markdown("---")
 # BẢNG CHI TIẾT THEO LÔ
 # ═════════════════════════════════════════════
 with st.expander("📋 Bảng chi tiết theo Lô"):
-    _lc = raw_c.groupby(["farm_code", "lo_code"])["thanh_tien"].sum().reset_index()
-    _lc.columns = ["farm_code", "lo_code", "tien_c"]
-    if not raw_v.empty:
-        _lv = raw_v.groupby(["farm_code", "lo_code"])["thanh_tien"].sum().reset_index()
-        _lv.columns = ["farm_code", "lo_code", "tien_v"]
-        _bl = _lc.merge(_lv, on=["farm_code", "lo_code"], how="outer").fillna(0)
-    else:
-        _bl = _lc.copy(); _bl["tien_v"] = 0.0
-    _bl["tien_c"] = pd.to_numeric(_bl["tien_c"], errors="coerce").fillna(0)
-    _bl["tien_v"] = pd.to_numeric(_bl["tien_v"], errors="coerce").fillna(0)
+    _lc = rc[("farm_code", "lo_code")][["farm_code", "lo_code", "thanh_tien"]].rename(columns={"thanh_tien": "tien_c"})
+    _lv = rv[("farm_code", "lo_code")][["farm_code", "lo_code", "thanh_tien"]].rename(columns={"thanh_tien": "tien_v"})
+    _bl = _lc.merge(_lv, on=["farm_code", "lo_code"], how="outer").fillna(0)
     _bl["Tổng"]   = _bl["tien_c"] + _bl["tien_v"]
     _bl = _bl.sort_values("Tổng", ascending=False).reset_index(drop=True)
     st.dataframe(pd.DataFrame({
@@ -4,7 +4,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from db import query, load_farms, load_filter_options, load_date_range, format_pct
+from db import query_frame, RowBudgetExceeded, load_farms, load_filter_options, load_date_range, format_pct
 from style import (inject_css, page_header, kpi_row, section_header, progress_bar,
                    tip, drill_badge, apply_plotly_style, chart_or_table,
                    C, CLR_DAT, CLR_KHONG, CLR_WARN)
@@ -74,7 +74,9 @@ with st.sidebar:
 # ─────────────────────────────────────────────
 # LOAD DATA — không dùng threshold, lấy ti_le thực tế
 # ─────────────────────────────────────────────
-@st.cache_data(ttl=300)
+# Cần từng dòng (median/phân bố) → stream qua server-side cursor, trần QUERY_ROW_BUDGET dòng;
+# max_entries giữ cache không phình theo số bộ lọc người dùng đã thử.
+@st.cache_data(ttl=300, max_entries=16)
 def load_dm(farm_ids, s, e, sel_dois, sel_los, include_ht):
     conds = [f"nk.farm_id IN ({','.join(['%s']*len(farm_ids))})"]
     params = list(farm_ids)
@@ -83,7 +85,7 @@ def load_dm(farm_ids, s, e, sel_dois, sel_los, include_ht):
     if sel_dois: conds.append(f"d.doi_code IN ({','.join(['%s']*len(sel_dois))})"); params += list(sel_dois)
     if sel_los:  conds.append(f"l.lo_code IN ({','.join(['%s']*len(sel_los))})"); params += list(sel_los)
     if not include_ht: conds.append("nk.is_ho_tro = FALSE")
-    return query(f"""
+    return query_frame(f"""
         SELECT f.farm_code, l.lo_code, d.doi_code,
                cv.ten_cong_viec,
                nk.ngay,
@@ -99,12 +101,12 @@ def load_dm(farm_ids, s, e, sel_dois, sel_los, include_ht):
         ORDER BY nk.ngay
     """, params)
 
-raw = load_dm(farm_ids, start_d, end_d, tuple(sel_dois), tuple(sel_los), include_ht)
+try:
+    raw = load_dm(farm_ids, start_d, end_d, tuple(sel_dois), tuple(sel_los), include_ht)
+except RowBudgetExceeded as ex:
+    st.error(f"⚠️ {ex}"); st.stop()
 if raw.empty: st.error("Không có dữ liệu định mức trong khoảng thời gian này."); st.stop()
 
-for col in ["so_cong","klcv","dinh_muc","ns_thuc","ti_le"]:
-    raw[col] = pd.to_numeric(raw[col], errors="coerce")
-raw["ngay"] = pd.to_datetime(raw["ngay"])
 
 def apply_drill(df):
     d = df.copy()
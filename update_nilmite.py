@@ -11,7 +11,7 @@ from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
 sys.path.insert(0, os.path.dirname(__file__))
-from etl_sync import detect_header_row, map_columns, parse_date, parse_number, normalize_text
+from etl_sync import detect_header_row, map_columns, parse_date, parse_number, normalize_text, refresh_rollup
 
 # --- Auth GSheet ---
 token_path = os.path.join(os.path.dirname(__file__), "token.json")
@@ -125,6 +125,7 @@ with conn.cursor() as cur:
 # --- Update don_gia and thanh_tien for matching rows ---
 print(f"\n🔧 Updating {len(db_rows)} Nilmite records in DB...")
 updated = 0
+months = set()  # tháng có dòng bị sửa → tính lại rollup agg_vat_tu_thang
 with conn.cursor() as cur:
     # Get farm_id and vat_tu_id for Farm 157 Nilmite
     cur.execute("SELECT farm_id FROM dim_farm WHERE farm_code = 'Farm 157'")
@@ -163,8 +164,11 @@ with conn.cursor() as cur:
                         WHERE vat_tu_fact_id = %s
                     """, (new_price, new_total_calc, fact_id))
                     updated += 1
+                    months.add(str(ngay)[:7])
                     print(f"  ✅ Updated {ngay} lô={lo_code}: price {old_price}->{new_price}, total {old_total}->{new_total_calc:.0f}")
     
+    if months:
+        refresh_rollup(cur, "vt", farm_id, months)
     conn.commit()
 
 print(f"\n✅ Done! Updated {updated} records.")